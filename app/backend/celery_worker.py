@@ -3,10 +3,37 @@
 from celery import Celery
 from app.config import settings
 
+REDIS_URL = getattr(settings, "REDIS_URL", "redis://localhost:6379/0")
+GMAIL_SYNC_INTERVAL_SECONDS = getattr(settings, "GMAIL_SYNC_INTERVAL_SECONDS", 5 * 60)
+# Redis Stream that ingest publishes new message ids to, and the consumer group analyzing them
+ANALYSIS_STREAM_KEY = getattr(settings, "ANALYSIS_STREAM_KEY", "analysis:incoming")
+ANALYSIS_STREAM_GROUP = getattr(settings, "ANALYSIS_STREAM_GROUP", "analyzers")
+# Each beat-started consumer task reads the stream for this long, then hands over to the next
+ANALYSIS_STREAM_TASK_SECONDS = getattr(settings, "ANALYSIS_STREAM_TASK_SECONDS", 60)
+
 celery_app = Celery(
     "email_tasks",
-    broker="redis://localhost:6379/0",
-    backend="redis://localhost:6379/1"
+    broker=REDIS_URL,
+    backend="redis://localhost:6379/1",
+    include=["app.backend.tasks.analysis_jobs", "app.backend.tasks.email_sync", "app.backend.tasks.analysis_stream"],
 )
 
 celery_app.conf.timezone = "UTC"
+# Redeliver a task if the worker dies mid-way instead of losing it
+celery_app.conf.task_acks_late = True
+celery_app.conf.task_reject_on_worker_lost = True
+celery_app.conf.worker_prefetch_multiplier = 1
+
+# `celery -A app.backend.celery_worker.celery_app beat` fans out one sync per mailbox
+celery_app.conf.beat_schedule = {
+    "sync-all-mailboxes": {
+        "task": "app.backend.tasks.email_sync.sync_all_mailboxes",
+        "schedule": GMAIL_SYNC_INTERVAL_SECONDS,
+    },
+    # Keeps ANALYSIS_STREAM_CONSUMERS consumers reading the analysis stream
+    "start-analysis-stream-consumers": {
+        "task": "app.backend.tasks.analysis_stream.start_analysis_stream_consumers",
+        "schedule": ANALYSIS_STREAM_TASK_SECONDS,
+        "options": {"expires": ANALYSIS_STREAM_TASK_SECONDS},
+    },
+}
@@ -6,7 +6,9 @@ CREATE TABLE threads (
     subject TEXT,
     snippet TEXT,
     history_id TEXT,
-    created_at TIMESTAMP DEFAULT now()
+    created_at TIMESTAMP DEFAULT now(),
+    summary TEXT,
+    analyzed_through TIMESTAMP
 );
 
 CREATE TABLE messages (
@@ -18,5 +20,73 @@ CREATE TABLE messages (
     subject TEXT,
     body TEXT,
     sent_at TIMESTAMP,
+    content_hash TEXT,
+    label_ids TEXT,
+    auto_headers TEXT,
     FOREIGN KEY (thread_id) REFERENCES threads(thread_id)
 );
+
+CREATE INDEX ix_messages_sent_at ON messages(sent_at);
+
+CREATE TABLE ai_message_analysis (
+    id SERIAL PRIMARY KEY,
+    message_id TEXT UNIQUE REFERENCES messages(message_id),
+    needs_reply BOOLEAN,
+    todo TEXT,
+    reply_draft TEXT,
+    reply_confidence DOUBLE PRECISION,
+    reply_source TEXT,
+    content_hash TEXT,
+    prompt_version TEXT,
+    processed_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX ix_ai_message_analysis_processed_at_id ON ai_message_analysis(processed_at, id);
+
+CREATE TABLE todos (
+    id SERIAL PRIMARY KEY,
+    message_id TEXT REFERENCES messages(message_id),
+    title TEXT NOT NULL,
+    completed BOOLEAN NOT NULL DEFAULT false,
+    due_hint TEXT,
+    created_at TIMESTAMP DEFAULT now(),
+    completed_at TIMESTAMP
+);
+
+CREATE INDEX ix_todos_message_id ON todos(message_id);
+CREATE INDEX ix_todos_created_at_id ON todos(created_at, id);
+CREATE INDEX ix_todos_completed_created_at_id ON todos(completed, created_at, id);
+
+CREATE TABLE mailbox_sync_state (
+    mailbox TEXT PRIMARY KEY,
+    history_id TEXT,
+    retry_message_ids TEXT,
+    last_full_sync_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE TABLE mailbox_credentials (
+    mailbox TEXT PRIMARY KEY,
+    encrypted_token TEXT NOT NULL,
+    account_email TEXT,
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE TABLE analysis_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT DEFAULT 'pending',
+    total INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT now(),
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE TABLE analysis_job_items (
+    id SERIAL PRIMARY KEY,
+    job_id TEXT REFERENCES analysis_jobs(id),
+    message_id TEXT REFERENCES messages(message_id),
+    status TEXT DEFAULT 'pending',
+    error TEXT,
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX ix_analysis_job_items_job_id ON analysis_job_items(job_id);
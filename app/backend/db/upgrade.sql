@@ -0,0 +1,88 @@
+-- app/db/upgrade.sql
+--
+-- Brings a database created from an older schema.sql (or init_db.py) up to the
+-- current one. Every statement is idempotent, so it is safe to run on every
+-- deploy:
+--
+--   psql "$DB_URL" -f app/backend/db/upgrade.sql
+
+BEGIN;
+
+-- Thread-level analysis
+ALTER TABLE threads ADD COLUMN IF NOT EXISTS summary TEXT;
+ALTER TABLE threads ADD COLUMN IF NOT EXISTS analyzed_through TIMESTAMP;
+
+-- Change detection, labels and bulk-mail markers
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_hash TEXT;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS label_ids TEXT;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS auto_headers TEXT;
+
+CREATE INDEX IF NOT EXISTS ix_messages_sent_at ON messages(sent_at);
+
+CREATE TABLE IF NOT EXISTS ai_message_analysis (
+    id SERIAL PRIMARY KEY,
+    message_id TEXT UNIQUE REFERENCES messages(message_id),
+    needs_reply BOOLEAN,
+    todo TEXT,
+    reply_draft TEXT,
+    processed_at TIMESTAMP DEFAULT now()
+);
+
+ALTER TABLE ai_message_analysis ADD COLUMN IF NOT EXISTS reply_confidence DOUBLE PRECISION;
+ALTER TABLE ai_message_analysis ADD COLUMN IF NOT EXISTS reply_source TEXT;
+ALTER TABLE ai_message_analysis ADD COLUMN IF NOT EXISTS content_hash TEXT;
+ALTER TABLE ai_message_analysis ADD COLUMN IF NOT EXISTS prompt_version TEXT;
+
+CREATE INDEX IF NOT EXISTS ix_ai_message_analysis_processed_at_id ON ai_message_analysis(processed_at, id);
+
+CREATE TABLE IF NOT EXISTS todos (
+    id SERIAL PRIMARY KEY,
+    message_id TEXT REFERENCES messages(message_id),
+    title TEXT NOT NULL,
+    completed BOOLEAN NOT NULL DEFAULT false,
+    due_hint TEXT,
+    created_at TIMESTAMP DEFAULT now(),
+    completed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_todos_message_id ON todos(message_id);
+CREATE INDEX IF NOT EXISTS ix_todos_created_at_id ON todos(created_at, id);
+CREATE INDEX IF NOT EXISTS ix_todos_completed_created_at_id ON todos(completed, created_at, id);
+
+CREATE TABLE IF NOT EXISTS mailbox_sync_state (
+    mailbox TEXT PRIMARY KEY,
+    history_id TEXT,
+    last_full_sync_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+ALTER TABLE mailbox_sync_state ADD COLUMN IF NOT EXISTS retry_message_ids TEXT;
+
+CREATE TABLE IF NOT EXISTS mailbox_credentials (
+    mailbox TEXT PRIMARY KEY,
+    encrypted_token TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+ALTER TABLE mailbox_credentials ADD COLUMN IF NOT EXISTS account_email TEXT;
+
+CREATE TABLE IF NOT EXISTS analysis_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT DEFAULT 'pending',
+    total INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT now(),
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS analysis_job_items (
+    id SERIAL PRIMARY KEY,
+    job_id TEXT REFERENCES analysis_jobs(id),
+    message_id TEXT REFERENCES messages(message_id),
+    status TEXT DEFAULT 'pending',
+    error TEXT,
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS ix_analysis_job_items_job_id ON analysis_job_items(job_id);
+
+COMMIT;
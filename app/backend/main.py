@@ -1,5 +1,8 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from app.backend.db.session import engine
 from app.backend.routes import gmail
+from app.backend.services.metrics import MetricsMiddleware, instrument_engine, render_metrics
 
 app = FastAPI(title="AI-Powered Email Assistant")
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,7 +13,26 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
+# Outermost, so its timings include the CORS layer and the full streamed body
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
 
 # Register your routes
 app.include_router(gmail.router, prefix="/gmail", tags=["Gmail"])
+
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    # Release the pooled keep-alive connections to Groq and Redis
+    from app.backend.services.ai_stuff import llm
+    from app.backend.services.response_cache import response_cache
+    await llm.aclose()
+    await response_cache.aclose()
@@ -5,6 +5,7 @@ from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 from sqlalchemy import Boolean, Text
 from sqlalchemy import Float
+from sqlalchemy import Index
 
 Base = declarative_base()
 
@@ -16,6 +17,9 @@ class Thread(Base):
     snippet = Column(Text)
     history_id = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Thread-level analysis: rolling summary of the conversation up to analyzed_through (a Message.sent_at)
+    summary = Column(Text, nullable=True)
+    analyzed_through = Column(DateTime, nullable=True)
 
 class Message(Base):
     __tablename__ = "messages"
@@ -26,10 +30,17 @@ class Message(Base):
     recipient = Column(Text)
     subject = Column(Text)
     body = Column(Text)
-    sent_at = Column(DateTime)
+    sent_at = Column(DateTime, index=True)
+    content_hash = Column(String)
+    label_ids = Column(Text)  # comma separated Gmail labelIds
+    auto_headers = Column(Text)  # comma separated bulk/automation markers, e.g. "list-unsubscribe,precedence:bulk"
 
 class AIMessageAnalysis(Base):
     __tablename__ = "ai_message_analysis"
+    __table_args__ = (
+        # Keyset pagination of reply drafts, newest first
+        Index("ix_ai_message_analysis_processed_at_id", "processed_at", "id"),
+    )
     id = Column(Integer, primary_key=True)
     message_id = Column(String, ForeignKey("messages.message_id"), unique=True)
     
@@ -37,5 +48,56 @@ class AIMessageAnalysis(Base):
     todo = Column(Text, nullable=True)
     reply_draft = Column(Text, nullable=True)
     reply_confidence = Column(Float, nullable=True)
+    reply_source = Column(String, nullable=True)  # who set needs_reply: "llm", "rules" or "model"; NULL on older rows means llm
+    content_hash = Column(String, nullable=True)
+    prompt_version = Column(String, nullable=True)
     processed_at = Column(DateTime, default=datetime.utcnow)
 
+class Todo(Base):
+    __tablename__ = "todos"
+    __table_args__ = (
+        # Keyset pagination runs newest first over (created_at, id), optionally per completed state
+        Index("ix_todos_created_at_id", "created_at", "id"),
+        Index("ix_todos_completed_created_at_id", "completed", "created_at", "id"),
+    )
+    id = Column(Integer, primary_key=True)
+    message_id = Column(String, ForeignKey("messages.message_id"), index=True)
+    title = Column(Text, nullable=False)
+    completed = Column(Boolean, default=False, nullable=False)
+    due_hint = Column(Text, nullable=True)  # free text deadline from the email, e.g. "Friday"
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
+class MailboxSyncState(Base):
+    __tablename__ = "mailbox_sync_state"
+    mailbox = Column(String, primary_key=True)
+    # High-water mark for users.history.list delta syncs
+    history_id = Column(String, nullable=True)
+    # Comma separated ids a sync couldn't fetch (after retries); fetched again by the next sync
+    retry_message_ids = Column(Text, nullable=True)
+    last_full_sync_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class MailboxCredentials(Base):
+    __tablename__ = "mailbox_credentials"
+    mailbox = Column(String, primary_key=True)
+    encrypted_token = Column(Text, nullable=False)  # Fernet token of the OAuth credentials JSON
+    account_email = Column(String, nullable=True)  # Google account (users.getProfile) the tokens belong to
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    id = Column(String, primary_key=True)  # uuid4 hex
+    status = Column(String, default="pending")  # pending, running, completed, completed_with_errors
+    total = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class AnalysisJobItem(Base):
+    __tablename__ = "analysis_job_items"
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String, ForeignKey("analysis_jobs.id"), index=True)
+    message_id = Column(String, ForeignKey("messages.message_id"))
+    status = Column(String, default="pending")  # pending, running, done, error
+    error = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
@@ -4,127 +4,149 @@ from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import RedirectResponse
 from google_auth_oauthlib.flow import Flow
 from app.config import settings
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from ..services.ai_stuff import flag_reply_needed, generate_reply, extract_todos_from_message
-from ..scripts.preprocess_msgs import fetch_top_30_messages, save_ai_analysis
-from ..scripts.preprocess_msgs import get_todos_from_db
-from ..scripts.preprocess_msgs import get_reply_drafts_from_db
-from ..services.ai_stuff import generate_reply_from_conversation, fetchRecentEmails, buildQAPrompt, answerQuestionWithLLM
+from ..celery_worker import REDIS_URL
+from ..services.analysis import analyze_messages, fetch_pending_messages
+from ..services.gmail import list_message_refs, batch_get_messages, ingest_messages, build_gmail_service
+from ..services.gmail_pool import gmail_pool
+from ..services.reply_prefilter import reply_prefilter
+from ..services.token_store import token_store, DEFAULT_MAILBOX
+from ..services.response_cache import response_cache
+from ..tasks.analysis_jobs import create_analysis_job, dispatch_analysis_job, get_analysis_job_status
+from ..scripts.preprocess_msgs import get_todos_from_db, set_todo_completed
+from ..scripts.preprocess_msgs import iter_reply_drafts, encode_cursor
+from ..services.ai_stuff import generate_reply_from_conversation_async, retrieveRelevantEmails, buildQAPrompt, answerQuestionWithLLMAsync, llm_cache, llm
+from ..services.ai_stuff import stream_reply_from_conversation_async, streamAnswerWithLLMAsync
 from pydantic import BaseModel
 from typing import List, Dict, Any
+from datetime import datetime
 # from ..scripts.preprocess_msgs import chat_llm
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import iterate_in_threadpool
+import asyncio
+import json
+import secrets
+import redis
 
 
 router = APIRouter()
 
+OAUTH_CLIENT_CONFIG = {
+    "web": {
+        "client_id": settings.GOOGLE_CLIENT_ID,
+        "client_secret": settings.GOOGLE_CLIENT_SECRET,
+        "redirect_uris": [settings.GOOGLE_REDIRECT_URI],
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token"
+    }
+}
+OAUTH_SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+# How long an /authorize nonce stays valid for /callback
+OAUTH_STATE_TTL_SECONDS = getattr(settings, "OAUTH_STATE_TTL_SECONDS", 600)
+OAUTH_STATE_COOKIE = "oauth_state"
+
+oauth_states = redis.Redis.from_url(REDIS_URL)
+
+
+def oauth_flow():
+    # A Flow carries per-authorization state, so each request still gets its own
+    flow = Flow.from_client_config(OAUTH_CLIENT_CONFIG, scopes=OAUTH_SCOPES)
+    flow.redirect_uri = settings.GOOGLE_REDIRECT_URI
+    return flow
+
 @router.get("/authorize")
 def authorize():
-    flow = Flow.from_client_config(
-        {
-            "web": {
-                "client_id": settings.GOOGLE_CLIENT_ID,
-                "client_secret": settings.GOOGLE_CLIENT_SECRET,
-                "redirect_uris": [settings.GOOGLE_REDIRECT_URI],
-                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                "token_uri": "https://oauth2.googleapis.com/token"
-            }
-        },
-        scopes=["https://www.googleapis.com/auth/gmail.readonly"],
-    )
-    flow.redirect_uri = settings.GOOGLE_REDIRECT_URI
+    flow = oauth_flow()
+    mailbox = DEFAULT_MAILBOX
 
+    # The state is a random single-use nonce; the mailbox it stands for stays server-side
+    state = secrets.token_urlsafe(32)
+    oauth_states.set(f"oauth_state:{state}", mailbox, ex=OAUTH_STATE_TTL_SECONDS)
     authorization_url, _ = flow.authorization_url(
         access_type='offline',
-        include_granted_scopes='true'
+        include_granted_scopes='true',
+        state=state,
     )
-    return RedirectResponse(authorization_url)
-
+    response = RedirectResponse(authorization_url)
+    # Binds the flow to the browser that started it, so a callback link forged by someone else is refused
+    response.set_cookie(
+        OAUTH_STATE_COOKIE, state, max_age=OAUTH_STATE_TTL_SECONDS, httponly=True, samesite="lax",
+        secure=settings.GOOGLE_REDIRECT_URI.startswith("https://"),
+    )
+    return response
 
-user_tokens = {}
 
 @router.get("/callback")
-async def oauth2_callback(request: Request):
+def oauth2_callback(request: Request):
     code = request.query_params.get("code")
     if not code:
         return {"error": "No code found in request"}
 
+    state = request.query_params.get("state") or ""
+    if not secrets.compare_digest(state.encode("utf-8"), request.cookies.get(OAUTH_STATE_COOKIE, "").encode("utf-8")):
+        raise HTTPException(status_code=400, detail="OAuth state does not match this browser's authorization")
+    mailbox = oauth_states.getdel(f"oauth_state:{state}")
+    if mailbox is None:
+        raise HTTPException(status_code=400, detail="Unknown or expired OAuth state")
+    mailbox = mailbox.decode("utf-8")
+
 
 # here if u see we have restablished the Oauth connection
 # why? because the "code" that we get after the user authorizes is just one time use
 # thats why we restablish the connection and do flow.fetch_token to get a more permanent kinda solution
 
-    flow = Flow.from_client_config(
-        {
-            "web": {
-                "client_id": settings.GOOGLE_CLIENT_ID,
-                "client_secret": settings.GOOGLE_CLIENT_SECRET,
-                "redirect_uris": [settings.GOOGLE_REDIRECT_URI],
-                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                "token_uri": "https://oauth2.googleapis.com/token"
-            }
-        },
-        scopes=["https://www.googleapis.com/auth/gmail.readonly"],
-    )
-    flow.redirect_uri = settings.GOOGLE_REDIRECT_URI
+    flow = oauth_flow()
 
     flow.fetch_token(code=code)
 
     credentials = flow.credentials
 
-    # ⚠️ Save this securely in production (encrypted DB)
-    user_tokens["default_user"] = {
-        "access_token": credentials.token,
-        "refresh_token": credentials.refresh_token,
-        "token_uri": credentials.token_uri,
-        "client_id": credentials.client_id,
-        "client_secret": credentials.client_secret,
-        "scopes": credentials.scopes,
-    }
+    # A mailbox stays tied to the Google account it was first authorized with
+    account = build_gmail_service(credentials).users().getProfile(userId="me").execute()["emailAddress"]
+    linked = token_store.account_email(mailbox)
+    if linked is not None and linked.lower() != account.lower():
+        raise HTTPException(status_code=409, detail=f"Mailbox {mailbox} is linked to a different Google account")
+
+    # Encrypted in the DB so every API process and Celery worker can use it
+    token_store.save(mailbox, credentials, account_email=account)
+
+    response = JSONResponse({"message": "Authorization successful", "scopes": credentials.scopes, "mailbox": mailbox, "account": account})
+    response.delete_cookie(OAUTH_STATE_COOKIE)
+    return response
 
-    return {"message": "Authorization successful", "scopes": credentials.scopes}
+def _fetch_latest_messages(mailbox, max_results):
+    """Latest message details for mailbox, or None if it never authorized. Blocking: list, batch get and backoff sleeps."""
+    with gmail_pool.lease(mailbox) as service:
+        if service is None:
+            return None
+        refs = list_message_refs(service, max_results=max_results)
+        details, _ = batch_get_messages(service, [ref["id"] for ref in refs])
+        return details
 
 @router.get("/messages")
-async def list_messages():
+async def list_messages(max_results: int = 30):
     try:
-        creds_data = user_tokens.get("default_user")
-        if not creds_data:
+        # Gmail calls and the upsert run in threads so a large import doesn't stall other requests
+        details = await asyncio.to_thread(_fetch_latest_messages, DEFAULT_MAILBOX, max_results)
+        if details is None:
             return {"error": "User not authenticated"}
 
-        creds = Credentials(
-            token=creds_data["access_token"],
-            refresh_token=creds_data["refresh_token"],
-            token_uri=creds_data["token_uri"],
-            client_id=creds_data["client_id"],
-            client_secret=creds_data["client_secret"],
-            scopes=creds_data["scopes"],
-        )
-
-        service = build("gmail", "v1", credentials=creds)
-
-        results = service.users().messages().list(userId="me", maxResults=30).execute()
-        messages = results.get("messages", [])
-
-        message_data = []
-
-        from app.backend.services.gmail import store_email_data
-
-        for msg in messages:
-            msg_detail = service.users().messages().get(userId="me", id=msg["id"]).execute()
-            snippet = msg_detail.get("snippet", "")
-            message_data.append({
-                "id": msg["id"],
-                "threadId": msg["threadId"],
-                "snippet": snippet,
-            })
+        message_data = [
+            {
+                "id": msg_detail["id"],
+                "threadId": msg_detail["threadId"],
+                "snippet": msg_detail.get("snippet", ""),
+            }
+            for msg_detail in details
+        ]
 
-            try:
-                store_email_data(msg["threadId"], msg_detail)
-            except Exception as e:
-                print(f"Error storing message {msg['id']}: {e}")
+        try:
+            counts = await asyncio.to_thread(ingest_messages, details, publish=True)
+        except Exception as e:
+            print(f"Error storing messages: {e}")
+            counts = None
 
-        return {"messages": message_data}
+        return {"messages": message_data, "ingested": counts}
 
     except Exception as e:
         import traceback
@@ -132,61 +154,170 @@ async def list_messages():
         return {"error": str(e)}
     
 @router.get("/ai_analysis")
-async def ai_analysis():
-    messages = fetch_top_30_messages()
-    processed = []
-
-    for msg in messages:
-        message_data = {
-            "sender": msg.sender,
-            "subject": msg.subject,
-            "body": msg.body,
-        }
-
-        needs_reply = flag_reply_needed(message_data)
-        reply_draft = generate_reply(message_data) if needs_reply else None
-        todos = extract_todos_from_message(message_data)
-
-        print("The generated draft is", reply_draft)
-        print("Extracted To-Dos:", todos)
-
-        save_ai_analysis(
-            message_id=msg.message_id,
-            needs_reply=needs_reply,
-            reply_draft=reply_draft,
-            todos=todos  # Make sure your save_ai_analysis accepts this
-        )
-
-        processed.append({
-            "message_id": msg.message_id,
-            "needs_reply": needs_reply,
-            "reply_draft": reply_draft,
-            "todos": todos
-        })
-
+async def ai_analysis(concurrency: int | None = None, mode: str | None = None, force: bool = False):
+    # Only new or changed messages are sent to the LLM unless force=true
+    messages = await asyncio.to_thread(fetch_pending_messages, limit=30, force=force)
+    processed = await analyze_messages(messages, concurrency=concurrency, mode=mode)
     return {"processed_messages": processed}
 
+@router.post("/ai_analysis/jobs")
+async def start_ai_analysis_job(force: bool = False, limit: int = 30):
+    # Analysis runs on Celery workers; poll the status endpoint for progress
+    job_id = await asyncio.to_thread(create_analysis_job, limit, force)
+    return {"job_id": job_id}
+
+@router.get("/ai_analysis/jobs/{job_id}")
+async def get_ai_analysis_job(job_id: str):
+    status = await asyncio.to_thread(get_analysis_job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return status
+
+@router.post("/ai_analysis/jobs/{job_id}/resume")
+async def resume_ai_analysis_job(job_id: str):
+    # Re-queues only the messages that are not done yet
+    if await asyncio.to_thread(get_analysis_job_status, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    await asyncio.to_thread(dispatch_analysis_job, job_id)
+    return {"job_id": job_id}
+
+def _etag_matches(request: Request, etag):
+    header = request.headers.get("if-none-match")
+    if not etag or not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+async def cached_json_response(request: Request, mailbox, namespace, params, compute):
+    """
+    Serve a read endpoint from the Redis response cache. compute() builds the
+    payload on a miss. A matching If-None-Match gets a 304 without touching
+    the DB or the LLM, since the ETag only changes when the data does.
+    """
+    etag, body, version = await response_cache.lookup(mailbox, namespace, params)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag else {}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if body is None:
+        body = json.dumps(jsonable_encoder(await compute())).encode("utf-8")
+        await response_cache.store(mailbox, namespace, params, version, body)
+        headers["X-Cache"] = "MISS"
+    else:
+        headers["X-Cache"] = "HIT"
+    return Response(body, media_type="application/json", headers=headers)
+
+async def _tee_to_cache(chunks, mailbox, namespace, params, version):
+    # Only a response that was sent in full gets cached
+    parts = []
+    try:
+        async for chunk in iterate_in_threadpool(chunks):
+            parts.append(chunk.encode("utf-8"))
+            yield chunk
+    finally:
+        chunks.close()
+    await response_cache.store(mailbox, namespace, params, version, b"".join(parts))
+
+async def cached_stream_response(request: Request, mailbox, namespace, params, chunks):
+    """Like cached_json_response for a streamed JSON body; chunks is a sync generator of str."""
+    etag, body, version = await response_cache.lookup(mailbox, namespace, params)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag else {}
+    if _etag_matches(request, etag):
+        chunks.close()
+        return Response(status_code=304, headers=headers)
+    if body is not None:
+        chunks.close()
+        return Response(body, media_type="application/json", headers={**headers, "X-Cache": "HIT"})
+    return StreamingResponse(
+        _tee_to_cache(chunks, mailbox, namespace, params, version),
+        media_type="application/json",
+        headers={**headers, "X-Cache": "MISS"},
+    )
+
 @router.get("/todos")
-async def get_todos():
-    """Get all todos extracted from emails"""
+async def get_todos(
+    request: Request,
+    limit: int = 50,
+    cursor: str | None = None,
+    completed: bool | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+):
+    """Page through todos extracted from emails, newest first; pass next_cursor back to get the next page"""
+    limit = min(max(limit, 1), 200)
+
+    async def compute():
+        todos, next_cursor = await asyncio.to_thread(get_todos_from_db, limit, cursor, completed, since, until)
+        return {"todos": todos, "next_cursor": next_cursor}
+
+    params = {"limit": limit, "cursor": cursor, "completed": completed, "since": since, "until": until}
     try:
-        todos = get_todos_from_db()  
-        return {"todos": todos}
+        return await cached_json_response(request, DEFAULT_MAILBOX, "todos", params, compute)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         import traceback
         traceback.print_exc()
         return {"error": str(e)}
 
+class TodoUpdate(BaseModel):
+    # Omit to flip the current state
+    completed: bool | None = None
+
+@router.patch("/todos/{todo_id}")
+async def update_todo(todo_id: int, update: TodoUpdate | None = None):
+    todo = await asyncio.to_thread(set_todo_completed, todo_id, update.completed if update else None)
+    if todo is None:
+        raise HTTPException(status_code=404, detail="Todo not found.")
+    return todo
+
+def _stream_reply_drafts(drafts, limit):
+    """
+    Serialize a page of drafts as {"reply_drafts": [...], "next_cursor": ...}
+    one row at a time. drafts yields up to limit + 1 rows; the extra one only
+    tells us whether there is a next page.
+    """
+    yield '{"reply_drafts": ['
+    last, has_more = None, False
+    try:
+        for count, draft in enumerate(drafts):
+            if count == limit:
+                has_more = True
+                break
+            yield ("," if count else "") + json.dumps(draft, default=lambda value: value.isoformat())
+            last = draft
+    finally:
+        drafts.close()  # releases the DB session even if the client went away
+    next_cursor = encode_cursor(last["processed_at"], last["id"]) if has_more else None
+    yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
 @router.get("/reply_drafts")
-async def get_todos():
-    """Get all todos extracted from emails"""
+async def get_reply_drafts(
+    request: Request, limit: int = 50, cursor: str | None = None, include_body: bool = True
+):
+    """Page through reply drafts, newest first; pass next_cursor back to get the next page"""
+    limit = min(max(limit, 1), 500)
     try:
-        reply_drafts = get_reply_drafts_from_db() 
-        return {"reply_drafts": reply_drafts}
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return {"error": str(e)}
+        drafts = iter_reply_drafts(limit + 1, cursor, include_body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    params = {"limit": limit, "cursor": cursor, "include_body": include_body}
+    return await cached_stream_response(request, DEFAULT_MAILBOX, "reply_drafts", params, _stream_reply_drafts(drafts, limit))
+
+@router.get("/llm_cache/stats")
+async def get_llm_cache_stats():
+    return llm_cache.stats()
+
+@router.get("/llm_scheduler/stats")
+async def get_llm_scheduler_stats():
+    # Reads the shared buckets from Redis
+    return await asyncio.to_thread(llm.scheduler.stats)
+
+@router.get("/gmail_pool/stats")
+async def get_gmail_pool_stats():
+    return gmail_pool.stats()
+
+@router.get("/reply_prefilter/stats")
+async def get_reply_prefilter_stats():
+    return reply_prefilter.stats()
 
 class ChatRequest(BaseModel):
     messages: list[dict]  
@@ -196,23 +327,75 @@ async def chat_llm(request: Request):
     data = await request.json()
     messages = data.get("messages", [])
     # Generate AI reply using full conversation
-    reply = generate_reply_from_conversation(messages)
+    reply = await generate_reply_from_conversation_async(messages)
     return JSONResponse({"reply": reply})
 
+# Emails retrieved from the search index and pasted into each Q&A prompt
+QA_TOP_K = getattr(settings, "QA_TOP_K", 8)
+
+async def sse_token_stream(request: Request, tokens):
+    """
+    Relay an async token stream as Server-Sent Events. Stops and closes the
+    upstream Groq request as soon as the client disconnects.
+    """
+    try:
+        async for token in tokens:
+            if await request.is_disconnected():
+                break
+            yield f"data: {json.dumps({'token': token})}\n\n"
+        else:
+            yield "event: done\ndata: {}\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+    finally:
+        await tokens.aclose()
+
+def sse_response(request: Request, tokens):
+    return StreamingResponse(
+        sse_token_stream(request, tokens),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.post("/chat/stream")
+async def chat_llm_stream(request: Request):
+    data = await request.json()
+    messages = data.get("messages", [])
+    return sse_response(request, stream_reply_from_conversation_async(messages))
+
 class EmailQARequest(BaseModel):
     # user_id: str
     question: str
 
 @router.post("/email-qa")
-async def email_qa(request: EmailQARequest):
-    print("Hello")
-    emails = fetchRecentEmails(count=30)
+async def email_qa(body: EmailQARequest, request: Request):
+    async def compute():
+        emails = await asyncio.to_thread(retrieveRelevantEmails, body.question, QA_TOP_K)
 
-    if not emails:
-        raise HTTPException(status_code=404, detail="No emails found.")
+        if not emails:
+            raise HTTPException(status_code=404, detail="No emails found.")
+
+        prompt = buildQAPrompt(emails, body.question)
 
-    prompt = buildQAPrompt(emails, request.question)
+        answer = await answerQuestionWithLLMAsync(prompt, strict=True)
 
-    answer = answerQuestionWithLLM(prompt)
+        return {"answer": answer}
+
+    # Repeat questions are answered from the cache until new mail or analyses land
+    try:
+        return await cached_json_response(request, DEFAULT_MAILBOX, "email-qa", {"question": body.question.strip()}, compute)
+    except HTTPException:
+        raise
+    except Exception:
+        # LLM failure: answer, but don't cache it
+        return {"answer": "Sorry, I couldn't answer that."}
+
+@router.post("/email-qa/stream")
+async def email_qa_stream(body: EmailQARequest, request: Request):
+    emails = await asyncio.to_thread(retrieveRelevantEmails, body.question, QA_TOP_K)
+
+    if not emails:
+        raise HTTPException(status_code=404, detail="No emails found.")
 
-    return {"answer": answer}
\ No newline at end of file
+    prompt = buildQAPrompt(emails, body.question)
+    return sse_response(request, streamAnswerWithLLMAsync(prompt))
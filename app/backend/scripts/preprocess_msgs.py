@@ -1,20 +1,28 @@
 from app.backend.db.session import SessionLocal
 from app.backend.models.email import Message
 from app.backend.models.email import AIMessageAnalysis
+from app.backend.models.email import Todo
+from app.backend.models.email import Thread
+from app.backend.services.metrics import TraceIdFilter, timed
+from app.backend.services.response_cache import response_cache
+from app.config import settings
 from datetime import datetime
+from sqlalchemy import or_, and_, tuple_
+import base64
 import json
 import logging
 from app.backend.models.email import AIMessageAnalysis
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG) # Ensure debug messages are visible
+logger.setLevel(getattr(settings, "LOG_LEVEL", "INFO"))
 
 # Add a handler if not configured globally (e.g., in your main.py/app.py)
 # This ensures logs go to the console
 if not logger.handlers:
     handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s')
     handler.setFormatter(formatter)
+    handler.addFilter(TraceIdFilter())
     logger.addHandler(handler)
 
 def fetch_top_30_messages():
@@ -26,26 +34,74 @@ def fetch_top_30_messages():
     finally:
         db.close()
 
-def save_ai_analysis(message_id, needs_reply, reply_draft, todos):
-     
+def fetch_messages_to_analyze(prompt_version, limit=30, force=False, message_ids=None):
+    """
+    Latest messages that still need LLM analysis: no analysis row yet, the
+    message content changed since it was analyzed, or the prompts changed.
+    Done as a single LEFT JOIN ... IS NULL query. force=True ignores existing
+    analyses and returns the latest messages like fetch_top_30_messages.
+    message_ids, if given, restricts the query to those messages.
+    """
     db = SessionLocal()
     try:
-        analysis = db.query(AIMessageAnalysis).filter_by(message_id=message_id).first()
-        if not analysis:
-            analysis = AIMessageAnalysis(message_id=message_id)
-            db.add(analysis)
-            logger.info(f"Created new AI analysis for message ID: {message_id}")
-        else:
-            logger.info(f"Updating AI analysis for message ID: {message_id}")
+        query = db.query(Message)
+        if message_ids is not None:
+            query = query.filter(Message.message_id.in_(message_ids))
+        if not force:
+            query = (
+                query.outerjoin(AIMessageAnalysis, AIMessageAnalysis.message_id == Message.message_id)
+                .filter(or_(
+                    AIMessageAnalysis.id.is_(None),
+                    and_(
+                        Message.content_hash.isnot(None),
+                        AIMessageAnalysis.content_hash.is_distinct_from(Message.content_hash),
+                    ),
+                    AIMessageAnalysis.prompt_version.is_distinct_from(prompt_version),
+                ))
+            )
+        messages = query.order_by(Message.sent_at.desc()).limit(limit).all()
+        logger.debug(f"Fetched {len(messages)} messages to analyze (force={force}).")
+        return messages
+    finally:
+        db.close()
+
+def _apply_analysis(db, message_id, needs_reply, reply_draft, todos, reply_confidence, content_hash, prompt_version, reply_source):
+    analysis = db.query(AIMessageAnalysis).filter_by(message_id=message_id).first()
+    if not analysis:
+        analysis = AIMessageAnalysis(message_id=message_id)
+        db.add(analysis)
+        logger.info(f"Created new AI analysis for message ID: {message_id}")
+    else:
+        logger.info(f"Updating AI analysis for message ID: {message_id}")
+
+    analysis.needs_reply = needs_reply
+    analysis.reply_draft = reply_draft
+    analysis.reply_confidence = reply_confidence
+    analysis.reply_source = reply_source
+    analysis.content_hash = content_hash
+    analysis.prompt_version = prompt_version
 
-        analysis.needs_reply = needs_reply
-        analysis.reply_draft = reply_draft
+    analysis.processed_at = datetime.utcnow()
+    if todos is None:
+        # Leave the message's todos as they are
+        if analysis.todo is None:
+            analysis.todo = "[]"
+        return analysis
 
-        # --- NEW LOG HERE ---
-        logger.debug(f"SAVE_AI_ANALYSIS: Attempting to save 'todos' for message ID {message_id}. Value: '{todos}' (Type: {type(todos)})")
-        analysis.todo = todos
-        analysis.processed_at = datetime.utcnow()
+    # --- NEW LOG HERE ---
+    logger.debug(f"SAVE_AI_ANALYSIS: Attempting to save 'todos' for message ID {message_id}. Value: '{todos}' (Type: {type(todos)})")
+    analysis.todo = todos
+    _replace_todos(db, message_id, todos)
+    return analysis
+
+@timed("db_write_analysis")
+def save_ai_analysis(message_id, needs_reply, reply_draft, todos, reply_confidence=None, content_hash=None, prompt_version=None, reply_source="llm"):
+     
+    db = SessionLocal()
+    try:
+        analysis = _apply_analysis(db, message_id, needs_reply, reply_draft, todos, reply_confidence, content_hash, prompt_version, reply_source)
         db.commit()
+        response_cache.bump()
         logger.debug(f"Successfully saved AI analysis for {message_id}. todo column value after commit: '{analysis.todo}'")
     except Exception as e:
         db.rollback()
@@ -53,77 +109,246 @@ def save_ai_analysis(message_id, needs_reply, reply_draft, todos):
     finally:
         db.close()
 
-def get_todos_from_db():
+def load_thread_context(thread_id, before, lookback=20, replaced_message_id=None):
+    """
+    What thread-level analysis knows about a conversation: its rolling summary
+    and the sent_at it covers, the titles of all its todos (open or done), and
+    the bodies of up to `lookback` earlier messages (sent before `before`) to
+    spot quoted text. Todos of replaced_message_id, whose todo list the
+    analysis is about to rewrite, don't count as tracked; otherwise a re-run
+    would leave them out of the new list and _replace_todos would delete them.
+    """
     db = SessionLocal()
     try:
-        total_analysis_records = db.query(AIMessageAnalysis).count()
-        logger.debug(f"GET_TODOS_FROM_DB: Total AIMessageAnalysis records in DB: {total_analysis_records}")
+        thread = db.query(Thread).filter_by(thread_id=thread_id).first()
+        query = (
+            db.query(Todo.title)
+            .join(Message, Message.message_id == Todo.message_id)
+            .filter(Message.thread_id == thread_id)
+        )
+        if replaced_message_id is not None:
+            query = query.filter(Todo.message_id != replaced_message_id)
+        tracked_todos = [title for (title,) in query.order_by(Todo.id)]
+        earlier_bodies = [
+            body
+            for (body,) in db.query(Message.body)
+            .filter(Message.thread_id == thread_id, Message.sent_at < before)
+            .order_by(Message.sent_at.desc())
+            .limit(lookback)
+        ]
+        return {
+            "summary": thread.summary if thread else None,
+            "analyzed_through": thread.analyzed_through if thread else None,
+            "tracked_todos": tracked_todos,
+            "earlier_bodies": earlier_bodies[::-1],
+        }
+    finally:
+        db.close()
 
-        results = (
+@timed("db_write_analysis")
+def save_thread_analysis(thread_id, summary, latest, covered, prompt_version):
+    """
+    Store one thread-level analysis in a single transaction: the full result
+    on the latest message (a dict of _apply_analysis arguments), a "thread"
+    analysis without reply on every other message it covered (their existing
+    todos stay), and the new summary on the thread. Older messages of the thread lose their reply flag and
+    draft, the conversation has moved on past them.
+    """
+    db = SessionLocal()
+    try:
+        latest_row = db.query(Message.sent_at).filter_by(message_id=latest["message_id"]).one()
+        _apply_analysis(db, **latest, prompt_version=prompt_version)
+        for message_id, content_hash in covered:
+            _apply_analysis(db, message_id, False, None, None, None, content_hash, prompt_version, "thread")
+        (
             db.query(AIMessageAnalysis)
+            .filter(
+                AIMessageAnalysis.message_id.in_(
+                    db.query(Message.message_id).filter(Message.thread_id == thread_id, Message.sent_at < latest_row.sent_at)
+                ),
+                AIMessageAnalysis.message_id.notin_([message_id for message_id, _ in covered]),
+                or_(AIMessageAnalysis.needs_reply.is_(True), AIMessageAnalysis.reply_draft.isnot(None)),
+            )
+            .update({"needs_reply": False, "reply_draft": None, "reply_source": "thread"}, synchronize_session=False)
+        )
+        thread = db.query(Thread).filter_by(thread_id=thread_id).first()
+        if thread is not None:
+            thread.summary = summary
+            thread.analyzed_through = max(thread.analyzed_through or latest_row.sent_at, latest_row.sent_at)
+        db.commit()
+        response_cache.bump()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def _parse_todo_items(todos):
+    try:
+        items = json.loads(todos) if todos else []
+    except json.JSONDecodeError:
+        items = [{"title": todos}]  # fallback if not proper JSON
+    if not isinstance(items, list):
+        items = [items]
+    return [item for item in items if isinstance(item, dict) and item.get("title")]
+
+def _replace_todos(db, message_id, todos):
+    """
+    Sync the todos rows of a message with a freshly extracted todo list.
+    Todos whose title survives a re-analysis keep their id and completed state.
+    """
+    existing = {row.title: row for row in db.query(Todo).filter_by(message_id=message_id)}
+    for item in _parse_todo_items(todos):
+        row = existing.pop(item["title"], None)
+        if row is None:
+            db.add(Todo(
+                message_id=message_id,
+                title=item["title"],
+                completed=bool(item.get("completed")),
+                due_hint=item.get("due"),
+            ))
+        else:
+            row.due_hint = item.get("due")
+    for row in existing.values():
+        db.delete(row)
+
+def backfill_todos(batch_size=500):
+    """One-off: fill the todos table from the JSON stored on existing analyses."""
+    db = SessionLocal()
+    try:
+        done = {message_id for (message_id,) in db.query(Todo.message_id).distinct()}
+        query = (
+            db.query(AIMessageAnalysis.message_id, AIMessageAnalysis.todo, AIMessageAnalysis.processed_at)
             .filter(AIMessageAnalysis.todo.isnot(None), AIMessageAnalysis.todo != "")
-            .all()
+            .yield_per(batch_size)
         )
-        # logger.debug(f"GET_TODOS_FROM_DB: Found {(results)} AIMessageAnalysis records with non-empty 'todo' after filtering.")
-
-        todos_list = []
-        for row in results:
-            # --- NEW LOG HERE ---
-            # logger.debug(f"GET_TODOS_FROM_DB: Processing row for message ID {row.message_id}. Raw 'todo' value from DB: '{row.todo}' (Type: {type(row.todo)})")
-
-            if row.todo != "{}": # This check is technically redundant due to the filter, but harmless
-                try:
-                    print(row.todo)
-                    parsed_todo = json.loads(row.todo)
-                    # print(parsed_todo)
-                    # logger.debug(f"Successfully parsed todo JSON for message ID: {parsed_todo}")
-                except json.JSONDecodeError:
-                    parsed_todo = {"title": row.todo}  # fallback if not proper JSON
-                    # logger.warning(f"Failed to parse todo JSON for message ID {row.message_id}. Falling back to title: '{row.todo}'")
-
-                todos_list.append({
-                    "id": row.id,
-                    "message_id": row.message_id,
-                    **parsed_todo
-                })
-        logger.debug(f"GET_TODOS_FROM_DB: Prepared {len(todos_list)} todos for response.")
-        return todos_list
+        added = 0
+        for message_id, todos, processed_at in query:
+            if message_id in done:
+                continue
+            for item in _parse_todo_items(todos):
+                db.add(Todo(
+                    message_id=message_id,
+                    title=item["title"],
+                    completed=bool(item.get("completed")),
+                    due_hint=item.get("due"),
+                    created_at=processed_at,
+                ))
+                added += 1
+        db.commit()
+        response_cache.bump()
+        logger.info(f"BACKFILL_TODOS: Added {added} todos.")
+        return added
+    finally:
+        db.close()
+
+def encode_cursor(timestamp, row_id):
+    """Opaque keyset cursor for the (timestamp, id) of the last row on a page."""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on anything malformed."""
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def _todo_to_dict(todo):
+    return {
+        "id": todo.id,
+        "message_id": todo.message_id,
+        "title": todo.title,
+        "completed": todo.completed,
+        "status": "completed" if todo.completed else "pending",
+        "due_hint": todo.due_hint,
+        "created_at": todo.created_at,
+        "completed_at": todo.completed_at,
+    }
+
+def get_todos_from_db(limit=50, cursor=None, completed=None, since=None, until=None):
+    """
+    One page of todos, newest first. Keyset pagination on (created_at, id)
+    served straight from the todos indexes, so every page costs the same no
+    matter how many todos exist. Returns (todos, next_cursor); next_cursor is
+    None on the last page.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    db = SessionLocal()
+    try:
+        query = db.query(Todo)
+        if completed is not None:
+            query = query.filter(Todo.completed == completed)
+        if since is not None:
+            query = query.filter(Todo.created_at >= since)
+        if until is not None:
+            query = query.filter(Todo.created_at < until)
+        if after:
+            query = query.filter(tuple_(Todo.created_at, Todo.id) < after)
+
+        rows = query.order_by(Todo.created_at.desc(), Todo.id.desc()).limit(limit + 1).all()
+        page = rows[:limit]
+        next_cursor = encode_cursor(page[-1].created_at, page[-1].id) if len(rows) > limit else None
+        logger.debug(f"GET_TODOS_FROM_DB: Prepared {len(page)} todos for response.")
+        return [_todo_to_dict(todo) for todo in page], next_cursor
     except Exception as e:
         logger.error(f"GET_TODOS_FROM_DB: An error occurred while fetching todos: {e}", exc_info=True)
         raise
     finally:
         db.close()
 
-def get_reply_drafts_from_db():
+def set_todo_completed(todo_id, completed=None):
+    """Set a todo's completed flag (or flip it when completed is None). Returns the todo, or None if missing."""
+    db = SessionLocal()
+    try:
+        todo = db.get(Todo, todo_id)
+        if todo is None:
+            return None
+        todo.completed = (not todo.completed) if completed is None else completed
+        todo.completed_at = datetime.utcnow() if todo.completed else None
+        db.commit()
+        response_cache.bump()
+        return _todo_to_dict(todo)
+    finally:
+        db.close()
+
+def iter_reply_drafts(limit=50, cursor=None, include_body=True):
+    """
+    Reply drafts newest first, one page of keyset pagination on
+    (processed_at, id). Only the columns the UI shows are selected and rows
+    are streamed from the DB rather than loaded at once. Returns a generator
+    of dicts; the cursor is validated up front (ValueError if malformed).
+    """
+    after = decode_cursor(cursor) if cursor else None
+    return _reply_draft_rows(limit, after, include_body)
+
+def _reply_draft_rows(limit, after, include_body):
+    columns = [
+        AIMessageAnalysis.id,
+        AIMessageAnalysis.message_id,
+        AIMessageAnalysis.reply_draft,
+        AIMessageAnalysis.needs_reply,
+        AIMessageAnalysis.processed_at,
+        Message.sender,
+        Message.subject,
+    ]
+    if include_body:
+        columns.append(Message.body)
+
     db = SessionLocal()
-    logger.debug("GET_REPLY_DRAFTS_FROM_DB: Attempting to fetch reply drafts from DB.")
     try:
-        results = (
-            db.query(AIMessageAnalysis, Message)
+        query = (
+            db.query(*columns)
             .join(Message, AIMessageAnalysis.message_id == Message.message_id)
             .filter(AIMessageAnalysis.reply_draft.isnot(None), AIMessageAnalysis.reply_draft != "")
-            .all()
         )
-
-        logger.debug(f"GET_REPLY_DRAFTS_FROM_DB: Found {len(results)} combined results for reply drafts.")
-
-        reply_drafts_list = []
-        for ai_analysis, message in results:
-            if ai_analysis.reply_draft:
-                reply_drafts_list.append({
-                    "id": ai_analysis.id,
-                    "message_id": ai_analysis.message_id,
-                    "reply_draft": ai_analysis.reply_draft,
-                    "needs_reply": ai_analysis.needs_reply,
-                    "processed_at": ai_analysis.processed_at,
-                    "sender": message.sender,
-                    "subject": message.subject,
-                    "body": message.body
-                })
-        logger.debug(f"GET_REPLY_DRAFTS_FROM_DB: Prepared {len(reply_drafts_list)} reply drafts for response.")
-        return reply_drafts_list
+        if after:
+            query = query.filter(tuple_(AIMessageAnalysis.processed_at, AIMessageAnalysis.id) < after)
+        query = query.order_by(AIMessageAnalysis.processed_at.desc(), AIMessageAnalysis.id.desc()).limit(limit)
+        for row in query.yield_per(100):
+            yield row._asdict()
     except Exception as e:
-        logger.error(f"GET_REPLY_DRAFTS_FROM_DB: An error occurred while fetching reply drafts: {e}", exc_info=True)
+        logger.error(f"ITER_REPLY_DRAFTS: An error occurred while fetching reply drafts: {e}", exc_info=True)
         raise
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
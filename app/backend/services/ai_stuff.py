@@ -3,7 +3,7 @@
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-from groq import Groq
+import asyncio
 from app.config import settings
 from datetime import datetime
 import json # Import json for serialization
@@ -13,25 +13,38 @@ from app.backend.models import email  # your DB session dependency
 from fastapi import Depends
 from app.backend.models.email import Message
 from app.backend.db.session import SessionLocal
+from app.backend.services.llm_cache import LLMCache
+from app.backend.services.llm_client import LLMClient
+from app.backend.services.llm_scheduler import PRIORITY_INTERACTIVE, GROQ_TPM, estimate_tokens
+from app.backend.services.metrics import TraceIdFilter, timed
+from app.backend.services.search_index import search_index
+from app.backend.services.vector_index import vector_index
 
 ai_logger = logging.getLogger(__name__)
-ai_logger.setLevel(logging.DEBUG) # Set to DEBUG to see all messages
+ai_logger.setLevel(getattr(settings, "LOG_LEVEL", "INFO"))
 
 if not ai_logger.handlers:
     handler = logging.StreamHandler()
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s')
     handler.setFormatter(formatter)
+    handler.addFilter(TraceIdFilter())
     ai_logger.addHandler(handler)
 
 # Load environment variables
 env_path = Path('app') / '.env'
 load_dotenv(dotenv_path=env_path)
 
-# Initialize Groq client with API key from .env
+# Initialize the shared LLM client with API key from .env
 api_key = settings.GROQ_API_KEY # Assuming settings.GROQ_API_KEY is correctly loaded
-client = Groq(api_key=api_key)
+# Deterministic (temperature 0.0) calls are served from a local cache on repeat
+llm_cache = LLMCache()
+# Sync methods for Celery/scripts, *_async variants below for the FastAPI routes
+llm = LLMClient(api_key=api_key, cache=llm_cache)
 
-def flag_reply_needed(message):
+# Bump whenever a prompt below changes so stored analyses get redone
+PROMPT_VERSION = "3"
+
+def _flag_reply_request(message):
     prompt = f"""
 You are an assistant that determines if an email requires a reply.
 
@@ -42,23 +55,39 @@ Body: {message['body']}
 
 Does this email need a reply? Answer only "Yes" or "No".
 """
+    return {
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.0, # Keep this low for consistent "Yes/No"
+        "task": "flag_reply",
+    }
+
+def _parse_flag_reply(content):
+    answer = content.strip().lower()
+    ai_logger.debug(f"Flag reply needed AI response: '{answer}'")
+    return answer == "yes"
+
+def flag_reply_needed(message, strict=False):
     try:
-        completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt},
-            ],
-            model="llama-3.3-70b-versatile",
-            temperature=0.0 # Keep this low for consistent "Yes/No"
-        )
-        answer = completion.choices[0].message.content.strip().lower()
-        ai_logger.debug(f"Flag reply needed AI response: '{answer}'")
-        return answer == "yes"
+        return _parse_flag_reply(llm.complete(**_flag_reply_request(message)))
     except Exception as e:
+        if strict:
+            raise
         ai_logger.error(f"Error flagging reply needed: {e}", exc_info=True)
         return False # Default to False on error
 
-def generate_reply(message):
+async def flag_reply_needed_async(message, strict=False):
+    try:
+        return _parse_flag_reply(await llm.acomplete(**_flag_reply_request(message)))
+    except Exception as e:
+        if strict:
+            raise
+        ai_logger.error(f"Error flagging reply needed: {e}", exc_info=True)
+        return False
+
+def _generate_reply_request(message):
     prompt = f"""
 You are an assistant helping to draft a polite, concise reply email.
 
@@ -72,27 +101,58 @@ If any important detail (e.g., availability, preferences, confirmation) is
 unknown or ambiguous, insert a placeholder (e.g., {{insert your availability}},
 OR provide alternative phrasings that the user can choose from). Keep the reply clear, helpful, and adaptable.
 """
+    return {
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.7, # Allow some creativity for replies
+        "task": "generate_reply",
+    }
+
+def _parse_reply(content):
+    reply_content = content.strip()
+    ai_logger.debug(f"Generated reply draft: '{reply_content[:100]}...'")
+    return reply_content
+
+def generate_reply(message, strict=False):
     try:
-        completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt},
-            ],
-            model="llama-3.3-70b-versatile",
-            temperature=0.7 # Allow some creativity for replies
-        )
-        reply_content = completion.choices[0].message.content.strip()
-        ai_logger.debug(f"Generated reply draft: '{reply_content[:100]}...'")
-        return reply_content
+        return _parse_reply(llm.complete(**_generate_reply_request(message)))
     except Exception as e:
+        if strict:
+            raise
         ai_logger.error(f"Error generating reply: {e}", exc_info=True)
         return "Error generating reply. Please try again." # Default reply on error
 
-def extract_todos_from_message(message):
+async def generate_reply_async(message, strict=False):
+    try:
+        return _parse_reply(await llm.acomplete(**_generate_reply_request(message)))
+    except Exception as e:
+        if strict:
+            raise
+        ai_logger.error(f"Error generating reply: {e}", exc_info=True)
+        return "Error generating reply. Please try again."
+
+def clean_todos(parsed_data):
+    # Ensure each item in the list is a dict and has 'title' and 'completed'
+    # This adds robustness if the AI doesn't perfectly follow the schema
+    cleaned_todos = []
+    for item in parsed_data:
+        if isinstance(item, dict) and "title" in item:
+            cleaned_todos.append({
+                "title": item["title"],
+                "completed": item.get("completed", False), # Default to False if not provided by AI
+                "due": item["due"] if isinstance(item.get("due"), str) and item["due"].strip() else None,
+            })
+        else:
+            ai_logger.warning(f"Skipping malformed todo item from AI: {item}")
+    return cleaned_todos
+
+def _extract_todos_request(message):
     # This prompt now explicitly asks for JSON output
     prompt = f"""
 You are an assistant that extracts actionable tasks from emails.
-For each task, provide a "title" (string) and "completed" (boolean, default to false).
+For each task, provide a "title" (string), "completed" (boolean, default to false) and "due" (the deadline or date mentioned for it as a short string, or null).
 If there are no tasks, return an empty JSON array: [].
 Ensure your entire response is a valid JSON array.
 
@@ -102,66 +162,392 @@ Body: {message['body']}
 
 JSON tasks:
 """
+    return {
+        "messages": [
+            {"role": "system", "content": "You extract tasks from emails and return them as a JSON array."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.0,
+        "task": "extract_todos",
+    }
+
+def _parse_todos(content):
+    raw_ai_output = content.strip()
+    ai_logger.debug(f"Raw AI output for todos: '{raw_ai_output}'")
+
+    # Attempt to parse the AI's raw string response
+    try:
+        parsed_data = json.loads(raw_ai_output)
+        # Ensure the parsed data is a list
+        if not isinstance(parsed_data, list):
+            ai_logger.warning(f"AI returned non-list JSON for todos. Converting to empty list. Raw: '{raw_ai_output}'")
+            parsed_data = []
+
+        final_json_string = json.dumps(clean_todos(parsed_data))
+        ai_logger.debug(f"extract_todos_from_message returning final JSON string: '{final_json_string}'")
+        return final_json_string
+
+    except json.JSONDecodeError:
+        ai_logger.error(f"AI returned unparseable JSON for todos: '{raw_ai_output}'. Returning empty array string.", exc_info=True)
+        return "[]" # If AI output is not valid JSON, return an empty array string
+
+def extract_todos_from_message(message, strict=False):
+    try:
+        return _parse_todos(llm.complete(**_extract_todos_request(message)))
+    except Exception as e:
+        if strict:
+            raise
+        ai_logger.error(f"Error during AI model call for todos: {e}. Returning empty array string.", exc_info=True)
+        return "[]"
+
+async def extract_todos_from_message_async(message, strict=False):
+    try:
+        return _parse_todos(await llm.acomplete(**_extract_todos_request(message)))
+    except Exception as e:
+        if strict:
+            raise
+        ai_logger.error(f"Error during AI model call for todos: {e}. Returning empty array string.", exc_info=True)
+        return "[]"
+
+def _triage_request(message):
+    prompt = f"""
+You are an assistant that triages emails.
+For the email below, decide whether it needs a reply and extract any actionable tasks.
+
+Respond with a single JSON object with exactly these keys:
+- "needs_reply": true or false
+- "reply_confidence": a number between 0 and 1 for how sure you are about needs_reply
+- "todos": a JSON array of tasks, each with a "title" (string), "completed" (boolean, default to false) and "due" (the deadline or date mentioned for it as a short string, or null). Use [] if there are no tasks.
+
+Email from {message['sender']}:
+Subject: {message['subject']}
+Body: {message['body']}
+"""
+    return {
+        "messages": [
+            {"role": "system", "content": "You triage emails and return a JSON object."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.0,
+        "response_format": {"type": "json_object"},
+        "task": "triage",
+    }
+
+def _parse_triage(content):
+    # Raises on anything unusable so the caller can fall back to separate calls
+    raw_ai_output = content.strip()
+    ai_logger.debug(f"Raw AI output for triage: '{raw_ai_output}'")
+    return _validate_triage(json.loads(raw_ai_output), raw_ai_output)
+
+def _validate_triage(parsed, raw_ai_output):
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("needs_reply"), bool):
+        raise ValueError(f"AI returned malformed triage object: '{raw_ai_output}'")
+
+    todos = parsed.get("todos", [])
+    if not isinstance(todos, list):
+        ai_logger.warning(f"AI returned non-list todos in triage. Converting to empty list. Raw: '{raw_ai_output}'")
+        todos = []
+
     try:
-        completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You extract tasks from emails and return them as a JSON array."},
-                {"role": "user", "content": prompt},
-            ],
-            model="llama-3.3-70b-versatile",
-            temperature=0.0 
+        reply_confidence = min(max(float(parsed.get("reply_confidence")), 0.0), 1.0)
+    except (TypeError, ValueError):
+        reply_confidence = None
+
+    return {
+        "needs_reply": parsed["needs_reply"],
+        "todos": json.dumps(clean_todos(todos)),
+        "reply_confidence": reply_confidence,
+    }
+
+def triage_message(message, strict=False):
+    """
+    Single-call replacement for flag_reply_needed + extract_todos_from_message.
+    Returns a dict with needs_reply (bool), todos (JSON string, same shape as
+    extract_todos_from_message) and reply_confidence (float 0-1).
+    If the combined call fails or returns something unusable, falls back to the
+    two separate calls so the caller always gets a complete result.
+    With strict=True, errors from those calls are raised instead of being
+    replaced by defaults, so batch analysis never saves a made-up result.
+    """
+    try:
+        return _parse_triage(llm.complete(**_triage_request(message)))
+    except Exception as e:
+        ai_logger.warning(f"Triage call failed, falling back to separate calls: {e}", exc_info=True)
+        return {
+            "needs_reply": flag_reply_needed(message, strict=strict),
+            "todos": extract_todos_from_message(message, strict=strict),
+            "reply_confidence": None,
+        }
+
+async def triage_message_async(message, strict=False):
+    try:
+        return _parse_triage(await llm.acomplete(**_triage_request(message)))
+    except Exception as e:
+        ai_logger.warning(f"Triage call failed, falling back to separate calls: {e}", exc_info=True)
+        needs_reply, todos = await asyncio.gather(
+            flag_reply_needed_async(message, strict=strict),
+            extract_todos_from_message_async(message, strict=strict),
         )
+        return {"needs_reply": needs_reply, "todos": todos, "reply_confidence": None}
+
+# Batched triage: several emails in one completion, answered as one JSON object keyed by message id.
+# Batches are filled up to a token budget (kept well inside the TPM limit) and a message cap that adapts
+TRIAGE_BATCH_TOKEN_BUDGET = min(getattr(settings, "TRIAGE_BATCH_TOKEN_BUDGET", 6000), GROQ_TPM // 2)
+TRIAGE_BATCH_MAX_MESSAGES = getattr(settings, "TRIAGE_BATCH_MAX_MESSAGES", 16)
+# Answer tokens reserved per email; also caps the completion so a runaway answer can't eat the budget
+TRIAGE_BATCH_ANSWER_TOKENS = 150
+
+TRIAGE_BATCH_INSTRUCTIONS = """
+You are an assistant that triages emails.
+For each email below, decide whether it needs a reply and extract any actionable tasks.
+
+Respond with a single JSON object with one key per email: the id attribute of its email tag, exactly as given.
+Each value is an object with exactly these keys:
+- "needs_reply": true or false
+- "reply_confidence": a number between 0 and 1 for how sure you are about needs_reply
+- "todos": a JSON array of tasks, each with a "title" (string), "completed" (boolean, default to false) and "due" (the deadline or date mentioned for it as a short string, or null). Use [] if there are no tasks.
+"""
 
-        raw_ai_output = completion.choices[0].message.content.strip()
-        ai_logger.debug(f"Raw AI output for todos: '{raw_ai_output}'")
+def _batch_triage_section(message):
+    return f"""
+<email id="{message['message_id']}">
+From: {message['sender']}
+Subject: {message['subject']}
+Body: {message['body']}
+</email>
+"""
 
-        # Attempt to parse the AI's raw string response
+def _batch_triage_request(messages):
+    prompt = TRIAGE_BATCH_INSTRUCTIONS + "".join(_batch_triage_section(m) for m in messages)
+    return {
+        "messages": [
+            {"role": "system", "content": "You triage emails and return a JSON object."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.0,
+        "response_format": {"type": "json_object"},
+        "max_tokens": TRIAGE_BATCH_ANSWER_TOKENS * len(messages),
+        "task": "triage_batch",
+    }
+
+def _parse_batch_triage(content, message_ids):
+    """{message_id: triage} for the ids whose entry is well formed; missing or malformed ones are left out."""
+    raw_ai_output = content.strip()
+    ai_logger.debug(f"Raw AI output for batch triage: '{raw_ai_output}'")
+    parsed = json.loads(raw_ai_output)
+    if not isinstance(parsed, dict):
+        raise ValueError(f"AI returned malformed batch triage object: '{raw_ai_output}'")
+    results = {}
+    for message_id in message_ids:
         try:
-            parsed_data = json.loads(raw_ai_output)
-            # Ensure the parsed data is a list
-            if not isinstance(parsed_data, list):
-                ai_logger.warning(f"AI returned non-list JSON for todos. Converting to empty list. Raw: '{raw_ai_output}'")
-                parsed_data = []
-
-            # Ensure each item in the list is a dict and has 'title' and 'completed'
-            # This adds robustness if the AI doesn't perfectly follow the schema
-            cleaned_todos = []
-            for item in parsed_data:
-                if isinstance(item, dict) and "title" in item:
-                    cleaned_todos.append({
-                        "title": item["title"],
-                        "completed": item.get("completed", False) # Default to False if not provided by AI
-                    })
-                else:
-                    ai_logger.warning(f"Skipping malformed todo item from AI: {item}")
-
-            final_json_string = json.dumps(cleaned_todos)
-            ai_logger.debug(f"extract_todos_from_message returning final JSON string: '{final_json_string}'")
-            return final_json_string
-
-        except json.JSONDecodeError:
-            ai_logger.error(f"AI returned unparseable JSON for todos: '{raw_ai_output}'. Returning empty array string.", exc_info=True)
-            return "[]" # If AI output is not valid JSON, return an empty array string
+            results[message_id] = _validate_triage(parsed.get(message_id), json.dumps(parsed.get(message_id)))
+        except ValueError as e:
+            ai_logger.warning(f"Batch triage entry for {message_id} is unusable: {e}")
+    return results
+
+class TriageBatchSizer:
+    """
+    Splits messages into batched triage calls. Each batch is filled greedily
+    up to the token budget and at most `limit` messages. The limit grows by one
+    after a batch that came back complete and is halved after one with missing
+    or malformed entries (usually a truncated answer), so it settles at what
+    the model reliably handles.
+    """
 
+    def __init__(self, token_budget=TRIAGE_BATCH_TOKEN_BUDGET, max_messages=TRIAGE_BATCH_MAX_MESSAGES):
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.limit = max(2, max_messages // 2)
+
+    def plan(self, messages):
+        overhead = estimate_tokens([{"content": TRIAGE_BATCH_INSTRUCTIONS}], 0)
+        batches, batch, used = [], [], overhead
+        for message in messages:
+            cost = estimate_tokens([{"content": _batch_triage_section(message)}], TRIAGE_BATCH_ANSWER_TOKENS)
+            if batch and (len(batch) >= self.limit or used + cost > self.token_budget):
+                batches.append(batch)
+                batch, used = [], overhead
+            batch.append(message)
+            used += cost
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def record(self, sent, valid):
+        if valid == sent:
+            self.limit = min(self.max_messages, self.limit + 1)
+        else:
+            self.limit = max(2, self.limit // 2)
+
+    def stats(self):
+        return {"limit": self.limit, "max_messages": self.max_messages, "token_budget": self.token_budget}
+
+triage_batch_sizer = TriageBatchSizer()
+
+def triage_batch(messages, strict=False):
+    """
+    Triage several messages with one completion. Returns {message_id: triage}
+    (same dicts as triage_message) for the entries that came back well formed;
+    callers retry the rest one by one. A failed call yields {} or, with
+    strict=True, raises.
+    """
+    try:
+        content = llm.complete(**_batch_triage_request(messages))
+        results = _parse_batch_triage(content, [m["message_id"] for m in messages])
     except Exception as e:
-        ai_logger.error(f"Error during AI model call for todos: {e}. Returning empty array string.", exc_info=True)
-        return "[]" 
+        triage_batch_sizer.record(len(messages), 0)
+        if strict:
+            raise
+        ai_logger.error(f"Batch triage of {len(messages)} messages failed: {e}", exc_info=True)
+        return {}
+    triage_batch_sizer.record(len(messages), len(results))
+    return results
+
+async def triage_batch_async(messages, strict=False):
+    try:
+        content = await llm.acomplete(**_batch_triage_request(messages))
+        results = _parse_batch_triage(content, [m["message_id"] for m in messages])
+    except Exception as e:
+        triage_batch_sizer.record(len(messages), 0)
+        if strict:
+            raise
+        ai_logger.error(f"Batch triage of {len(messages)} messages failed: {e}", exc_info=True)
+        return {}
+    triage_batch_sizer.record(len(messages), len(results))
+    return results
+
+# Thread-level analysis reads only a conversation's new content plus a rolling summary of the rest
+THREAD_SUMMARY_MAX_WORDS = getattr(settings, "THREAD_SUMMARY_MAX_WORDS", 120)
+
+def _thread_message_section(message):
+    sent_at = message.get("sent_at")
+    return f"""
+<message from="{message['sender']}" date="{sent_at.isoformat() if sent_at else ''}">
+Subject: {message['subject']}
+{message['body']}
+</message>
+"""
+
+def _thread_triage_request(summary, tracked_todos, messages):
+    tracked = "\n".join(f"- {title}" for title in tracked_todos) or "(none)"
+    prompt = f"""
+You are an assistant that triages an email conversation for the user.
+
+Summary of the conversation so far:
+{summary or "(none, these are its first messages)"}
+
+Tasks already tracked for this conversation:
+{tracked}
+
+New messages, oldest first. Text they quote from earlier messages has been removed.
+{"".join(_thread_message_section(m) for m in messages)}
+Respond with a single JSON object with exactly these keys:
+- "needs_reply": true or false, whether the latest message needs a reply from the user
+- "reply_confidence": a number between 0 and 1 for how sure you are about needs_reply
+- "todos": a JSON array of tasks from the new messages that are not already tracked, each with a "title" (string), "completed" (boolean, default to false) and "due" (the deadline or date mentioned for it as a short string, or null). Use [] if there are none.
+- "summary": an updated summary of the whole conversation in at most {THREAD_SUMMARY_MAX_WORDS} words: who is involved, what was decided, and what is still open or awaited.
+"""
+    return {
+        "messages": [
+            {"role": "system", "content": "You triage email conversations and return a JSON object."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.0,
+        "response_format": {"type": "json_object"},
+        "task": "thread_triage",
+    }
+
+def _parse_thread_triage(content):
+    raw_ai_output = content.strip()
+    ai_logger.debug(f"Raw AI output for thread triage: '{raw_ai_output}'")
+    parsed = json.loads(raw_ai_output)
+    result = _validate_triage(parsed, raw_ai_output)
+    summary = parsed.get("summary")
+    if not isinstance(summary, str) or not summary.strip():
+        raise ValueError(f"AI returned no thread summary: '{raw_ai_output}'")
+    # Keep the summary compact even if the model ignores the word limit
+    result["summary"] = " ".join(summary.split()[:2 * THREAD_SUMMARY_MAX_WORDS])
+    return result
+
+async def triage_thread_async(summary, tracked_todos, messages, strict=False):
+    """
+    needs_reply, reply_confidence, todos (new ones only) and an updated summary
+    for a conversation, from its previous summary and its new messages. None
+    on failure, or raises with strict=True.
+    """
+    try:
+        return _parse_thread_triage(await llm.acomplete(**_thread_triage_request(summary, tracked_todos, messages)))
+    except Exception as e:
+        if strict:
+            raise
+        ai_logger.error(f"Thread triage failed: {e}", exc_info=True)
+        return None
+
+def _thread_reply_request(summary, message):
+    prompt = f"""
+You are an assistant helping to draft a polite, concise reply email.
+
+Summary of the conversation so far:
+{summary}
+
+Latest email, from {message['sender']}:
+
+Subject: {message['subject']}
+Body: {message['body']}
+
+Write a polite, professional reply to the latest email, consistent with the conversation.
+If any important detail (e.g., availability, preferences, confirmation) is
+unknown or ambiguous, insert a placeholder (e.g., {{insert your availability}},
+OR provide alternative phrasings that the user can choose from). Keep the reply clear, helpful, and adaptable.
+"""
+    return {
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.7,
+        "task": "thread_reply",
+    }
+
+async def generate_thread_reply_async(summary, message, strict=False):
+    try:
+        return _parse_reply(await llm.acomplete(**_thread_reply_request(summary, message)))
+    except Exception as e:
+        if strict:
+            raise
+        ai_logger.error(f"Error generating thread reply: {e}", exc_info=True)
+        return "Error generating reply. Please try again."
+
+CONVERSATION_SYSTEM_PROMPT = (
+    "You are an expert assistant helping the user draft professional, polite, "
+    "and concise email replies based on their chat messages. "
+    "Always keep the tone courteous and clear. "
+    "If any important information is missing, provide placeholders or ask clarifying questions. "
+    "Adapt to the context of the conversation and maintain coherence."
+)
+
+def stream_reply_from_conversation(messages: list[dict]):
+    """
+    Yield the reply text piece by piece as Groq streams it. Closing the
+    generator (e.g. when the HTTP client goes away) closes the upstream
+    response so generation stops being read.
+    """
+    return llm.stream([{"role": "system", "content": CONVERSATION_SYSTEM_PROMPT}] + messages, temperature=0.7, priority=PRIORITY_INTERACTIVE, task="conversation")
+
+def stream_reply_from_conversation_async(messages: list[dict]):
+    return llm.astream([{"role": "system", "content": CONVERSATION_SYSTEM_PROMPT}] + messages, temperature=0.7, priority=PRIORITY_INTERACTIVE, task="conversation")
 
 def generate_reply_from_conversation(messages: list[dict]) -> str:
-    system_prompt = (
-        "You are an expert assistant helping the user draft professional, polite, "
-        "and concise email replies based on their chat messages. "
-        "Always keep the tone courteous and clear. "
-        "If any important information is missing, provide placeholders or ask clarifying questions. "
-        "Adapt to the context of the conversation and maintain coherence."
-    )
     try:
-        completion = client.chat.completions.create(
-            messages=[{"role": "system", "content": system_prompt}] + messages,
-            model="llama-3.3-70b-versatile",
-            temperature=0.7,
-        )
-        return completion.choices[0].message.content.strip()
+        return llm.complete([{"role": "system", "content": CONVERSATION_SYSTEM_PROMPT}] + messages, temperature=0.7, priority=PRIORITY_INTERACTIVE, task="conversation").strip()
+    except Exception as e:
+        ai_logger.error(f"Error generating reply: {e}", exc_info=True)
+        return "Error generating reply. Please try again."
+
+async def generate_reply_from_conversation_async(messages: list[dict]) -> str:
+    try:
+        content = await llm.acomplete([{"role": "system", "content": CONVERSATION_SYSTEM_PROMPT}] + messages, temperature=0.7, priority=PRIORITY_INTERACTIVE, task="conversation")
+        return content.strip()
     except Exception as e:
         ai_logger.error(f"Error generating reply: {e}", exc_info=True)
         return "Error generating reply. Please try again."
@@ -172,13 +558,15 @@ def fetchRecentEmails(count: int = 5) -> list[dict]:
     Fetch the most recent 'count' emails for the given user from the 'messages' table.
     """
     db = SessionLocal()
-    emails = (
-        db.query(Message.sender, Message.subject, Message.body)
-        #   .order_by(Message.date.desc())
-          .limit(count)
-          .all()
-    )
-    print("The emails are", emails)
+    try:
+        emails = (
+            db.query(Message.sender, Message.subject, Message.body)
+              .order_by(Message.sent_at.desc())
+              .limit(count)
+              .all()
+        )
+    finally:
+        db.close()
     result = [
         {
             "sender": email.sender,
@@ -191,15 +579,80 @@ def fetchRecentEmails(count: int = 5) -> list[dict]:
     return result
     
 
+# Cosine similarity below this is treated as "not related" for semantic retrieval
+SEMANTIC_MIN_SCORE = 0.05
+
+def fetchEmailsByIds(row_ids: list[int]) -> list[dict]:
+    """
+    Load emails by Message.id, keeping the order of row_ids.
+    """
+    if not row_ids:
+        return []
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(Message.id, Message.message_id, Message.sender, Message.subject, Message.body, Message.sent_at)
+              .filter(Message.id.in_(row_ids))
+              .all()
+        )
+    finally:
+        db.close()
+    by_id = {row.id: row for row in rows}
+    return [
+        {
+            "message_id": by_id[row_id].message_id,
+            "sender": by_id[row_id].sender,
+            "subject": by_id[row_id].subject,
+            "body": by_id[row_id].body,
+            "sent_at": by_id[row_id].sent_at,
+        }
+        for row_id in row_ids
+        if row_id in by_id
+    ]
+
+
+def semanticSearchEmails(question: str, count: int = 8) -> list[dict]:
+    """
+    Top 'count' emails by embedding similarity, for paraphrased questions that
+    share few exact words with the email.
+    """
+    vector_index.maybe_catch_up()
+    hits = vector_index.search([question], k=count)[0]
+    return fetchEmailsByIds([row_id for row_id, score in hits if score >= SEMANTIC_MIN_SCORE])
+
+
+@timed("retrieval")
+def retrieveRelevantEmails(question: str, count: int = 8) -> list[dict]:
+    """
+    Top 'count' emails for the question, fusing the full-text and semantic
+    rankings with reciprocal rank fusion, falling back to the most recent
+    emails when neither finds anything.
+    """
+    # Indexes rows that ingest wrote but failed to index, and fills a new or empty index
+    search_index.maybe_catch_up()
+    keyword_hits = search_index.search(question, k=count)
+    semantic_hits = semanticSearchEmails(question, count=count)
+
+    scores, emails = {}, {}
+    for ranking in (keyword_hits, semantic_hits):
+        for rank, email in enumerate(ranking):
+            scores[email["message_id"]] = scores.get(email["message_id"], 0.0) + 1.0 / (60 + rank)
+            emails.setdefault(email["message_id"], email)
+    fused = [emails[message_id] for message_id in sorted(scores, key=scores.get, reverse=True)[:count]]
+
+    ai_logger.debug(f"Retrieved {len(fused)} emails ({len(keyword_hits)} keyword, {len(semantic_hits)} semantic) for question: '{question}'")
+    return fused or fetchRecentEmails(count=count)
+
+
 def buildQAPrompt(emails: list[dict], question: str) -> str:
     email_texts = "\n\n".join(
         f"Subject: {email['subject']}\nFrom: {email['sender']}\nBody: {email['body']}"
         for email in emails
     )
     prompt = f"""
-You are an assistant that answers questions based on recent emails.
+You are an assistant that answers questions based on the user's emails.
 
-Here are the recent emails:
+Here are the emails most relevant to the question:
 
 {email_texts}
 
@@ -210,20 +663,35 @@ Answer the question based on the emails above. If you don’t know the answer, s
     return prompt.strip()
 
 
+def _qa_messages(prompt: str) -> list[dict]:
+    return [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def streamAnswerWithLLM(prompt: str):
+    return llm.stream(_qa_messages(prompt), temperature=0.0, priority=PRIORITY_INTERACTIVE, task="qa")
+
+
+def streamAnswerWithLLMAsync(prompt: str):
+    return llm.astream(_qa_messages(prompt), temperature=0.0, priority=PRIORITY_INTERACTIVE, task="qa")
+
+
 def answerQuestionWithLLM(prompt: str) -> str:
     try:
-        completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt},
-            ],
-            model="llama-3.3-70b-versatile",
-            temperature=0.0,  # deterministic answers
-        )
-        return completion.choices[0].message.content.strip()
+        return llm.complete(_qa_messages(prompt), temperature=0.0, priority=PRIORITY_INTERACTIVE, task="qa").strip()  # deterministic answers
     except Exception as e:
         ai_logger.error(f"Error answering question: {e}", exc_info=True)
         return "Sorry, I couldn't answer that."
 
 
-
+async def answerQuestionWithLLMAsync(prompt: str, strict=False) -> str:
+    try:
+        content = await llm.acomplete(_qa_messages(prompt), temperature=0.0, priority=PRIORITY_INTERACTIVE, task="qa")
+        return content.strip()
+    except Exception as e:
+        if strict:
+            raise
+        ai_logger.error(f"Error answering question: {e}", exc_info=True)
+        return "Sorry, I couldn't answer that."
@@ -0,0 +1,268 @@
+# app/services/analysis.py
+
+import asyncio
+import json
+import logging
+import re
+from collections import defaultdict
+from app.config import settings
+from app.backend.services.ai_stuff import (
+    flag_reply_needed_async,
+    generate_reply_async,
+    extract_todos_from_message_async,
+    triage_message_async,
+    triage_batch_async,
+    triage_batch_sizer,
+    triage_thread_async,
+    generate_thread_reply_async,
+    PROMPT_VERSION,
+)
+from app.backend.scripts.preprocess_msgs import save_ai_analysis, fetch_messages_to_analyze, load_thread_context, save_thread_analysis
+from app.backend.services.mime_body import paragraph_keys, drop_seen_paragraphs
+from app.backend.services.metrics import timed
+from app.backend.services.reply_prefilter import reply_prefilter
+
+analysis_logger = logging.getLogger(__name__)
+
+# Max number of Groq calls in flight at once for a single batch
+DEFAULT_CONCURRENCY = getattr(settings, "AI_ANALYSIS_CONCURRENCY", 8)
+
+# "triage" gets needs_reply + todos from one fused completion,
+# "batch" packs several messages into each fused completion (see TriageBatchSizer),
+# "thread" analyzes each conversation's new messages together against a rolling summary,
+# "split" keeps the original flag_reply_needed / extract_todos_from_message pair
+DEFAULT_MODE = getattr(settings, "AI_ANALYSIS_MODE", "triage")
+
+# Opt-in: mail the header rules mark as automated gets no todo extraction either,
+# so it costs no LLM call at all. Off by default, calendar invites, bills and
+# shipping notices often carry the very tasks the todo list is for.
+PREFILTER_SKIP_AUTOMATED_TODOS = getattr(settings, "REPLY_PREFILTER_SKIP_AUTOMATED_TODOS", False)
+
+
+def _message_to_dict(msg):
+    return {
+        "message_id": msg.message_id,
+        "sender": msg.sender,
+        "subject": msg.subject,
+        "body": msg.body,
+        "content_hash": msg.content_hash,
+        "label_ids": msg.label_ids,
+        "auto_headers": msg.auto_headers,
+        "thread_id": msg.thread_id,
+        "sent_at": msg.sent_at,
+    }
+
+
+async def _run_limited(semaphore, func, *args):
+    # The semaphore caps how many LLM calls of this batch are in flight at once.
+    # strict=True makes LLM failures raise so they are reported, not saved as defaults.
+    async with semaphore:
+        return await func(*args, strict=True)
+
+
+async def analyze_message(message_data, semaphore, mode=DEFAULT_MODE, verdict=None, batch=None):
+    """
+    Work out needs_reply and todos for one message (fused triage call, or the
+    reply-flag check and todo extraction side by side), then draft a reply only
+    if one is needed. verdict is the reply pre-filter's decision, if it made
+    one: then only the todos go to the LLM, or nothing for automated mail.
+    batch is the task of the batched triage call the message went into; if its
+    entry came back unusable the message is triaged on its own. Errors are
+    captured on the result instead of being raised so one bad message doesn't
+    sink the whole batch.
+    """
+    result = _empty_result(message_data["message_id"])
+    with timed("analyze_message"):
+        try:
+            triage = (await batch).get(message_data["message_id"]) if batch is not None else None
+            if verdict is not None:
+                needs_reply, reply_confidence = verdict["needs_reply"], verdict["reply_confidence"]
+                if verdict["source"] == "rules" and PREFILTER_SKIP_AUTOMATED_TODOS:
+                    todos = "[]"
+                else:
+                    todos = await _run_limited(semaphore, extract_todos_from_message_async, message_data)
+            elif triage is not None:
+                needs_reply, todos, reply_confidence = triage["needs_reply"], triage["todos"], triage["reply_confidence"]
+            elif mode in ("triage", "batch"):
+                triage = await _run_limited(semaphore, triage_message_async, message_data)
+                needs_reply, todos, reply_confidence = triage["needs_reply"], triage["todos"], triage["reply_confidence"]
+            else:
+                needs_reply, todos = await asyncio.gather(
+                    _run_limited(semaphore, flag_reply_needed_async, message_data),
+                    _run_limited(semaphore, extract_todos_from_message_async, message_data),
+                )
+                reply_confidence = None
+            reply_draft = await _run_limited(semaphore, generate_reply_async, message_data) if needs_reply else None
+
+            reply_source = verdict["source"] if verdict is not None else "llm"
+            result.update(needs_reply=needs_reply, reply_confidence=reply_confidence, reply_draft=reply_draft, todos=todos, reply_source=reply_source)
+
+            await asyncio.to_thread(
+                save_ai_analysis,
+                message_id=message_data["message_id"],
+                needs_reply=needs_reply,
+                reply_draft=reply_draft,
+                todos=todos,
+                reply_confidence=reply_confidence,
+                content_hash=message_data["content_hash"],
+                prompt_version=PROMPT_VERSION,
+                reply_source=reply_source,
+            )
+        except Exception as e:
+            analysis_logger.error(f"Analysis failed for message {message_data['message_id']}: {e}", exc_info=True)
+            result["error"] = str(e)
+    return result
+
+
+def _empty_result(message_id):
+    return {
+        "message_id": message_id,
+        "needs_reply": None,
+        "reply_confidence": None,
+        "reply_draft": None,
+        "todos": "[]",
+        "reply_source": None,
+        "error": None,
+    }
+
+
+def _todo_key(title):
+    return re.sub(r"\W+", " ", (title or "").lower()).strip()
+
+
+def _drop_tracked_todos(todos, tracked_titles):
+    """todos (JSON string) without the tasks a thread already tracks, or that repeat within the list."""
+    seen = {_todo_key(title) for title in tracked_titles}
+    kept = []
+    for item in json.loads(todos):
+        key = _todo_key(item.get("title"))
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(item)
+    return json.dumps(kept)
+
+
+async def analyze_thread(thread_id, messages, semaphore):
+    """
+    Analyze the new messages of one conversation with a single triage call:
+    the thread's rolling summary plus only their new text, with paragraphs
+    already seen earlier in the thread (quoted history) removed. Needs-reply,
+    draft and new todos go on the latest message; the others are marked as
+    covered by it. Returns {message_id: result} for messages.
+    """
+    messages = sorted(messages, key=lambda m: (m["sent_at"], m["message_id"]))
+    latest = messages[-1]
+    results = {m["message_id"]: _empty_result(m["message_id"]) for m in messages}
+    with timed("analyze_thread"):
+        try:
+            context = await asyncio.to_thread(
+                load_thread_context, thread_id, messages[0]["sent_at"], replaced_message_id=latest["message_id"]
+            )
+            summary = context["summary"]
+            if context["analyzed_through"] is not None and latest["sent_at"] <= context["analyzed_through"]:
+                # Nothing newer than what the summary covers (forced re-run, new prompts): start it over
+                summary = None
+
+            seen = set()
+            for body in context["earlier_bodies"]:
+                seen |= paragraph_keys(body)
+            new_messages = [{**m, "body": drop_seen_paragraphs(m["body"], seen)} for m in messages]
+
+            triage = await _run_limited(semaphore, triage_thread_async, summary, context["tracked_todos"], new_messages)
+            todos = _drop_tracked_todos(triage["todos"], context["tracked_todos"])
+            reply_draft = None
+            if triage["needs_reply"]:
+                reply_draft = await _run_limited(semaphore, generate_thread_reply_async, triage["summary"], new_messages[-1])
+
+            latest_result = {
+                "message_id": latest["message_id"],
+                "needs_reply": triage["needs_reply"],
+                "reply_confidence": triage["reply_confidence"],
+                "reply_draft": reply_draft,
+                "todos": todos,
+                "reply_source": "llm",
+            }
+            await asyncio.to_thread(
+                save_thread_analysis,
+                thread_id,
+                triage["summary"],
+                latest={**latest_result, "content_hash": latest["content_hash"]},
+                covered=[(m["message_id"], m["content_hash"]) for m in messages[:-1]],
+                prompt_version=PROMPT_VERSION,
+            )
+            results[latest["message_id"]].update(latest_result)
+            for m in messages[:-1]:
+                results[m["message_id"]].update(needs_reply=False, reply_source="thread")
+        except Exception as e:
+            analysis_logger.error(f"Thread analysis failed for thread {thread_id}: {e}", exc_info=True)
+            for result in results.values():
+                result["error"] = str(e)
+    return results
+
+
+async def _triage_batch(semaphore, messages):
+    try:
+        return await _run_limited(semaphore, triage_batch_async, messages)
+    except Exception as e:
+        analysis_logger.warning(f"Batch triage of {len(messages)} messages failed, triaging them one by one: {e}")
+        return {}
+
+
+async def analyze_messages(messages, concurrency=None, mode=None, on_result=None):
+    """
+    Analyze a batch of Message rows concurrently and return one result dict per
+    message, in the same order they were passed in. on_result, if given, is a
+    blocking callable run (in a thread) with each result as soon as it is ready.
+    """
+    semaphore = asyncio.Semaphore(concurrency or DEFAULT_CONCURRENCY)
+    try:
+        # Pick up needs_reply answers saved since the last batch (rate limited inside)
+        await asyncio.to_thread(reply_prefilter.refresh)
+    except Exception as e:
+        analysis_logger.warning(f"Reply pre-filter refresh failed: {e}", exc_info=True)
+    mode = mode or DEFAULT_MODE
+    message_dicts = [_message_to_dict(msg) for msg in messages]
+    verdicts = {m["message_id"]: reply_prefilter.classify(m) for m in message_dicts}
+
+    # Messages the pre-filter left to the LLM share batched triage calls; each
+    # message continues (reply draft, save) as soon as its own batch is back
+    batches = {}
+    if mode == "batch":
+        undecided = [m for m in message_dicts if verdicts[m["message_id"]] is None]
+        for group in triage_batch_sizer.plan(undecided):
+            if len(group) < 2:
+                continue
+            task = asyncio.ensure_future(_triage_batch(semaphore, group))
+            batches.update((m["message_id"], task) for m in group)
+
+    threads = {}
+    if mode == "thread":
+        by_thread = defaultdict(list)
+        for m in message_dicts:
+            if verdicts[m["message_id"]] is None:
+                by_thread[m["thread_id"]].append(m)
+        threads = {
+            thread_id: asyncio.ensure_future(analyze_thread(thread_id, group, semaphore))
+            for thread_id, group in by_thread.items()
+        }
+
+    async def run_one(message_data):
+        message_id = message_data["message_id"]
+        if verdicts[message_id] is None and message_data["thread_id"] in threads:
+            result = (await threads[message_data["thread_id"]])[message_id]
+        else:
+            result = await analyze_message(message_data, semaphore, mode, verdict=verdicts[message_id], batch=batches.get(message_id))
+        if on_result is not None:
+            await asyncio.to_thread(on_result, result)
+        return result
+
+    results = await asyncio.gather(*(run_one(m) for m in message_dicts))
+    failed = sum(1 for r in results if r["error"])
+    analysis_logger.info(f"Analyzed {len(results)} messages ({failed} failed) with concurrency {concurrency or DEFAULT_CONCURRENCY}")
+    return list(results)
+
+
+def fetch_pending_messages(limit=30, force=False, message_ids=None):
+    """Messages that are new or changed since they were last analyzed with the current prompts."""
+    return fetch_messages_to_analyze(PROMPT_VERSION, limit=limit, force=force, message_ids=message_ids)
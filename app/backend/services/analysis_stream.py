@@ -0,0 +1,56 @@
+# app/services/analysis_stream.py
+
+import logging
+import redis
+from app.config import settings
+from app.backend.celery_worker import REDIS_URL, ANALYSIS_STREAM_KEY
+from app.backend.services.metrics import ANALYSIS_STREAM_ENTRIES
+
+stream_logger = logging.getLogger(__name__)
+
+ANALYSIS_STREAM_ENABLED = getattr(settings, "ANALYSIS_STREAM_ENABLED", True)
+# Entries kept in the stream (approximately, trimming is done per macro node). When
+# consumers fall this far behind the oldest ids are dropped; those messages are still
+# pending and get picked up by the next /ai_analysis run or analysis job.
+ANALYSIS_STREAM_MAXLEN = getattr(settings, "ANALYSIS_STREAM_MAXLEN", 50_000)
+
+
+class AnalysisStreamPublisher:
+    """
+    Appends ids of newly written messages to the analysis Redis Stream so the
+    consumer group (tasks/analysis_stream.py) analyzes them as they arrive.
+    Like the response cache, Redis being down only turns publishing off; it
+    never fails an ingest.
+    """
+
+    def __init__(self, url=REDIS_URL, stream=ANALYSIS_STREAM_KEY, maxlen=ANALYSIS_STREAM_MAXLEN, enabled=ANALYSIS_STREAM_ENABLED):
+        self.url = url
+        self.stream = stream
+        self.maxlen = maxlen
+        self.enabled = enabled
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def publish(self, message_ids):
+        """Queue message_ids for analysis in one pipelined round trip. Returns how many were published."""
+        message_ids = list(message_ids)
+        if not self.enabled or not message_ids:
+            return 0
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for message_id in message_ids:
+                pipe.xadd(self.stream, {"message_id": message_id}, maxlen=self.maxlen, approximate=True)
+            pipe.execute()
+        except redis.RedisError as e:
+            stream_logger.warning(f"Could not publish {len(message_ids)} messages to the analysis stream: {e}")
+            return 0
+        ANALYSIS_STREAM_ENTRIES.labels("published").inc(len(message_ids))
+        return len(message_ids)
+
+
+analysis_stream = AnalysisStreamPublisher()
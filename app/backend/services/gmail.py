@@ -1,43 +1,348 @@
 from app.backend.db.session import SessionLocal
 from app.backend.models.email import Thread, Message
-from sqlalchemy.exc import IntegrityError
+from app.backend.services.mime_body import extract_body
+from app.backend.services.search_index import search_index
+from app.backend.services.vector_index import vector_index, message_text
+from app.backend.services.response_cache import response_cache
+from app.backend.services.analysis_stream import analysis_stream
+from app.backend.services.metrics import timed
+from app.config import settings
+from sqlalchemy import select, or_
+from googleapiclient.errors import HttpError
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from datetime import datetime
+import functools
+import hashlib
+import json
+import logging
+import time
 
-def store_email_data(thread_id, msg_detail):
+gmail_logger = logging.getLogger(__name__)
+
+# Gmail accepts at most 100 calls per batch HTTP request
+BATCH_SIZE = 100
+LIST_PAGE_SIZE = 500
+# Rows per INSERT ... VALUES statement, keeps us under bind-parameter limits
+INGEST_CHUNK_SIZE = 500
+BATCH_MAX_RETRIES = 3
+
+# Only the parts of a message we actually store
+METADATA_HEADERS = ["From", "To", "Subject", "List-Unsubscribe", "List-Id", "Precedence", "Auto-Submitted", "X-Autoreply"]
+MESSAGE_FIELDS = "id,threadId,snippet,internalDate,historyId,labelIds,payload/headers"
+FULL_MESSAGE_FIELDS = "id,threadId,snippet,internalDate,historyId,labelIds,payload"
+
+# "full" pulls the MIME tree so bodies can be extracted, "metadata" only headers + snippet
+FETCH_FORMAT = "full" if getattr(settings, "GMAIL_FETCH_BODIES", True) else "metadata"
+
+# Alternative Gmail API root, e.g. the local stand-in used by benchmarks/
+GMAIL_API_ENDPOINT = getattr(settings, "GMAIL_API_ENDPOINT", None)
+
+@functools.lru_cache(maxsize=1)
+def gmail_discovery_document():
+    """
+    The Gmail v1 discovery document bundled with googleapiclient, read once
+    per process. Batch requests go to its rootUrl rather than
+    client_options.api_endpoint, so GMAIL_API_ENDPOINT is applied here.
+    """
+    document = get_static_doc("gmail", "v1")
+    if GMAIL_API_ENDPOINT:
+        parsed = json.loads(document)
+        parsed["rootUrl"] = parsed["baseUrl"] = GMAIL_API_ENDPOINT
+        document = json.dumps(parsed)
+    return document
+
+
+def build_gmail_service(credentials=None, http=None):
+    """Gmail v1 client for credentials (or an already authorized http), without a discovery fetch."""
+    return build_from_document(gmail_discovery_document(), credentials=credentials, http=http)
+
+
+def message_content_hash(sender, subject, body):
+    # Used to tell whether a message changed since it was last analyzed
+    content = "\x1f".join(part or "" for part in (sender, subject, body))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def _dialect_insert(db):
+    # ON CONFLICT support lives in the dialect-specific insert() constructs
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def automation_markers(headers):
+    """Bulk/automated-mail signals from a message's headers, as stored in Message.auto_headers."""
+    lowered = {name.lower(): value.strip().lower() for name, value in headers.items()}
+    markers = [name for name in ("list-unsubscribe", "list-id", "x-autoreply") if name in lowered]
+    if lowered.get("precedence") in ("bulk", "list", "junk"):
+        markers.append(f"precedence:{lowered['precedence']}")
+    if lowered.get("auto-submitted", "no") != "no":
+        markers.append(f"auto-submitted:{lowered['auto-submitted']}")
+    return ",".join(markers)
+
+
+def parse_message_detail(msg_detail):
+    """Turn a Gmail users.messages.get dict into (thread row, message row) dicts."""
+    headers = {h["name"]: h["value"] for h in msg_detail["payload"]["headers"]}
+    subject = headers.get("Subject")
+    sender = headers.get("From")
+    recipient = headers.get("To")
+    sent_at = int(msg_detail.get("internalDate", "0")) / 1000
+    body = extract_body(msg_detail["payload"]) or msg_detail.get("snippet", "")
+
+    thread_row = {
+        "thread_id": msg_detail["threadId"],
+        "subject": subject,
+        "snippet": msg_detail.get("snippet", ""),
+        "history_id": msg_detail.get("historyId"),
+        "created_at": datetime.utcnow(),
+    }
+    message_row = {
+        "message_id": msg_detail["id"],
+        "thread_id": msg_detail["threadId"],
+        "sender": sender,
+        "recipient": recipient,
+        "subject": subject,
+        "body": body,
+        "sent_at": datetime.utcfromtimestamp(sent_at),
+        "content_hash": message_content_hash(sender, subject, body),
+        "label_ids": ",".join(msg_detail.get("labelIds", [])),
+        "auto_headers": automation_markers(headers),
+    }
+    return thread_row, message_row
+
+
+@timed("db_write_messages")
+def _upsert_messages(threads, messages, counts, chunk_size):
+    """The set-based upsert behind ingest_messages; fills counts and returns {message_id: Message.id} of written rows."""
     db = SessionLocal()
+    written_ids = {}
     try:
-        headers = {h["name"]: h["value"] for h in msg_detail["payload"]["headers"]}
-        subject = headers.get("Subject")
-        sender = headers.get("From")
-        recipient = headers.get("To")
-        sent_at = int(msg_detail.get("internalDate", "0")) / 1000
-
-        # Insert thread if not exists
-        thread = db.query(Thread).filter_by(thread_id=thread_id).first()
-        if not thread:
-            thread = Thread(
-                thread_id=thread_id,
-                subject=subject,
-                snippet=msg_detail.get("snippet", ""),
-                history_id=msg_detail.get("historyId")
-            )
-            db.add(thread)
-            db.commit()
-
-        # Insert message
-        message = Message(
-            message_id=msg_detail["id"],
-            thread_id=thread_id,
-            sender=sender,
-            recipient=recipient,
-            subject=subject,
-            body=msg_detail.get("snippet", ""),  # TODO: parse full body later
-            sent_at=datetime.utcfromtimestamp(sent_at)
-        )
-        db.add(message)
+        insert = _dialect_insert(db)
+        thread_rows = list(threads.values())
+        message_rows = list(messages.values())
+
+        for start in range(0, len(thread_rows), chunk_size):
+            stmt = insert(Thread).values(thread_rows[start:start + chunk_size])
+            db.execute(stmt.on_conflict_do_nothing(index_elements=["thread_id"]))
+
+        for start in range(0, len(message_rows), chunk_size):
+            chunk = message_rows[start:start + chunk_size]
+            chunk_ids = [row["message_id"] for row in chunk]
+            existing = set(db.scalars(select(Message.message_id).where(Message.message_id.in_(chunk_ids))))
+
+            stmt = insert(Message).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["message_id"],
+                set_={
+                    column: stmt.excluded[column]
+                    for column in ("sender", "recipient", "subject", "body", "content_hash", "label_ids", "auto_headers")
+                },
+                where=or_(
+                    Message.content_hash.is_distinct_from(stmt.excluded.content_hash),
+                    Message.label_ids.is_distinct_from(stmt.excluded.label_ids),
+                    Message.auto_headers.is_distinct_from(stmt.excluded.auto_headers),
+                ),
+            ).returning(Message.id, Message.message_id)
+            returned = {message_id: row_id for row_id, message_id in db.execute(stmt)}
+            written_ids.update(returned)
+            written = set(returned)
+
+            counts["inserted"] += len(written - existing)
+            counts["updated"] += len(written & existing)
+            counts["skipped"] += len(chunk) - len(written)
+
         db.commit()
-    except IntegrityError as e:
-        db.rollback()  # Skip duplicates
-        print(f"[IntegrityError] Failed to insert message {msg_detail['id']}: {e}")
+        gmail_logger.info(f"Ingested {len(message_rows)} messages: {counts}")
+    except Exception:
+        db.rollback()
+        raise
     finally:
         db.close()
+    return written_ids
+
+
+def ingest_messages(msg_details, chunk_size=INGEST_CHUNK_SIZE, publish=False):
+    """
+    Write a batch of Gmail message dicts in one transaction using set-based
+    INSERT ... ON CONFLICT. New threads are inserted, existing ones left alone.
+    New messages are inserted; existing messages are updated only if their
+    content or labels changed. With publish=True the written messages are
+    queued on the analysis stream. Returns {"inserted", "updated", "skipped"}.
+    """
+    threads, messages = {}, {}
+    for msg_detail in msg_details:
+        try:
+            thread_row, message_row = parse_message_detail(msg_detail)
+        except (KeyError, TypeError, ValueError) as e:
+            gmail_logger.warning(f"Skipping malformed message {msg_detail.get('id')}: {e}")
+            continue
+        threads.setdefault(thread_row["thread_id"], thread_row)
+        # Postgres refuses to touch the same row twice in one upsert
+        messages[message_row["message_id"]] = message_row
+
+    counts = {"inserted": 0, "updated": 0, "skipped": len(msg_details) - len(messages)}
+    if not messages:
+        return counts
+
+    written_ids = _upsert_messages(threads, messages, counts, chunk_size)
+
+    # Keep the Q&A keyword and semantic indexes current with what was just written
+    try:
+        with timed("index_update"):
+            search_index.add({**messages[message_id], "id": row_id} for message_id, row_id in written_ids.items())
+            vector_index.add(written_ids.values(), [message_text(messages[message_id]) for message_id in written_ids])
+    except Exception as e:
+        gmail_logger.error(f"Failed to update search indexes: {e}", exc_info=True)
+    if written_ids:
+        response_cache.bump()
+    if written_ids and publish:
+        # Analysis workers pick these up right away instead of on the next /ai_analysis call
+        analysis_stream.publish(written_ids)
+    return counts
+
+
+def store_email_data(thread_id, msg_detail):
+    # Single-message convenience wrapper kept for existing callers
+    return ingest_messages([{**msg_detail, "threadId": thread_id}])
+
+
+def iter_message_ref_pages(service, max_results=None, query=None, label_ids=None):
+    """
+    Page through users.messages.list via nextPageToken, yielding each page as
+    [{"id", "threadId"}, ...], newest first. max_results=None walks the whole mailbox.
+    """
+    listed = 0
+    page_token = None
+    while True:
+        page_size = LIST_PAGE_SIZE if max_results is None else min(LIST_PAGE_SIZE, max_results - listed)
+        kwargs = {"userId": "me", "maxResults": page_size, "fields": "messages(id,threadId),nextPageToken"}
+        if page_token:
+            kwargs["pageToken"] = page_token
+        if query:
+            kwargs["q"] = query
+        if label_ids:
+            kwargs["labelIds"] = label_ids
+
+        with timed("gmail_list"):
+            result = service.users().messages().list(**kwargs).execute()
+        page = result.get("messages", [])
+        listed += len(page)
+        if page:
+            yield page
+        page_token = result.get("nextPageToken")
+        if not page_token or (max_results is not None and listed >= max_results):
+            break
+
+
+def list_message_refs(service, max_results=None, query=None, label_ids=None):
+    """All refs iter_message_ref_pages yields, as one list."""
+    return [ref for page in iter_message_ref_pages(service, max_results, query, label_ids) for ref in page]
+
+
+@timed("gmail_fetch")
+def batch_get_messages(service, message_ids, batch_size=BATCH_SIZE, fmt=FETCH_FORMAT, fields=None):
+    """
+    Fetch many messages with batch HTTP requests (up to batch_size gets per
+    round trip), asking only for headers, snippet, internalDate, historyId and,
+    with fmt="full", the MIME tree needed for the body. Calls that fail inside
+    a batch (usually 429s) are retried with backoff. Returns (details,
+    missing): message dicts in the same order as message_ids, and the ids
+    that still failed after retries so the caller can fetch them later.
+    Messages Gmail answers 404 for were deleted meanwhile and are in neither.
+    """
+    fetched = {}
+    gone = set()
+    pending = list(message_ids)
+    if fields is None:
+        fields = MESSAGE_FIELDS if fmt == "metadata" else FULL_MESSAGE_FIELDS
+
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        failed = []
+
+        def callback(request_id, response, exception):
+            if isinstance(exception, HttpError) and exception.resp.status == 404:
+                gone.add(request_id)
+            elif exception is not None:
+                failed.append(request_id)
+                gmail_logger.debug(f"Batch get failed for message {request_id}: {exception}")
+            else:
+                fetched[request_id] = response
+
+        for start in range(0, len(pending), batch_size):
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in pending[start:start + batch_size]:
+                request = service.users().messages().get(
+                    userId="me",
+                    id=message_id,
+                    format=fmt,
+                    metadataHeaders=METADATA_HEADERS if fmt == "metadata" else None,
+                    fields=fields,
+                )
+                batch.add(request, request_id=message_id)
+            batch.execute()
+
+        pending = failed
+        if not failed:
+            break
+        if attempt < BATCH_MAX_RETRIES:
+            time.sleep(2 ** attempt)
+    else:
+        gmail_logger.warning(f"Giving up on {len(pending)} messages after {BATCH_MAX_RETRIES} retries")
+
+    return [fetched[message_id] for message_id in message_ids if message_id in fetched], pending
+
+
+class HistoryExpiredError(Exception):
+    """The stored historyId is too old for users.history.list; a full resync is needed."""
+
+
+@timed("gmail_history")
+def list_history_changes(service, start_history_id):
+    """
+    Collect everything that changed since start_history_id using
+    users.history.list. Returns a dict with:
+      added:   ids of messages added since then
+      deleted: ids of messages deleted since then
+      labels:  {message_id: [labelIds]} for messages whose labels changed
+      history_id: the new high-water mark to store for the next delta sync
+    Raises HistoryExpiredError when Gmail no longer has history that far back.
+    """
+    added, deleted, labels = [], set(), {}
+    new_history_id = start_history_id
+    page_token = None
+
+    while True:
+        kwargs = {
+            "userId": "me",
+            "startHistoryId": start_history_id,
+            "historyTypes": ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
+        }
+        if page_token:
+            kwargs["pageToken"] = page_token
+        try:
+            result = service.users().history().list(**kwargs).execute()
+        except HttpError as e:
+            if e.resp.status == 404:
+                raise HistoryExpiredError(start_history_id) from e
+            raise
+
+        for record in result.get("history", []):
+            for item in record.get("messagesAdded", []):
+                added.append(item["message"]["id"])
+            for item in record.get("messagesDeleted", []):
+                deleted.add(item["message"]["id"])
+            for item in record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+                labels[item["message"]["id"]] = item["message"].get("labelIds", [])
+
+        new_history_id = result.get("historyId", new_history_id)
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            break
+
+    # A message added and deleted inside the same window never needs fetching
+    added = [message_id for message_id in dict.fromkeys(added) if message_id not in deleted]
+    labels = {message_id: label_ids for message_id, label_ids in labels.items() if message_id not in deleted}
+    return {"added": added, "deleted": sorted(deleted), "labels": labels, "history_id": new_history_id}
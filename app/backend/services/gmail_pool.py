@@ -0,0 +1,133 @@
+# app/services/gmail_pool.py
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from app.config import settings
+from app.backend.services.gmail import build_gmail_service
+from app.backend.services.token_store import token_store
+
+pool_logger = logging.getLogger(__name__)
+
+# Mailboxes whose clients are kept around; the least recently used is dropped first
+GMAIL_POOL_MAX_MAILBOXES = getattr(settings, "GMAIL_POOL_MAX_MAILBOXES", 64)
+# Clients unused for this long are closed on the next lease
+GMAIL_POOL_IDLE_SECONDS = getattr(settings, "GMAIL_POOL_IDLE_SECONDS", 900)
+# Idle clients kept per mailbox, i.e. how many threads can use one mailbox at once without a build
+GMAIL_POOL_CLIENTS_PER_MAILBOX = getattr(settings, "GMAIL_POOL_CLIENTS_PER_MAILBOX", 4)
+# Access tokens expiring sooner than this are refreshed before a client is handed out
+GMAIL_TOKEN_REFRESH_MARGIN_SECONDS = getattr(settings, "GMAIL_TOKEN_REFRESH_MARGIN_SECONDS", 300)
+GMAIL_HTTP_TIMEOUT_SECONDS = getattr(settings, "GMAIL_HTTP_TIMEOUT_SECONDS", 60)
+
+
+class _PooledClient:
+    __slots__ = ("service", "http")
+
+    def __init__(self, credentials):
+        self.http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT_SECONDS))
+        self.service = build_gmail_service(http=self.http)
+
+    def close(self):
+        self.http.http.close()
+
+
+class _MailboxEntry:
+    __slots__ = ("credentials", "idle", "last_used")
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.idle = []
+        self.last_used = time.monotonic()
+
+
+class GmailServicePool:
+    """
+    Built Gmail services per mailbox, each on its own keep-alive httplib2
+    connection. httplib2 isn't thread-safe, so a client is leased to one
+    caller at a time and a second concurrent caller for the same mailbox
+    gets another client. Mailboxes are evicted LRU and after sitting idle.
+    """
+
+    def __init__(self, max_mailboxes=GMAIL_POOL_MAX_MAILBOXES, idle_seconds=GMAIL_POOL_IDLE_SECONDS,
+                 clients_per_mailbox=GMAIL_POOL_CLIENTS_PER_MAILBOX, refresh_margin_seconds=GMAIL_TOKEN_REFRESH_MARGIN_SECONDS):
+        self.max_mailboxes = max_mailboxes
+        self.idle_seconds = idle_seconds
+        self.clients_per_mailbox = clients_per_mailbox
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.reuses = 0
+
+    @contextmanager
+    def lease(self, mailbox):
+        """Gmail service for mailbox for the duration of the block; None if it never authorized."""
+        credentials = token_store.get_credentials(mailbox, min_ttl_seconds=self.refresh_margin_seconds)
+        if credentials is None:
+            yield None
+            return
+
+        with self._lock:
+            self._drop_idle(time.monotonic())
+            # Re-inserting moves the mailbox to the most recently used end
+            entry = self._entries.pop(mailbox, None) or _MailboxEntry(credentials)
+            entry.credentials = credentials
+            self._entries[mailbox] = entry
+            while len(self._entries) > self.max_mailboxes:
+                _, evicted = self._entries.popitem(last=False)
+                self._close_all(evicted)
+            client = entry.idle.pop() if entry.idle else None
+            if client is None:
+                self.builds += 1
+            else:
+                self.reuses += 1
+
+        if client is None:
+            client = _PooledClient(credentials)
+        # Picks up credentials the token store refreshed since this client was last used
+        client.http.credentials = credentials
+        try:
+            yield client.service
+        finally:
+            with self._lock:
+                entry.last_used = time.monotonic()
+                if self._entries.get(mailbox) is entry and len(entry.idle) < self.clients_per_mailbox:
+                    entry.idle.append(client)
+                    client = None
+            if client is not None:
+                client.close()
+
+    def _drop_idle(self, now):
+        for mailbox in [m for m, entry in self._entries.items() if now - entry.last_used > self.idle_seconds]:
+            self._close_all(self._entries.pop(mailbox))
+
+    def _close_all(self, entry):
+        for client in entry.idle:
+            try:
+                client.close()
+            except Exception as e:
+                pool_logger.warning(f"Failed to close Gmail client: {e}")
+        entry.idle.clear()
+
+    def discard(self, mailbox):
+        """Forget a mailbox's clients, e.g. after its tokens were revoked."""
+        with self._lock:
+            entry = self._entries.pop(mailbox, None)
+        if entry is not None:
+            self._close_all(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mailboxes": len(self._entries),
+                "idle_clients": sum(len(entry.idle) for entry in self._entries.values()),
+                "builds": self.builds,
+                "reuses": self.reuses,
+            }
+
+
+gmail_pool = GmailServicePool()
@@ -0,0 +1,228 @@
+# app/services/llm_client.py
+
+import asyncio
+import logging
+import random
+import time
+import httpx
+from groq import Groq, AsyncGroq, APIStatusError, APIConnectionError, APITimeoutError
+from app.config import settings
+from app.backend.services.llm_cache import make_cache_key
+from app.backend.services.llm_scheduler import RateLimitScheduler, PRIORITY_BULK, estimate_tokens
+from app.backend.services.metrics import record_llm_call, LLM_RETRIES, LLM_CACHE_HITS
+
+llm_logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+# None keeps the SDK default; set to an OpenAI-compatible stand-in for benchmarks
+LLM_BASE_URL = getattr(settings, "GROQ_BASE_URL", None)
+LLM_TIMEOUT_SECONDS = getattr(settings, "LLM_TIMEOUT_SECONDS", 60.0)
+LLM_MAX_RETRIES = getattr(settings, "LLM_MAX_RETRIES", 4)
+LLM_MAX_CONNECTIONS = getattr(settings, "LLM_MAX_CONNECTIONS", 32)
+LLM_BACKOFF_BASE_SECONDS = 0.5
+LLM_BACKOFF_MAX_SECONDS = 30.0
+
+
+def _is_retryable(error):
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+
+def _retry_delay(attempt, error):
+    # Honour the server's retry-after when it sends one, otherwise
+    # exponential backoff with full jitter so workers don't retry in lockstep
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def _is_rate_limit(error):
+    return isinstance(error, APIStatusError) and error.status_code == 429
+
+
+def _total_tokens(completion):
+    usage = getattr(completion, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def _stream_usage(chunk):
+    # Groq reports usage on the last chunk under x_groq
+    return getattr(getattr(chunk, "x_groq", None), "usage", None)
+
+
+def _pool_limits():
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS, keepalive_expiry=60.0)
+
+
+class LLMClient:
+    """
+    Shared entry point for every Groq call. complete()/stream() are the
+    blocking facade for Celery workers and scripts; acomplete()/astream() are
+    the non-blocking versions for FastAPI routes. Both sides keep a pooled
+    keep-alive HTTP client, apply per-call timeouts, retry 429/5xx with
+    jittered backoff, go through the completion cache and wait their turn in
+    the shared rate-limit scheduler (priority=PRIORITY_INTERACTIVE for
+    requests a user is waiting on).
+    """
+
+    def __init__(self, api_key, cache=None, scheduler=None, timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES):
+        self.api_key = api_key
+        self.cache = cache
+        self.scheduler = scheduler or RateLimitScheduler()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._sync_client = None
+        self._async_client = None
+
+    @property
+    def sync_client(self):
+        if self._sync_client is None:
+            self._sync_client = Groq(
+                api_key=self.api_key,
+                base_url=LLM_BASE_URL,
+                max_retries=0,  # retries are handled here so they share one policy
+                timeout=self.timeout,
+                http_client=httpx.Client(limits=_pool_limits(), timeout=self.timeout),
+            )
+        return self._sync_client
+
+    @property
+    def async_client(self):
+        # Created lazily so the connection pool binds to the running event loop
+        if self._async_client is None:
+            self._async_client = AsyncGroq(
+                api_key=self.api_key,
+                base_url=LLM_BASE_URL,
+                max_retries=0,
+                timeout=self.timeout,
+                http_client=httpx.AsyncClient(limits=_pool_limits(), timeout=self.timeout),
+            )
+        return self._async_client
+
+    def _cache_lookup(self, request, use_cache):
+        if use_cache is None:
+            use_cache = not request.get("temperature")
+        if self.cache is None or not use_cache:
+            if self.cache is not None:
+                self.cache.bypassed += 1
+            return None, None
+        key = make_cache_key(**request)
+        return key, self.cache.get(key)
+
+    def _cache_store(self, key, content):
+        if key is not None and content is not None:
+            self.cache.set(key, content)
+
+    def _backoff(self, attempt, error, task):
+        LLM_RETRIES.labels(task).inc()
+        delay = _retry_delay(attempt, error)
+        if _is_rate_limit(error):
+            # Everyone else would hit the same 429, so hold the whole scheduler
+            self.scheduler.pause(delay)
+        llm_logger.warning(f"LLM call failed ({error.__class__.__name__}), retry {attempt + 1} in {delay:.2f}s")
+        return delay
+
+    def complete(self, messages, temperature=0.0, model=DEFAULT_MODEL, timeout=None, use_cache=None, priority=PRIORITY_BULK, task="other", **kwargs):
+        """Blocking completion; returns the message content string. task labels the call in /metrics."""
+        request = {"model": model, "messages": messages, "temperature": temperature, **kwargs}
+        key, cached = self._cache_lookup(request, use_cache)
+        if cached is not None:
+            LLM_CACHE_HITS.labels(task).inc()
+            return cached
+
+        estimated = estimate_tokens(messages, kwargs.get("max_tokens"))
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            self.scheduler.acquire_sync(priority, estimated)
+            try:
+                completion = self.sync_client.chat.completions.create(**request, timeout=timeout or self.timeout)
+                self.scheduler.record_usage(estimated, _total_tokens(completion))
+                record_llm_call(task, started, "success", getattr(completion, "usage", None))
+                content = completion.choices[0].message.content
+                self._cache_store(key, content)
+                return content
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    record_llm_call(task, started, "error")
+                    raise
+                time.sleep(self._backoff(attempt, e, task))
+
+    async def acomplete(self, messages, temperature=0.0, model=DEFAULT_MODEL, timeout=None, use_cache=None, priority=PRIORITY_BULK, task="other", **kwargs):
+        """Non-blocking completion; returns the message content string. task labels the call in /metrics."""
+        request = {"model": model, "messages": messages, "temperature": temperature, **kwargs}
+        key, cached = self._cache_lookup(request, use_cache)
+        if cached is not None:
+            LLM_CACHE_HITS.labels(task).inc()
+            return cached
+
+        estimated = estimate_tokens(messages, kwargs.get("max_tokens"))
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            await self.scheduler.acquire(priority, estimated)
+            try:
+                completion = await self.async_client.chat.completions.create(**request, timeout=timeout or self.timeout)
+                await asyncio.to_thread(self.scheduler.record_usage, estimated, _total_tokens(completion))
+                record_llm_call(task, started, "success", getattr(completion, "usage", None))
+                content = completion.choices[0].message.content
+                self._cache_store(key, content)
+                return content
+            except Exception as e:
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    record_llm_call(task, started, "error")
+                    raise
+                await asyncio.sleep(await asyncio.to_thread(self._backoff, attempt, e, task))
+
+    def stream(self, messages, temperature=0.0, model=DEFAULT_MODEL, timeout=None, priority=PRIORITY_BULK, task="other", **kwargs):
+        """Blocking generator of content deltas; closing it closes the upstream response."""
+        started = time.perf_counter()
+        self.scheduler.acquire_sync(priority, estimate_tokens(messages, kwargs.get("max_tokens")))
+        stream = self.sync_client.chat.completions.create(
+            model=model, messages=messages, temperature=temperature, stream=True, timeout=timeout or self.timeout, **kwargs
+        )
+        outcome, usage = "error", None
+        try:
+            for chunk in stream:
+                usage = _stream_usage(chunk) or usage
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+            outcome = "success"
+        except GeneratorExit:
+            outcome = "cancelled"
+            raise
+        finally:
+            record_llm_call(task, started, outcome, usage)
+            stream.close()
+
+    async def astream(self, messages, temperature=0.0, model=DEFAULT_MODEL, timeout=None, priority=PRIORITY_BULK, task="other", **kwargs):
+        """Async generator of content deltas; aclose() cancels the upstream request."""
+        started = time.perf_counter()
+        await self.scheduler.acquire(priority, estimate_tokens(messages, kwargs.get("max_tokens")))
+        stream = await self.async_client.chat.completions.create(
+            model=model, messages=messages, temperature=temperature, stream=True, timeout=timeout or self.timeout, **kwargs
+        )
+        outcome, usage = "error", None
+        try:
+            async for chunk in stream:
+                usage = _stream_usage(chunk) or usage
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+            outcome = "success"
+        except GeneratorExit:
+            outcome = "cancelled"
+            raise
+        finally:
+            record_llm_call(task, started, outcome, usage)
+            await stream.close()
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
@@ -0,0 +1,253 @@
+# app/services/llm_scheduler.py
+
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+import redis
+from app.config import settings
+from app.backend.celery_worker import REDIS_URL
+
+scheduler_logger = logging.getLogger(__name__)
+
+# Groq limits for llama-3.3-70b-versatile on the account tier we run on
+GROQ_RPM = getattr(settings, "GROQ_RPM", 30)
+GROQ_TPM = getattr(settings, "GROQ_TPM", 12_000)
+# The quota is per account, not per process: keep the buckets in Redis so the API
+# processes and every Celery worker draw from the same one
+GROQ_RATE_LIMIT_SHARED = getattr(settings, "GROQ_RATE_LIMIT_SHARED", True)
+# Processes calling Groq when the buckets are local (shared off, or Redis unreachable);
+# each one then gets this share of GROQ_RPM / GROQ_TPM
+GROQ_RATE_LIMIT_PROCESSES = getattr(settings, "GROQ_RATE_LIMIT_PROCESSES", 1)
+
+# Lower value = served first
+PRIORITY_INTERACTIVE = 0  # /chat, /email-qa: a user is waiting on the answer
+PRIORITY_BULK = 1  # triage, todos, drafts for batch analysis
+
+# Completion size assumed when the caller doesn't set max_tokens
+DEFAULT_COMPLETION_TOKENS = 300
+# How often blocked callers re-check the buckets
+POLL_INTERVAL_SECONDS = 0.05
+# Set by interactive callers while they wait; longer than the longest sleep
+# between their re-checks, so bulk callers elsewhere keep deferring to them
+INTERACTIVE_LEASE_MS = 1500
+# After a Redis error the local buckets are used for this long before retrying Redis
+SHARED_RETRY_SECONDS = 5.0
+
+BUCKETS_KEY = "llm_rl:buckets"
+INTERACTIVE_KEY = "llm_rl:interactive"
+
+# Shared state is one hash: req/tok levels as of "at" (Redis TIME), plus paused_until
+_REFILL_LUA = """
+local rpm, tpm = tonumber(ARGV[1]), tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'req', 'tok', 'at', 'paused_until')
+local at = tonumber(state[3]) or now
+local req = math.min(rpm, (tonumber(state[1]) or rpm) + (now - at) * rpm / 60)
+local tok = math.min(tpm, (tonumber(state[2]) or tpm) + (now - at) * tpm / 60)
+local paused = tonumber(state[4]) or 0
+"""
+# ARGV: rpm, tpm, tokens, priority, poll seconds, interactive lease ms. Returns the wait in seconds, "0" when acquired.
+ACQUIRE_LUA = _REFILL_LUA + """
+if now < paused then return tostring(paused - now) end
+if tonumber(ARGV[4]) > 0 and redis.call('EXISTS', KEYS[2]) == 1 then return ARGV[5] end
+local tokens = math.min(tonumber(ARGV[3]), tpm)
+local wait = math.max((1 - req) * 60 / rpm, (tokens - tok) * 60 / tpm, 0)
+if wait > 0 then
+  if tonumber(ARGV[4]) == 0 then redis.call('SET', KEYS[2], '1', 'PX', ARGV[6]) end
+  return tostring(wait)
+end
+redis.call('HSET', KEYS[1], 'req', req - 1, 'tok', tok - tokens, 'at', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+return '0'
+"""
+# ARGV: rpm, tpm, tokens to take off (negative gives back)
+ADJUST_LUA = _REFILL_LUA + """
+redis.call('HSET', KEYS[1], 'req', req, 'tok', tok - tonumber(ARGV[3]), 'at', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+"""
+# ARGV: rpm, tpm, seconds
+PAUSE_LUA = _REFILL_LUA + """
+redis.call('HSET', KEYS[1], 'paused_until', math.max(paused, now + tonumber(ARGV[3])))
+redis.call('EXPIRE', KEYS[1], 3600)
+"""
+STATE_LUA = _REFILL_LUA + """
+return {tostring(req), tostring(tok), tostring(math.max(0, paused - now))}
+"""
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """Rough prompt + completion token count (~4 characters per token) used for TPM accounting."""
+    prompt_chars = sum(len(m.get("content") or "") for m in messages)
+    return prompt_chars // 4 + 4 * len(messages) + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class TokenBucket:
+    def __init__(self, capacity, per_seconds=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / per_seconds
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        # May go negative when correcting an underestimate; later callers just wait longer
+        self.level -= amount
+
+
+class RateLimitScheduler:
+    """
+    Gate in front of every Groq request. A request needs one slot from the
+    requests-per-minute bucket and its estimated tokens from the
+    tokens-per-minute bucket; bulk work never jumps ahead of waiting
+    interactive work, and a 429's retry-after pauses everyone.
+
+    With GROQ_RATE_LIMIT_SHARED the buckets, the pause and a short "an
+    interactive caller is waiting" lease live in Redis and are checked and
+    taken by one Lua script, so all API processes and Celery workers share
+    the account's quota. Otherwise, and while Redis is unreachable, each
+    process uses local buckets holding 1/GROQ_RATE_LIMIT_PROCESSES of it.
+    """
+
+    def __init__(self, rpm=GROQ_RPM, tpm=GROQ_TPM, shared=GROQ_RATE_LIMIT_SHARED, processes=GROQ_RATE_LIMIT_PROCESSES, url=REDIS_URL):
+        self._lock = threading.Lock()
+        self.rpm, self.tpm = rpm, tpm
+        self.requests = TokenBucket(rpm / processes)
+        self.tokens = TokenBucket(tpm / processes)
+        self.shared = shared
+        self.url = url
+        self._client = None
+        self._scripts = None
+        self._shared_down_until = 0.0
+        self._waiting = Counter()
+        self._paused_until = 0.0
+        self.throttled = 0
+        self.rate_limited = 0
+
+    @property
+    def scripts(self):
+        if self._scripts is None:
+            self._client = redis.Redis.from_url(self.url, socket_timeout=0.5, socket_connect_timeout=0.5)
+            self._scripts = {
+                name: self._client.register_script(source)
+                for name, source in (("acquire", ACQUIRE_LUA), ("adjust", ADJUST_LUA), ("pause", PAUSE_LUA), ("state", STATE_LUA))
+            }
+        return self._scripts
+
+    def _use_shared(self):
+        return self.shared and time.monotonic() >= self._shared_down_until
+
+    def _run_shared(self, name, *args):
+        """Run a bucket script; None (and local buckets for a while) if Redis is unreachable."""
+        try:
+            return self.scripts[name](keys=[BUCKETS_KEY, INTERACTIVE_KEY], args=[self.rpm, self.tpm, *args])
+        except redis.RedisError as e:
+            if time.monotonic() >= self._shared_down_until:
+                scheduler_logger.warning(f"Shared Groq rate limit unavailable, using local buckets for {SHARED_RETRY_SECONDS:.0f}s: {e}")
+            self._shared_down_until = time.monotonic() + SHARED_RETRY_SECONDS
+            return None
+
+    def _try_acquire(self, priority, tokens):
+        """Returns 0 when the request may go now, otherwise how long to wait before re-checking."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if any(count for p, count in self._waiting.items() if p < priority):
+                return POLL_INTERVAL_SECONDS
+            if not self._use_shared():
+                wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                if wait > 0:
+                    return wait
+                self.requests.consume(1)
+                self.tokens.consume(min(tokens, self.tokens.capacity))
+                return 0.0
+        wait = self._run_shared("acquire", tokens, priority, POLL_INTERVAL_SECONDS, INTERACTIVE_LEASE_MS)
+        if wait is None:
+            # Redis just failed: check again right away, against the local buckets
+            return self._try_acquire(priority, tokens)
+        return float(wait)
+
+    def _enter(self, priority):
+        with self._lock:
+            self._waiting[priority] += 1
+
+    def _leave(self, priority):
+        with self._lock:
+            self._waiting[priority] -= 1
+
+    async def _try_acquire_async(self, priority, tokens):
+        # A check against the shared buckets is a Redis round trip; keep it off the event loop
+        if self._use_shared():
+            return await asyncio.to_thread(self._try_acquire, priority, tokens)
+        return self._try_acquire(priority, tokens)
+
+    async def acquire(self, priority, tokens):
+        self._enter(priority)
+        try:
+            throttled = False
+            while (wait := await self._try_acquire_async(priority, tokens)) > 0:
+                throttled = True
+                await asyncio.sleep(min(wait, 1.0))
+            self.throttled += throttled
+        finally:
+            self._leave(priority)
+
+    def acquire_sync(self, priority, tokens):
+        self._enter(priority)
+        try:
+            throttled = False
+            while (wait := self._try_acquire(priority, tokens)) > 0:
+                throttled = True
+                time.sleep(min(wait, 1.0))
+            self.throttled += throttled
+        finally:
+            self._leave(priority)
+
+    def record_usage(self, estimated, actual):
+        """Correct the TPM bucket once the real token count is known."""
+        if actual is None:
+            return
+        if self._use_shared() and self._run_shared("adjust", actual - min(estimated, self.tpm)) is not None:
+            return
+        with self._lock:
+            self.tokens.consume(actual - min(estimated, self.tokens.capacity))
+
+    def pause(self, seconds):
+        """Hold every caller back, e.g. for a 429's retry-after."""
+        with self._lock:
+            self.rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        if self._use_shared():
+            self._run_shared("pause", seconds)
+
+    def stats(self):
+        shared = self._run_shared("state") if self._use_shared() else None
+        with self._lock:
+            now = time.monotonic()
+            self.requests._refill(now)
+            self.tokens._refill(now)
+            paused_for = max(0.0, self._paused_until - now)
+            requests_available, tokens_available = self.requests.level, self.tokens.level
+            if shared is not None:
+                requests_available, tokens_available = float(shared[0]), float(shared[1])
+                paused_for = max(paused_for, float(shared[2]))
+            return {
+                "shared": shared is not None,
+                "requests_available": round(requests_available, 2),
+                "tokens_available": round(tokens_available, 2),
+                "waiting": {("interactive" if p == PRIORITY_INTERACTIVE else "bulk"): n for p, n in self._waiting.items() if n},
+                "paused_for_seconds": round(paused_for, 2),
+                "throttled": self.throttled,
+                "rate_limited": self.rate_limited,
+            }
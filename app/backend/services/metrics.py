@@ -0,0 +1,200 @@
+# app/services/metrics.py
+
+import contextvars
+import logging
+import os
+import time
+import uuid
+import redis
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from app.config import settings
+from app.backend.celery_worker import REDIS_URL, ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP
+
+metrics_logger = logging.getLogger(__name__)
+
+# Echo/accept X-Request-ID and stamp it on log lines
+REQUEST_TRACE_IDS = getattr(settings, "REQUEST_TRACE_IDS", True)
+# Celery queues whose backlog is reported on /metrics
+CELERY_QUEUES = getattr(settings, "CELERY_METRIC_QUEUES", ["celery"])
+
+STAGE_SECONDS = Histogram(
+    "email_assistant_stage_seconds",
+    "Wall time per pipeline stage (Gmail fetch, DB writes, retrieval, ...)",
+    ["stage"],
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "email_assistant_llm_request_seconds",
+    "LLM call latency including scheduler wait and retries",
+    ["task", "outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+)
+LLM_TOKENS = Counter("email_assistant_llm_tokens_total", "Tokens reported by the LLM", ["task", "kind"])
+LLM_RETRIES = Counter("email_assistant_llm_retries_total", "LLM attempts retried after 429/5xx/timeouts", ["task"])
+LLM_CACHE_HITS = Counter("email_assistant_llm_cache_hits_total", "LLM calls answered from the completion cache", ["task"])
+REPLY_PREFILTER_DECISIONS = Counter(
+    "email_assistant_reply_prefilter_total",
+    "needs_reply decisions by source: rules, model_no, model_yes, or llm when the pre-filter was unsure",
+    ["decision"],
+)
+ANALYSIS_STREAM_ENTRIES = Counter(
+    "email_assistant_analysis_stream_entries_total",
+    "Analysis stream entries by outcome: published, acked, retried, dead_lettered",
+    ["outcome"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "email_assistant_http_request_seconds",
+    "HTTP request latency until the last body chunk is sent",
+    ["method", "route", "status"],
+)
+DB_QUERIES = Counter("email_assistant_db_queries_total", "SQL statements executed")
+DB_QUERIES_PER_REQUEST = Histogram(
+    "email_assistant_db_queries_per_request",
+    "SQL statements executed while serving one HTTP request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000),
+)
+
+trace_id_var = contextvars.ContextVar("trace_id", default=None)
+# Holds a one-item list so increments from worker threads (to_thread copies
+# the context, not the list) land on the request's counter
+_request_queries = contextvars.ContextVar("request_queries", default=None)
+
+
+def timed(stage):
+    """Histogram timer for a stage; works as a context manager or a decorator on sync functions."""
+    return STAGE_SECONDS.labels(stage).time()
+
+
+def record_llm_call(task, started, outcome, usage=None):
+    LLM_REQUEST_SECONDS.labels(task, outcome).observe(time.perf_counter() - started)
+    if usage is not None:
+        LLM_TOKENS.labels(task, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+        LLM_TOKENS.labels(task, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+
+def _count_query(*args):
+    DB_QUERIES.inc()
+    counter = _request_queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _count_query)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds %(trace_id)s to log records; '-' outside of a request."""
+
+    def filter(self, record):
+        record.trace_id = trace_id_var.get() or "-"
+        return True
+
+
+class CeleryQueueCollector:
+    """
+    Reports how many tasks wait in each Celery queue, and how far the analysis
+    stream's consumer group is behind, read from the Redis broker at scrape time.
+    """
+
+    def __init__(self, url=REDIS_URL, queues=CELERY_QUEUES, stream=ANALYSIS_STREAM_KEY, group=ANALYSIS_STREAM_GROUP):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.queues = queues
+        self.stream = stream
+        self.group = group
+
+    def describe(self):
+        # Lets REGISTRY.register() skip its trial collect() and the Redis call it would make at import
+        return []
+
+    def collect(self):
+        family = GaugeMetricFamily("email_assistant_celery_queue_depth", "Tasks waiting in a Celery queue", labels=["queue"])
+        try:
+            for queue in self.queues:
+                family.add_metric([queue], self.client.llen(queue))
+        except redis.RedisError as e:
+            metrics_logger.warning(f"Could not read Celery queue depth: {e}")
+            return
+        yield family
+
+        # lag: published but not yet read by any consumer; pending: read but not acked
+        backlog = GaugeMetricFamily("email_assistant_analysis_stream_backlog", "Analysis stream entries not yet acked", labels=["state"])
+        try:
+            groups = self.client.xinfo_groups(self.stream)
+        except redis.RedisError:
+            # No stream or group until the first publish / consumer start
+            return
+        for group in groups:
+            if group["name"].decode() == self.group:
+                backlog.add_metric(["lag"], group.get("lag") or 0)
+                backlog.add_metric(["pending"], group["pending"])
+                yield backlog
+
+
+REGISTRY.register(CeleryQueueCollector())
+
+
+def render_metrics():
+    """Prometheus text exposition; aggregates every process when PROMETHEUS_MULTIPROC_DIR is set."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(CeleryQueueCollector())
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def _route_label(scope):
+    """Route template the request matched (e.g. /gmail/todos/{todo_id}), so ids don't explode label cardinality."""
+    route = scope.get("route")
+    if route is None:
+        return "unmatched"
+    # Newer FastAPI keeps included routers nested instead of copying their routes with the prefix applied
+    included = (scope.get("fastapi") or {}).get("included_router")
+    prefix = getattr(getattr(included, "include_context", None), "prefix", "")
+    path = route.path
+    return path if path.startswith(prefix) else prefix + path
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing each request until its last body chunk (so
+    streamed responses are measured in full), counting the SQL statements it
+    ran, and tagging it with a trace id taken from or returned as X-Request-ID.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace_id = None
+        if REQUEST_TRACE_IDS:
+            headers = dict(scope.get("headers") or [])
+            trace_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex
+        trace_token = trace_id_var.set(trace_id)
+        queries = [0]
+        queries_token = _request_queries.set(queries)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if trace_id:
+                    message["headers"] = list(message.get("headers") or []) + [(b"x-request-id", trace_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            path = _route_label(scope)
+            HTTP_REQUEST_SECONDS.labels(scope["method"], path, str(status)).observe(time.perf_counter() - started)
+            DB_QUERIES_PER_REQUEST.labels(path).observe(queries[0])
+            _request_queries.reset(queries_token)
+            trace_id_var.reset(trace_token)
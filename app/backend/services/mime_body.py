@@ -0,0 +1,208 @@
+# app/services/mime_body.py
+
+import base64
+import codecs
+import hashlib
+import re
+from html.parser import HTMLParser
+from app.config import settings
+
+# Upper bound on the text kept per message body, in UTF-8 bytes
+MAX_BODY_BYTES = getattr(settings, "MAX_BODY_BYTES", 16 * 1024)
+
+# Base64 input is decoded in slices of this many characters (multiple of 4)
+DECODE_CHUNK_CHARS = 64 * 1024
+
+REPLY_HEADER_RE = re.compile(
+    r"^(On .+wrote:|-{2,}\s*Original Message\s*-{2,}|-{2,}\s*Forwarded message\s*-{2,}|_{10,})\s*$",
+    re.IGNORECASE,
+)
+PARAGRAPH_SPLIT_RE = re.compile(r"\n\s*\n")
+NON_WORD_RE = re.compile(r"\W+", re.UNICODE)
+# Shorter paragraphs ("Thanks!", "Hi Bob,") repeat by chance, so they are never treated as quotes
+MIN_QUOTE_CHARS = 40
+SIGNATURE_RE = re.compile(r"^(--|-- |Sent from my \w+.*|Get Outlook for \w+.*)$", re.IGNORECASE)
+
+
+def _headers(part):
+    return {h["name"].lower(): h["value"] for h in part.get("headers", [])}
+
+
+def _is_attachment(part):
+    if part.get("filename"):
+        return True
+    if part.get("body", {}).get("attachmentId"):
+        return True
+    return _headers(part).get("content-disposition", "").lower().startswith("attachment")
+
+
+def _charset(part):
+    match = re.search(r'charset="?([\w.-]+)"?', _headers(part).get("content-type", ""), re.IGNORECASE)
+    return match.group(1) if match else "utf-8"
+
+
+def iter_text_parts(payload):
+    """Walk the payload.parts tree depth-first, yielding inline text/* leaves that carry data."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get("parts"):
+            stack.extend(reversed(part["parts"]))
+            continue
+        if part.get("mimeType", "").startswith("text/") and not _is_attachment(part) and part.get("body", {}).get("data"):
+            yield part
+
+
+def iter_decoded(data, charset="utf-8"):
+    """Decode base64url data slice by slice, yielding str chunks."""
+    try:
+        decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    data = data.rstrip("=")
+    for start in range(0, len(data), DECODE_CHUNK_CHARS):
+        piece = data[start:start + DECODE_CHUNK_CHARS]
+        raw = base64.urlsafe_b64decode(piece + "=" * (-len(piece) % 4))
+        text = decoder.decode(raw)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+class _HTMLTextExtractor(HTMLParser):
+    BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "blockquote"}
+    SKIP_TAGS = {"script", "style", "head", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self._skip_depth = 0
+        self._quote_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "blockquote":
+            # Quoted history in HTML replies
+            self._quote_depth += 1
+        if tag in self.BLOCK_TAGS:
+            self.out.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag == "blockquote" and self._quote_depth:
+            self._quote_depth -= 1
+        if tag in self.BLOCK_TAGS:
+            self.out.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth and not self._quote_depth:
+            self.out.append(data)
+
+
+def iter_html_text(chunks):
+    """Convert streamed HTML into plain text in a single pass over the chunks."""
+    parser = _HTMLTextExtractor()
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.out:
+            yield "".join(parser.out)
+            parser.out.clear()
+    parser.close()
+    if parser.out:
+        yield "".join(parser.out)
+
+
+def iter_lines(chunks):
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        yield from lines
+    if buffer:
+        yield buffer
+
+
+def iter_stripped_lines(lines):
+    """Drop quoted (>) lines and stop at the first reply header or signature delimiter."""
+    blank_run = 0
+    for line in lines:
+        line = line.rstrip("\r").rstrip()
+        stripped = line.strip()
+        if REPLY_HEADER_RE.match(stripped) or SIGNATURE_RE.match(stripped):
+            return
+        if stripped.startswith(">"):
+            continue
+        if not stripped:
+            blank_run += 1
+            if blank_run > 1:
+                continue
+        else:
+            blank_run = 0
+        yield line
+
+
+def extract_body(payload, max_bytes=MAX_BODY_BYTES):
+    """
+    Return the readable body of a Gmail payload: text/plain if there is one,
+    otherwise text/html converted to text, with attachments, quoted reply
+    history and signatures removed. Decoding stops once max_bytes of text
+    have been collected, so huge parts are never fully materialized.
+    Returns None if the payload has no inline text.
+    """
+    parts = list(iter_text_parts(payload))
+    part = next((p for p in parts if p["mimeType"] == "text/plain"), None)
+    if part is None:
+        part = next((p for p in parts if p["mimeType"] == "text/html"), None)
+    if part is None:
+        return None
+
+    chunks = iter_decoded(part["body"]["data"], _charset(part))
+    if part["mimeType"] == "text/html":
+        chunks = iter_html_text(chunks)
+
+    kept, size = [], 0
+    for line in iter_stripped_lines(iter_lines(chunks)):
+        encoded = (line + "\n").encode("utf-8")
+        if size + len(encoded) > max_bytes:
+            kept.append(encoded[:max_bytes - size].decode("utf-8", errors="ignore"))
+            break
+        kept.append(line + "\n")
+        size += len(encoded)
+
+    body = "".join(kept).strip()
+    return body or None
+
+
+def _paragraph_key(paragraph):
+    # Case, punctuation and line wrapping differ between a text and its quoted copy
+    normalized = NON_WORD_RE.sub(" ", paragraph.lower()).strip()
+    if len(normalized) < MIN_QUOTE_CHARS:
+        return None
+    return hashlib.sha1(normalized.encode("utf-8")).digest()
+
+
+def paragraph_keys(text):
+    """Fingerprints of the substantial paragraphs of text, for drop_seen_paragraphs."""
+    return {key for key in map(_paragraph_key, PARAGRAPH_SPLIT_RE.split(text or "")) if key is not None}
+
+
+def drop_seen_paragraphs(text, seen):
+    """
+    text without the paragraphs whose fingerprint is in seen: quoted history
+    that got past iter_stripped_lines (Outlook headers, HTML blockquotes,
+    rewrapped quotes). The kept paragraphs are added to seen.
+    """
+    kept = []
+    for paragraph in PARAGRAPH_SPLIT_RE.split(text or ""):
+        key = _paragraph_key(paragraph)
+        if key is not None and key in seen:
+            continue
+        if key is not None:
+            seen.add(key)
+        kept.append(paragraph.strip())
+    return "\n\n".join(p for p in kept if p)
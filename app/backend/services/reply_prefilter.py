@@ -0,0 +1,242 @@
+# app/services/reply_prefilter.py
+
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from email.utils import parseaddr
+from pathlib import Path
+import numpy as np
+from sqlalchemy import or_
+from app.config import settings
+from app.backend.db.session import SessionLocal
+from app.backend.models.email import Message, AIMessageAnalysis
+from app.backend.services.metrics import REPLY_PREFILTER_DECISIONS
+from app.backend.services.vector_index import HashingEmbedder, message_text
+
+prefilter_logger = logging.getLogger(__name__)
+
+REPLY_PREFILTER_ENABLED = getattr(settings, "REPLY_PREFILTER_ENABLED", True)
+REPLY_PREFILTER_PATH = getattr(settings, "REPLY_PREFILTER_PATH", "reply_prefilter.npz")
+# The model only decides once the LLM has labelled this many messages of each kind
+REPLY_PREFILTER_MIN_EXAMPLES = getattr(settings, "REPLY_PREFILTER_MIN_EXAMPLES", 100)
+# Model probability of needing a reply below / above which the LLM is skipped
+REPLY_PREFILTER_NO_BELOW = getattr(settings, "REPLY_PREFILTER_NO_BELOW", 0.03)
+REPLY_PREFILTER_YES_ABOVE = getattr(settings, "REPLY_PREFILTER_YES_ABOVE", 0.97)
+# How often analyses labelled since the last update are pulled in and learned from
+REPLY_PREFILTER_REFRESH_SECONDS = getattr(settings, "REPLY_PREFILTER_REFRESH_SECONDS", 300)
+
+FEATURE_DIM = 2 ** 14
+# Only the start of a body carries the ask; long tails are quoted history and footers
+BODY_CHARS = 2000
+TRAIN_BATCH = 2000
+
+# Markers from Message.auto_headers that on their own mean nobody expects an answer.
+# List-Id is left to the model, mailing list threads between people often do need one.
+NO_REPLY_MARKERS = ("list-unsubscribe", "precedence:", "auto-submitted:", "x-autoreply")
+NO_REPLY_SENDER_RE = re.compile(
+    r"^(no-?reply|do-?not-?reply|mailer-daemon|postmaster|bounces?|notifications?|notify|alerts?|automated)([+._-]|$)"
+)
+AUTOMATED_LABELS = {"CATEGORY_PROMOTIONS", "CATEGORY_SOCIAL", "CATEGORY_UPDATES", "SPAM"}
+CALENDAR_SUBJECT_RE = re.compile(
+    r"^(updated )?(invitation|accepted|declined|tentatively accepted|cancell?ed event)( with note)?:", re.IGNORECASE
+)
+
+
+def header_rule(message):
+    """Why message is automated mail that needs no reply, or None if the headers don't say."""
+    for marker in filter(None, (message.get("auto_headers") or "").split(",")):
+        if marker.startswith(NO_REPLY_MARKERS):
+            return f"header:{marker}"
+    local_part = parseaddr(message.get("sender") or "")[1].partition("@")[0].lower()
+    if NO_REPLY_SENDER_RE.match(local_part):
+        return "sender"
+    labels = AUTOMATED_LABELS.intersection((message.get("label_ids") or "").split(","))
+    if labels:
+        return f"label:{min(labels)}"
+    if CALENDAR_SUBJECT_RE.match(message.get("subject") or ""):
+        return "calendar"
+    return None
+
+
+def _classifier_text(message):
+    # Markers and labels become tokens, so the model also learns what they imply
+    signals = [f"hdr_{m}" for m in (message.get("auto_headers") or "").split(",") if m]
+    signals += [f"label_{label}" for label in (message.get("label_ids") or "").split(",") if label]
+    message = {**message, "body": (message.get("body") or "")[:BODY_CHARS]}
+    return message_text(message) + "\n" + " ".join(signals)
+
+
+class ReplyClassifier:
+    """
+    Logistic regression over hashed word/character features, trained with
+    mini-batch SGD one batch of labelled messages at a time. Classes are
+    weighted by how often each has been seen, since most mail needs no reply.
+    """
+
+    def __init__(self, dim=FEATURE_DIM):
+        self.embedder = HashingEmbedder(dim)
+        self.weights = np.zeros(dim, dtype=np.float32)
+        self.bias = 0.0
+        self.seen = np.zeros(2, dtype=np.int64)  # [no reply, needs reply]
+
+    @property
+    def ready(self):
+        return int(self.seen.min()) >= REPLY_PREFILTER_MIN_EXAMPLES
+
+    def predict(self, messages):
+        """Probability that each message needs a reply."""
+        features = self.embedder.embed([_classifier_text(m) for m in messages])
+        return 1.0 / (1.0 + np.exp(-(features @ self.weights + self.bias)))
+
+    def partial_fit(self, messages, labels, epochs=5, learning_rate=4.0, l2=1e-6, batch_size=32):
+        labels = np.asarray(labels, dtype=np.float32)
+        features = self.embedder.embed([_classifier_text(m) for m in messages])
+        self.seen += np.bincount(labels.astype(np.int64), minlength=2)
+        class_weight = self.seen.sum() / (2.0 * np.maximum(self.seen, 1))
+        sample_weight = class_weight[labels.astype(np.int64)].astype(np.float32)
+
+        # Train on copies and swap at the end so concurrent predict() calls never see a half update
+        weights, bias = self.weights.copy(), self.bias
+        rng = np.random.default_rng(int(self.seen.sum()))
+        for _ in range(epochs):
+            order = rng.permutation(len(labels))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                x = features[batch]
+                predicted = 1.0 / (1.0 + np.exp(-(x @ weights + bias)))
+                gradient = sample_weight[batch] * (predicted - labels[batch])
+                weights -= learning_rate * (x.T @ gradient / len(batch) + l2 * weights)
+                bias -= learning_rate * float(gradient.mean())
+        self.weights, self.bias = weights, bias
+
+
+class ReplyPrefilter:
+    """
+    Cheap stage in front of the needs-reply LLM call. Header rules catch bulk
+    and automated mail outright; after that a local classifier, learned from
+    the LLM's own past needs_reply answers, settles the messages it is very
+    sure about. Anything else is left to the LLM. Only LLM-labelled analyses
+    are learned from, so the model never trains on its own guesses.
+    """
+
+    def __init__(self, path=REPLY_PREFILTER_PATH, enabled=REPLY_PREFILTER_ENABLED):
+        self.path = Path(path)
+        self.enabled = enabled
+        self.model = ReplyClassifier()
+        self.trained_until = None
+        self.decisions = {"rules": 0, "model_no": 0, "model_yes": 0, "llm": 0}
+        self._lock = threading.Lock()
+        self._next_refresh = 0.0
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            state = np.load(self.path)
+            if state["weights"].shape != self.model.weights.shape:
+                prefilter_logger.warning(f"Ignoring {self.path}: built for a different feature size")
+                return
+            self.model.weights = state["weights"]
+            self.model.bias = float(state["bias"])
+            self.model.seen = state["seen"]
+            self.trained_until = datetime.fromisoformat(str(state["trained_until"])) if str(state["trained_until"]) else None
+        except Exception as e:
+            prefilter_logger.warning(f"Could not load reply pre-filter model from {self.path}: {e}")
+
+    def _save(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp.npz")
+        np.savez(
+            tmp_path,
+            weights=self.model.weights,
+            bias=self.model.bias,
+            seen=self.model.seen,
+            trained_until=self.trained_until.isoformat() if self.trained_until else "",
+        )
+        os.replace(tmp_path, self.path)
+
+    def refresh(self, force=False):
+        """Learn from analyses the LLM labelled since the last refresh. Returns how many were learned."""
+        if not self.enabled or (not force and time.monotonic() < self._next_refresh):
+            return 0
+        learned = 0
+        with self._lock:
+            self._next_refresh = time.monotonic() + REPLY_PREFILTER_REFRESH_SECONDS
+            db = SessionLocal()
+            try:
+                while True:
+                    query = (
+                        db.query(
+                            Message.sender, Message.subject, Message.body, Message.label_ids, Message.auto_headers,
+                            AIMessageAnalysis.needs_reply, AIMessageAnalysis.processed_at,
+                        )
+                        .join(AIMessageAnalysis, AIMessageAnalysis.message_id == Message.message_id)
+                        .filter(
+                            AIMessageAnalysis.needs_reply.isnot(None),
+                            or_(AIMessageAnalysis.reply_source.is_(None), AIMessageAnalysis.reply_source == "llm"),
+                        )
+                    )
+                    if self.trained_until is not None:
+                        query = query.filter(AIMessageAnalysis.processed_at > self.trained_until)
+                    rows = query.order_by(AIMessageAnalysis.processed_at).limit(TRAIN_BATCH).all()
+                    if not rows:
+                        break
+                    messages = [
+                        {"sender": r.sender, "subject": r.subject, "body": r.body, "label_ids": r.label_ids, "auto_headers": r.auto_headers}
+                        for r in rows
+                    ]
+                    self.model.partial_fit(messages, [bool(r.needs_reply) for r in rows])
+                    self.trained_until = rows[-1].processed_at
+                    learned += len(rows)
+                    if len(rows) < TRAIN_BATCH:
+                        break
+            finally:
+                db.close()
+            if learned:
+                self._save()
+                prefilter_logger.info(f"Reply pre-filter learned from {learned} analyses ({self.model.seen.tolist()} no/yes seen)")
+        return learned
+
+    def _count(self, decision):
+        self.decisions[decision] += 1
+        REPLY_PREFILTER_DECISIONS.labels(decision).inc()
+
+    def classify(self, message):
+        """
+        {"needs_reply", "reply_confidence", "source", "reason"} when the
+        pre-filter is confident about message, or None to ask the LLM.
+        """
+        if not self.enabled:
+            return None
+        reason = header_rule(message)
+        if reason is not None:
+            self._count("rules")
+            return {"needs_reply": False, "reply_confidence": 1.0, "source": "rules", "reason": reason}
+        if self.model.ready:
+            probability = float(self.model.predict([message])[0])
+            if probability <= REPLY_PREFILTER_NO_BELOW:
+                self._count("model_no")
+                return {"needs_reply": False, "reply_confidence": round(1.0 - probability, 4), "source": "model", "reason": "classifier"}
+            if probability >= REPLY_PREFILTER_YES_ABOVE:
+                self._count("model_yes")
+                return {"needs_reply": True, "reply_confidence": round(probability, 4), "source": "model", "reason": "classifier"}
+        self._count("llm")
+        return None
+
+    def stats(self):
+        total = sum(self.decisions.values())
+        skipped = total - self.decisions["llm"]
+        return {
+            "enabled": self.enabled,
+            "model_ready": self.model.ready,
+            "examples_seen": {"no_reply": int(self.model.seen[0]), "needs_reply": int(self.model.seen[1])},
+            "trained_until": self.trained_until.isoformat() if self.trained_until else None,
+            "decisions": dict(self.decisions),
+            "skip_rate": round(skipped / total, 4) if total else 0.0,
+        }
+
+
+reply_prefilter = ReplyPrefilter()
@@ -0,0 +1,103 @@
+# app/services/response_cache.py
+
+import hashlib
+import json
+import logging
+import redis
+import redis.asyncio as aioredis
+from app.config import settings
+from app.backend.celery_worker import REDIS_URL
+
+cache_logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_TTL_SECONDS = getattr(settings, "RESPONSE_CACHE_TTL_SECONDS", 3600)
+RESPONSE_CACHE_ENABLED = getattr(settings, "RESPONSE_CACHE_ENABLED", True)
+
+# Only DEFAULT_MAILBOX is served until messages, analyses and todos are partitioned
+# per mailbox, so a single counter covers the data; entries are still keyed per mailbox.
+VERSION_KEY = "resp_cache:version"
+
+
+def _query_hash(namespace, params):
+    payload = json.dumps({"ns": namespace, **params}, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Serialized read-endpoint responses in Redis, one entry per mailbox and
+    query. Every write to the underlying data bumps a version counter; an
+    entry is only served while it was built at the current version, and the
+    ETag is derived from (version, query) so an If-None-Match check needs a
+    single Redis round trip and no DB or LLM work. Redis being down only
+    turns the cache off, it never fails the request or the write.
+    """
+
+    def __init__(self, url=REDIS_URL, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, enabled=RESPONSE_CACHE_ENABLED):
+        self.url = url
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._sync = None
+        self._async = None
+
+    @property
+    def sync_client(self):
+        if self._sync is None:
+            self._sync = redis.Redis.from_url(self.url)
+        return self._sync
+
+    @property
+    def async_client(self):
+        if self._async is None:
+            self._async = aioredis.Redis.from_url(self.url)
+        return self._async
+
+    def bump(self):
+        """Invalidate every cached response. Call after committing a write."""
+        if not self.enabled:
+            return
+        try:
+            self.sync_client.incr(VERSION_KEY)
+        except redis.RedisError as e:
+            cache_logger.warning(f"Could not bump response cache version: {e}")
+
+    async def lookup(self, mailbox, namespace, params):
+        """
+        Returns (etag, body, version). body is None on a miss; etag and version
+        are None when the cache is disabled or unreachable.
+        """
+        if not self.enabled:
+            return None, None, None
+        digest = _query_hash(namespace, params)
+        key = f"resp_cache:{mailbox}:{digest}"
+        try:
+            version, entry = await self.async_client.mget(VERSION_KEY, key)
+        except redis.RedisError as e:
+            cache_logger.warning(f"Response cache lookup failed: {e}")
+            return None, None, None
+        version = int(version or 0)
+        etag = f'"{version}-{digest[:16]}"'
+        body = None
+        if entry is not None:
+            stored_version, _, stored_body = entry.partition(b"\n")
+            if int(stored_version) == version:
+                body = stored_body
+        return etag, body, version
+
+    async def store(self, mailbox, namespace, params, version, body):
+        """Cache body as built at version; a concurrent bump makes it unreachable."""
+        if not self.enabled or version is None:
+            return
+        key = f"resp_cache:{mailbox}:{_query_hash(namespace, params)}"
+        try:
+            await self.async_client.set(key, str(version).encode("ascii") + b"\n" + body, ex=self.ttl_seconds)
+        except redis.RedisError as e:
+            cache_logger.warning(f"Response cache store failed: {e}")
+
+    async def aclose(self):
+        if self._async is not None:
+            await self._async.aclose()
+            self._async = None
+
+
+response_cache = ResponseCache()
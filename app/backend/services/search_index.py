@@ -0,0 +1,191 @@
+# app/services/search_index.py
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from sqlalchemy import func
+from app.config import settings
+from app.backend.db.session import SessionLocal
+from app.backend.models.email import Message
+
+search_logger = logging.getLogger(__name__)
+
+# Relative paths are taken from the project root rather than the CWD, so the API
+# and Celery workers started from other directories all write the same file
+PROJECT_ROOT = Path(__file__).resolve().parents[3]
+SEARCH_INDEX_PATH = str(PROJECT_ROOT / getattr(settings, "SEARCH_INDEX_PATH", "email_search.sqlite3"))
+# How often a query checks the index against the messages table
+CATCH_UP_INTERVAL_SECONDS = getattr(settings, "SEARCH_INDEX_CATCH_UP_SECONDS", 30)
+# Bumped when the index layout changes; an index built with an older layout is dropped and rebuilt
+INDEX_VERSION = 1
+
+# Words that only add noise to a BM25 query built from a natural-language question
+STOP_WORDS = {
+    "a", "an", "and", "any", "are", "about", "did", "do", "does", "for", "from", "have", "how",
+    "i", "in", "is", "it", "me", "my", "of", "on", "or", "show", "tell", "that", "the", "there",
+    "this", "to", "was", "what", "when", "where", "which", "who", "why", "with", "you", "all", "emails", "email",
+}
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def build_match_query(text):
+    """Turn free text into an FTS5 MATCH expression: quoted terms OR'ed together."""
+    terms = [t for t in TOKEN_RE.findall(text.lower()) if t not in STOP_WORDS and len(t) > 1]
+    return " OR ".join(f'"{t}"' for t in dict.fromkeys(terms))
+
+
+class EmailSearchIndex:
+    """
+    Local SQLite FTS5 index over sender, subject and body, ranked with BM25.
+    Kept in sync by ingest (add/remove) so Q&A can retrieve from the whole
+    mailbox instead of a fixed window of recent rows. FTS rows are keyed on
+    rowid = Message.id, so re-indexing or removing a message is a rowid
+    lookup rather than a scan of the whole table. Rows an ingest failed to
+    index, or that were ingested against another copy of the file, are
+    picked up by catch_up().
+    """
+
+    def __init__(self, path=SEARCH_INDEX_PATH, catch_up_interval=CATCH_UP_INTERVAL_SECONDS):
+        self._lock = threading.Lock()
+        self._catch_up_lock = threading.Lock()
+        self.catch_up_interval = catch_up_interval
+        self._caught_up_at = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+        if version < INDEX_VERSION:
+            # Older indexes used arbitrary rowids; catch_up() refills the empty index from the DB
+            self._conn.execute("DROP TABLE IF EXISTS email_fts")
+            self._conn.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+        self._conn.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS email_fts USING fts5(
+                message_id UNINDEXED,
+                sent_at UNINDEXED,
+                sender,
+                subject,
+                body,
+                tokenize = 'porter unicode61'
+            )
+            """
+        )
+        self._conn.commit()
+
+    def add(self, rows):
+        """Index (or re-index) message rows: dicts with id (Message.id), message_id, sender, subject, body, sent_at."""
+        rows = list(rows)
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM email_fts WHERE rowid = ?", [(r["id"],) for r in rows])
+            self._conn.executemany(
+                "INSERT INTO email_fts (rowid, message_id, sent_at, sender, subject, body) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        r["id"],
+                        r["message_id"],
+                        r["sent_at"].isoformat() if r.get("sent_at") else None,
+                        r.get("sender") or "",
+                        r.get("subject") or "",
+                        r.get("body") or "",
+                    )
+                    for r in rows
+                ],
+            )
+            self._conn.commit()
+
+    def remove(self, row_ids):
+        """Drop messages from the index by Message.id."""
+        with self._lock:
+            self._conn.executemany("DELETE FROM email_fts WHERE rowid = ?", [(row_id,) for row_id in row_ids])
+            self._conn.commit()
+
+    def count(self):
+        with self._lock:
+            (n,) = self._conn.execute("SELECT COUNT(*) FROM email_fts").fetchone()
+        return n
+
+    def search(self, text, k=10):
+        """Top-k messages for free text, best match first. Subject hits weigh more than body hits."""
+        match = build_match_query(text)
+        if not match:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT message_id, sent_at, sender, subject, body
+                FROM email_fts
+                WHERE email_fts MATCH ?
+                ORDER BY bm25(email_fts, 0.0, 0.0, 2.0, 3.0, 1.0)
+                LIMIT ?
+                """,
+                (match, k),
+            ).fetchall()
+        return [
+            {"message_id": r[0], "sent_at": r[1], "sender": r[2], "subject": r[3], "body": r[4]}
+            for r in rows
+        ]
+
+    def _add_from_db(self, db, condition, batch_size):
+        query = (
+            db.query(Message.id, Message.message_id, Message.sender, Message.subject, Message.body, Message.sent_at)
+            .filter(condition)
+            .order_by(Message.id)
+            .yield_per(batch_size)
+        )
+        batch, total = [], 0
+        for row in query:
+            batch.append(row._asdict())
+            if len(batch) >= batch_size:
+                self.add(batch)
+                total += len(batch)
+                batch = []
+        self.add(batch)
+        return total + len(batch)
+
+    def catch_up(self, batch_size=1000):
+        """
+        Bring the index in line with the messages table. Normally that is just
+        indexing rows above the highest indexed Message.id; when the index
+        holds a different number of rows below that mark (a failed update, a
+        delete that never reached it) the full id sets are compared and
+        repaired. Returns how many messages were indexed.
+        """
+        with self._lock:
+            high, indexed = self._conn.execute("SELECT COALESCE(MAX(rowid), 0), COUNT(*) FROM email_fts").fetchone()
+        db = SessionLocal()
+        try:
+            stored = db.query(func.count(Message.id)).filter(Message.id <= high).scalar()
+            total = self._add_from_db(db, Message.id > high, batch_size)
+            if stored != indexed:
+                with self._lock:
+                    in_index = {rowid for (rowid,) in self._conn.execute("SELECT rowid FROM email_fts WHERE rowid <= ?", (high,))}
+                in_db = {row_id for (row_id,) in db.query(Message.id).filter(Message.id <= high)}
+                self.remove(in_index - in_db)
+                gaps = sorted(in_db - in_index)
+                for start in range(0, len(gaps), batch_size):
+                    total += self._add_from_db(db, Message.id.in_(gaps[start:start + batch_size]), batch_size)
+        finally:
+            db.close()
+        if total:
+            search_logger.info(f"Search index caught up with {total} messages")
+        return total
+
+    def maybe_catch_up(self):
+        """catch_up() at most once per catch_up_interval, and never in two threads at once."""
+        if self._caught_up_at is not None and time.monotonic() - self._caught_up_at < self.catch_up_interval:
+            return 0
+        if not self._catch_up_lock.acquire(blocking=False):
+            return 0
+        try:
+            total = self.catch_up()
+            self._caught_up_at = time.monotonic()
+            return total
+        finally:
+            self._catch_up_lock.release()
+
+
+search_index = EmailSearchIndex()
@@ -0,0 +1,169 @@
+# app/services/token_store.py
+
+import base64
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+import requests
+from cryptography.fernet import Fernet, MultiFernet
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.oauth2.credentials import Credentials
+from app.config import settings
+from app.backend.db.session import SessionLocal
+from app.backend.models.email import MailboxCredentials
+
+token_logger = logging.getLogger(__name__)
+
+# Messages, threads, analyses and todos aren't partitioned per mailbox yet, so this is
+# the only mailbox that may be authorized, synced and served; a second one's mail
+# would show up in the first one's todos, drafts and Q&A answers
+DEFAULT_MAILBOX = "default_user"
+
+# Comma separated Fernet keys; the first encrypts, all of them decrypt (for rotation)
+TOKEN_ENCRYPTION_KEYS = getattr(settings, "TOKEN_ENCRYPTION_KEY", None)
+
+
+def _fernet():
+    if TOKEN_ENCRYPTION_KEYS:
+        return MultiFernet([Fernet(key.strip()) for key in TOKEN_ENCRYPTION_KEYS.split(",") if key.strip()])
+    # Dev fallback so a fresh checkout still works; set TOKEN_ENCRYPTION_KEY in production
+    token_logger.warning("TOKEN_ENCRYPTION_KEY is not set, deriving the token key from GOOGLE_CLIENT_SECRET")
+    digest = hashlib.sha256(f"token-store:{settings.GOOGLE_CLIENT_SECRET}".encode("utf-8")).digest()
+    return MultiFernet([Fernet(base64.urlsafe_b64encode(digest))])
+
+
+def _serialize(credentials):
+    return {
+        "access_token": credentials.token,
+        "refresh_token": credentials.refresh_token,
+        "token_uri": credentials.token_uri,
+        "client_id": credentials.client_id,
+        "client_secret": credentials.client_secret,
+        "scopes": list(credentials.scopes or []),
+        "expiry": credentials.expiry.isoformat() if credentials.expiry else None,
+    }
+
+
+def _deserialize(data):
+    return Credentials(
+        token=data["access_token"],
+        refresh_token=data["refresh_token"],
+        token_uri=data["token_uri"],
+        client_id=data["client_id"],
+        client_secret=data["client_secret"],
+        scopes=data["scopes"],
+        expiry=datetime.fromisoformat(data["expiry"]) if data.get("expiry") else None,
+    )
+
+
+def _fresh(credentials, min_ttl_seconds):
+    """valid, and still valid min_ttl_seconds from now."""
+    if not credentials.valid:
+        return False
+    return credentials.expiry is None or credentials.expiry - datetime.utcnow() > timedelta(seconds=min_ttl_seconds)
+
+
+class TokenStore:
+    """
+    OAuth credentials per mailbox, encrypted at rest in mailbox_credentials so
+    every API process and Celery worker sees the same tokens. Credentials are
+    cached in-process and only refreshed (and written back) once expired.
+    """
+
+    def __init__(self):
+        self._fernet = None
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._refresh_locks = {}
+        # Token refreshes reuse one keep-alive session to oauth2.googleapis.com
+        self._auth_request = GoogleAuthRequest(session=requests.Session())
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            self._fernet = _fernet()
+        return self._fernet
+
+    def save(self, mailbox, credentials, account_email=None):
+        """Store credentials for mailbox; account_email=None keeps the account already on record."""
+        encrypted = self.fernet.encrypt(json.dumps(_serialize(credentials)).encode("utf-8")).decode("ascii")
+        db = SessionLocal()
+        try:
+            row = db.get(MailboxCredentials, mailbox) or MailboxCredentials(mailbox=mailbox)
+            row.encrypted_token = encrypted
+            row.updated_at = datetime.utcnow()
+            if account_email is not None:
+                row.account_email = account_email
+            db.add(row)
+            db.commit()
+        finally:
+            db.close()
+        with self._lock:
+            self._cache[mailbox] = credentials
+
+    def _load(self, mailbox):
+        db = SessionLocal()
+        try:
+            row = db.get(MailboxCredentials, mailbox)
+            if row is None:
+                return None
+            return _deserialize(json.loads(self.fernet.decrypt(row.encrypted_token.encode("ascii"))))
+        finally:
+            db.close()
+
+    def get_credentials(self, mailbox, min_ttl_seconds=0):
+        """
+        Valid credentials for mailbox, or None if it never authorized. Tokens
+        expiring within min_ttl_seconds are refreshed now rather than mid-call.
+        """
+        with self._lock:
+            credentials = self._cache.get(mailbox)
+            refresh_lock = self._refresh_locks.setdefault(mailbox, threading.Lock())
+        if credentials is not None and _fresh(credentials, min_ttl_seconds):
+            return credentials
+
+        with refresh_lock:
+            # Another thread may have refreshed while we waited
+            with self._lock:
+                credentials = self._cache.get(mailbox)
+            if credentials is None or not _fresh(credentials, min_ttl_seconds):
+                credentials = self._load(mailbox)
+                if credentials is None:
+                    return None
+                if not _fresh(credentials, min_ttl_seconds) and credentials.refresh_token:
+                    credentials.refresh(self._auth_request)
+                    self.save(mailbox, credentials)
+                with self._lock:
+                    self._cache[mailbox] = credentials
+            return credentials
+
+    def account_email(self, mailbox):
+        """Google account mailbox was authorized with, or None (never authorized, or before this was recorded)."""
+        db = SessionLocal()
+        try:
+            row = db.get(MailboxCredentials, mailbox)
+            return row.account_email if row else None
+        finally:
+            db.close()
+
+    def delete(self, mailbox):
+        db = SessionLocal()
+        try:
+            db.query(MailboxCredentials).filter_by(mailbox=mailbox).delete()
+            db.commit()
+        finally:
+            db.close()
+        with self._lock:
+            self._cache.pop(mailbox, None)
+
+    def mailboxes(self):
+        db = SessionLocal()
+        try:
+            return [mailbox for (mailbox,) in db.query(MailboxCredentials.mailbox).order_by(MailboxCredentials.mailbox)]
+        finally:
+            db.close()
+
+
+token_store = TokenStore()
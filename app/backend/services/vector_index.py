@@ -0,0 +1,377 @@
+# app/services/vector_index.py
+
+import fcntl
+import json
+import logging
+import re
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+from sqlalchemy import func
+from app.config import settings
+from app.backend.db.session import SessionLocal
+from app.backend.models.email import Message
+
+vector_logger = logging.getLogger(__name__)
+
+# A relative directory is resolved against the project root, not the CWD, so every process shares it
+VECTOR_INDEX_DIR = str(Path(__file__).resolve().parents[3] / getattr(settings, "VECTOR_INDEX_DIR", "vector_index"))
+EMBEDDER_NAME = getattr(settings, "EMBEDDER", "hashing")
+# Above this many vectors a trained IVF index is used instead of a full scan
+IVF_MIN_VECTORS = getattr(settings, "VECTOR_IVF_MIN_VECTORS", 50_000)
+# Minimum time between two checks of the valid rows against the messages table
+CATCH_UP_INTERVAL_SECONDS = getattr(settings, "VECTOR_INDEX_CATCH_UP_SECONDS", 30)
+# On-disk layout of the index directory; older layouts are upgraded on open
+INDEX_LAYOUT = 2
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """
+    Dependency-free embedder: signed feature hashing of words, word bigrams and
+    character trigrams, sublinear term weights, L2 normalized. Trigrams let
+    "asked"/"asking" or "meeting"/"meetings" land near each other.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def _features(self, text):
+        words = TOKEN_RE.findall((text or "").lower())
+        for word in words:
+            yield word, 1.0
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                yield "#" + padded[i:i + 3], 0.25
+        for first, second in zip(words, words[1:]):
+            yield first + " " + second, 0.5
+
+    def embed(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = {}
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                index = h % self.dim
+                sign = 1.0 if (h >> 31) & 1 else -1.0
+                counts[index] = counts.get(index, 0.0) + sign * weight
+            if counts:
+                indices = np.fromiter(counts.keys(), dtype=np.int64)
+                values = np.fromiter(counts.values(), dtype=np.float32)
+                out[row, indices] = np.sign(values) * np.log1p(np.abs(values))
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerEmbedder:
+    """Small local model (e.g. all-MiniLM-L6-v2) loaded from the local cache only; needs sentence-transformers."""
+
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2"):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("EMBEDDER='minilm' requires the sentence-transformers package") from e
+        self.name = model_name
+        self._model = SentenceTransformer(model_name, device="cpu", local_files_only=True)
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        return self._model.encode(list(texts), batch_size=64, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def get_embedder(name=EMBEDDER_NAME):
+    if name == "hashing":
+        return HashingEmbedder()
+    if name == "minilm":
+        return SentenceTransformerEmbedder()
+    raise ValueError(f"Unknown embedder: {name}")
+
+
+def message_text(row):
+    return f"{row.get('subject') or ''}\n{row.get('sender') or ''}\n{row.get('body') or ''}"
+
+
+class VectorIndex:
+    """
+    Dense vectors in a memory-mapped float32 matrix where row i belongs to
+    Message.id == i, so adds and deletes are O(1) writes. Search is a batched
+    matrix product over the valid rows, or over a few IVF cells once the index
+    is large and has been trained with build_ivf().
+
+    The API and the Celery workers all ingest into the same directory. The
+    valid mask and IVF assignments are memory-mapped next to the vectors, so
+    each process writes only the rows it touches straight into the shared
+    files and sees the others' rows on its next call; growing the files and
+    training the IVF index are done under a file lock. Messages whose vectors
+    never got written are embedded later by catch_up().
+    """
+
+    def __init__(self, directory=VECTOR_INDEX_DIR, embedder=None, catch_up_interval=CATCH_UP_INTERVAL_SECONDS):
+        self.embedder = embedder or get_embedder()
+        self.catch_up_interval = catch_up_interval
+        self._catch_up_lock = threading.Lock()
+        self._caught_up_at = None
+        self.dim = self.embedder.dim
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._vectors_path = self.directory / "vectors.f32"
+        self._valid_path = self.directory / "valid.u8"
+        self._assignments_path = self.directory / "assignments.i32"
+        self._ivf_path = self.directory / "ivf.npz"
+        self._meta_path = self.directory / "meta.json"
+        self._lock_path = self.directory / ".lock"
+
+        with self._file_lock():
+            meta = json.loads(self._meta_path.read_text()) if self._meta_path.exists() else {}
+            if meta.get("embedder") != self.embedder.name or meta.get("dim") != self.dim:
+                # Vectors from a different embedder are meaningless here; start over
+                for path in (self._vectors_path, self._valid_path, self._assignments_path, self._ivf_path, self.directory / "valid.npy"):
+                    path.unlink(missing_ok=True)
+            elif meta.get("layout") != INDEX_LAYOUT:
+                self._upgrade_layout()
+            self._meta_path.write_text(json.dumps({"embedder": self.embedder.name, "dim": self.dim, "layout": INDEX_LAYOUT}))
+
+        self.capacity = 0
+        self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+        self.valid = np.zeros(0, dtype=bool)
+        self.centroids, self.assignments = None, None
+        self._ivf_mtime = None
+        self._refresh()
+
+    def _upgrade_layout(self):
+        # Layout 1 kept the valid mask in valid.npy and assignments inside ivf.npz,
+        # each process saving its own copy; keep the vectors, retrain IVF later
+        legacy_valid = self.directory / "valid.npy"
+        if legacy_valid.exists():
+            np.load(legacy_valid).astype(bool).tofile(self._valid_path)
+            legacy_valid.unlink()
+        self._ivf_path.unlink(missing_ok=True)
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self._lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Pick up growth and IVF training done by other processes sharing the directory."""
+        size = self._vectors_path.stat().st_size if self._vectors_path.exists() else 0
+        capacity = size // (self.dim * 4)
+        ivf_mtime = self._ivf_path.stat().st_mtime_ns if self._ivf_path.exists() else None
+        if capacity != self.capacity:
+            self.capacity = capacity
+            if capacity:
+                self.vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+                self.valid = np.memmap(self._valid_path, dtype=bool, mode="r+", shape=(capacity,))
+            self._ivf_mtime = None  # assignments need remapping at the new size
+        if ivf_mtime != self._ivf_mtime:
+            self.centroids, self.assignments = None, None
+            if ivf_mtime is not None and capacity:
+                self.centroids = np.load(self._ivf_path)["centroids"]
+                self.assignments = np.memmap(self._assignments_path, dtype=np.int32, mode="r+", shape=(capacity,))
+            self._ivf_mtime = ivf_mtime
+
+    def _ensure_capacity(self, max_id):
+        if max_id < self.capacity:
+            return
+        with self._file_lock():
+            self._refresh()
+            if max_id < self.capacity:
+                return
+            old_capacity = self.capacity
+            new_capacity = max(1024, self.capacity * 2, max_id + 1)
+            # The vectors file defines the capacity, so it is grown last
+            with open(self._valid_path, "ab") as f:
+                f.truncate(new_capacity)
+            if self._assignments_path.exists():
+                with open(self._assignments_path, "ab") as f:
+                    f.truncate(new_capacity * 4)
+                assignments = np.memmap(self._assignments_path, dtype=np.int32, mode="r+", shape=(new_capacity,))
+                assignments[old_capacity:] = -1
+                assignments.flush()
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(new_capacity * self.dim * 4)
+            self._refresh()
+
+    def _flush(self):
+        for array in (self.vectors, self.valid, self.assignments):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return int(np.count_nonzero(self.valid))
+
+    def add(self, ids, texts):
+        """Embed texts and store them at rows ids (Message.id values)."""
+        ids = np.asarray(list(ids), dtype=np.int64)
+        if len(ids) == 0:
+            return
+        embeddings = self.embedder.embed(list(texts))
+        with self._lock:
+            self._refresh()
+            self._ensure_capacity(int(ids.max()))
+            self.vectors[ids] = embeddings
+            if self.centroids is not None:
+                self.assignments[ids] = np.argmax(embeddings @ self.centroids.T, axis=1)
+            # Searches in every process use a row once it is valid, so that is written last
+            self.valid[ids] = True
+            self._flush()
+            if self.centroids is None and len(self) >= IVF_MIN_VECTORS:
+                # Large enough that a full scan stops being cheap
+                self.build_ivf()
+
+    def remove(self, ids):
+        with self._lock:
+            self._refresh()
+            ids = np.asarray([i for i in ids if i < self.capacity], dtype=np.int64)
+            if len(ids) == 0:
+                return
+            self.valid[ids] = False
+            self._flush()
+
+    def build_ivf(self, nlist=None, iterations=10, sample_size=50_000, seed=0):
+        """Train k-means centroids (nlist ~ sqrt(N)) and assign every stored vector to its cell."""
+        with self._lock, self._file_lock():
+            self._refresh()
+            rows = np.flatnonzero(self.valid)
+            if len(rows) == 0:
+                return
+            nlist = nlist or max(1, int(np.sqrt(len(rows))))
+            rng = np.random.default_rng(seed)
+            sample = self.vectors[rng.choice(rows, size=min(sample_size, len(rows)), replace=False)]
+            centroids = sample[rng.choice(len(sample), size=min(nlist, len(sample)), replace=False)].copy()
+
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                for c in range(len(centroids)):
+                    members = sample[labels == c]
+                    if len(members):
+                        centroid = members.mean(axis=0)
+                        centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+            assignments = np.memmap(self._assignments_path, dtype=np.int32, mode="w+", shape=(self.capacity,))
+            assignments[:] = -1
+            for start in range(0, len(rows), 65536):
+                chunk = rows[start:start + 65536]
+                assignments[chunk] = np.argmax(self.vectors[chunk] @ centroids.T, axis=1)
+            assignments.flush()
+            # Written after the assignments; other processes reload both when its mtime changes
+            np.savez(self._ivf_path, centroids=centroids)
+            self._refresh()
+            vector_logger.info(f"Built IVF index with {len(centroids)} cells over {len(rows)} vectors")
+
+    def search(self, queries, k=10, nprobe=8, use_ivf=None):
+        """
+        Batched top-k cosine search. queries is a list of strings; returns one
+        [(message_row_id, score), ...] list per query, best first.
+        """
+        query_vectors = self.embedder.embed(list(queries))
+        with self._lock:
+            self._refresh()
+            if use_ivf is None:
+                use_ivf = self.centroids is not None and len(self) >= IVF_MIN_VECTORS
+
+            results = []
+            if use_ivf and self.centroids is not None:
+                probes = np.argsort(-(query_vectors @ self.centroids.T), axis=1)[:, :nprobe]
+                for query_vector, probe in zip(query_vectors, probes):
+                    # -1: added by a process that hadn't seen the centroids yet, so always scanned
+                    candidates = np.flatnonzero((np.isin(self.assignments, probe) | (self.assignments == -1)) & self.valid)
+                    results.append(self._top_k(query_vector[None, :], candidates, k)[0])
+                return results
+
+            # Scan the whole contiguous matrix (no gather copy) and mask out empty rows
+            if not self.valid.any():
+                return [[] for _ in range(len(query_vectors))]
+            scores = query_vectors @ np.asarray(self.vectors).T
+            scores[:, ~self.valid] = -np.inf
+            return self._rank(scores, np.arange(self.capacity), min(k, len(self)))
+
+    def _top_k(self, query_vectors, candidates, k):
+        if len(candidates) == 0:
+            return [[] for _ in range(len(query_vectors))]
+        scores = query_vectors @ self.vectors[candidates].T
+        return self._rank(scores, candidates, min(k, len(candidates)))
+
+    def _rank(self, scores, candidates, k):
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row_scores, row_top in zip(scores, top):
+            order = row_top[np.argsort(-row_scores[row_top])]
+            results.append([(int(candidates[i]), float(row_scores[i])) for i in order])
+        return results
+
+    def _add_from_db(self, db, condition, batch_size):
+        query = (
+            db.query(Message.id, Message.sender, Message.subject, Message.body)
+            .filter(condition)
+            .order_by(Message.id)
+            .yield_per(batch_size)
+        )
+        batch, total = [], 0
+        for row in query:
+            batch.append(row._asdict())
+            if len(batch) >= batch_size:
+                self.add([r["id"] for r in batch], [message_text(r) for r in batch])
+                total += len(batch)
+                batch = []
+        if batch:
+            self.add([r["id"] for r in batch], [message_text(r) for r in batch])
+            total += len(batch)
+        return total
+
+    def catch_up(self, batch_size=1000):
+        """
+        Embed messages missing from the index. Rows past the last valid one
+        are always added; if the valid mask and the messages table disagree on
+        how many rows lie below it, the gaps are filled and rows of deleted
+        messages cleared. Returns how many messages were embedded.
+        """
+        with self._lock:
+            self._refresh()
+            valid_rows = np.flatnonzero(self.valid)
+        high = int(valid_rows[-1]) if len(valid_rows) else 0
+        db = SessionLocal()
+        try:
+            stored = db.query(func.count(Message.id)).filter(Message.id <= high).scalar()
+            total = self._add_from_db(db, Message.id > high, batch_size)
+            if stored != len(valid_rows):
+                in_index = set(valid_rows.tolist())
+                in_db = {row_id for (row_id,) in db.query(Message.id).filter(Message.id <= high)}
+                self.remove(in_index - in_db)
+                gaps = sorted(in_db - in_index)
+                for start in range(0, len(gaps), batch_size):
+                    total += self._add_from_db(db, Message.id.in_(gaps[start:start + batch_size]), batch_size)
+        finally:
+            db.close()
+        if total:
+            vector_logger.info(f"Vector index caught up with {total} messages")
+        return total
+
+    def maybe_catch_up(self):
+        """Rate-limited catch_up() for the query path; a thread finding one already running skips it."""
+        if self._caught_up_at is not None and time.monotonic() - self._caught_up_at < self.catch_up_interval:
+            return 0
+        if not self._catch_up_lock.acquire(blocking=False):
+            return 0
+        try:
+            total = self.catch_up()
+            self._caught_up_at = time.monotonic()
+            return total
+        finally:
+            self._catch_up_lock.release()
+
+
+vector_index = VectorIndex()
@@ -0,0 +1,166 @@
+# app/tasks/analysis_jobs.py
+
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from celery import chord
+from sqlalchemy import func
+from app.backend.celery_worker import celery_app
+from app.backend.db.session import SessionLocal
+from app.backend.models.email import Message, AnalysisJob, AnalysisJobItem
+from app.backend.services.analysis import analyze_messages, fetch_pending_messages
+from app.backend.services.ai_stuff import llm
+from app.config import settings
+
+job_logger = logging.getLogger(__name__)
+
+# Messages per Celery task inside a job's chord
+ANALYSIS_JOB_BATCH_SIZE = getattr(settings, "ANALYSIS_JOB_BATCH_SIZE", 10)
+
+
+def create_analysis_job(limit=30, force=False):
+    """Snapshot the messages to analyze into a new job and queue it. Returns the job id."""
+    message_ids = [msg.message_id for msg in fetch_pending_messages(limit=limit, force=force)]
+    job_id = uuid.uuid4().hex
+
+    db = SessionLocal()
+    try:
+        db.add(AnalysisJob(id=job_id, status="pending", total=len(message_ids)))
+        db.add_all(AnalysisJobItem(job_id=job_id, message_id=message_id) for message_id in message_ids)
+        db.commit()
+    finally:
+        db.close()
+
+    dispatch_analysis_job(job_id)
+    return job_id
+
+
+def dispatch_analysis_job(job_id):
+    """Queue every unfinished item of a job as a chord of batch tasks. Used for new jobs and resumes."""
+    db = SessionLocal()
+    try:
+        message_ids = [
+            message_id
+            for (message_id,) in db.query(AnalysisJobItem.message_id)
+            .filter(AnalysisJobItem.job_id == job_id, AnalysisJobItem.status != "done")
+            .order_by(AnalysisJobItem.id)
+        ]
+        db.query(AnalysisJob).filter_by(id=job_id).update({"status": "running", "updated_at": datetime.utcnow()})
+        db.commit()
+    finally:
+        db.close()
+
+    batches = [message_ids[i:i + ANALYSIS_JOB_BATCH_SIZE] for i in range(0, len(message_ids), ANALYSIS_JOB_BATCH_SIZE)]
+    if not batches:
+        finalize_analysis_job.delay([], job_id)
+        return
+    chord(analyze_batch.s(job_id, batch) for batch in batches)(finalize_analysis_job.s(job_id))
+
+
+def _record_result(job_id, result):
+    db = SessionLocal()
+    try:
+        db.query(AnalysisJobItem).filter_by(job_id=job_id, message_id=result["message_id"]).update({
+            "status": "error" if result["error"] else "done",
+            "error": result["error"],
+            "updated_at": datetime.utcnow(),
+        })
+        db.query(AnalysisJob).filter_by(id=job_id).update({"updated_at": datetime.utcnow()})
+        db.commit()
+    finally:
+        db.close()
+
+
+async def _analyze_and_close(messages, on_result):
+    try:
+        return await analyze_messages(messages, on_result=on_result)
+    finally:
+        # The async connection pool is tied to this task's event loop
+        await llm.aclose()
+
+
+@celery_app.task
+def analyze_batch(job_id, message_ids):
+    """
+    Analyze one slice of a job. Items already marked done are skipped, so a
+    batch redelivered after a worker crash only redoes unfinished messages.
+    """
+    db = SessionLocal()
+    try:
+        pending_ids = [
+            message_id
+            for (message_id,) in db.query(AnalysisJobItem.message_id).filter(
+                AnalysisJobItem.job_id == job_id,
+                AnalysisJobItem.message_id.in_(message_ids),
+                AnalysisJobItem.status != "done",
+            )
+        ]
+        db.query(AnalysisJobItem).filter(
+            AnalysisJobItem.job_id == job_id, AnalysisJobItem.message_id.in_(pending_ids)
+        ).update({"status": "running", "updated_at": datetime.utcnow()}, synchronize_session=False)
+        db.commit()
+        messages = db.query(Message).filter(Message.message_id.in_(pending_ids)).all() if pending_ids else []
+    finally:
+        db.close()
+
+    if not messages:
+        return {"analyzed": 0, "failed": 0}
+
+    results = asyncio.run(_analyze_and_close(messages, lambda result: _record_result(job_id, result)))
+    failed = sum(1 for r in results if r["error"])
+    job_logger.info(f"Job {job_id}: analyzed {len(results)} messages ({failed} failed)")
+    return {"analyzed": len(results), "failed": failed}
+
+
+@celery_app.task
+def finalize_analysis_job(batch_results, job_id):
+    db = SessionLocal()
+    try:
+        counts = _item_counts(db, job_id)
+        status = "completed_with_errors" if counts.get("error") else "completed"
+        db.query(AnalysisJob).filter_by(id=job_id).update({"status": status, "updated_at": datetime.utcnow()})
+        db.commit()
+        return status
+    finally:
+        db.close()
+
+
+def _item_counts(db, job_id):
+    return dict(
+        db.query(AnalysisJobItem.status, func.count(AnalysisJobItem.id))
+        .filter(AnalysisJobItem.job_id == job_id)
+        .group_by(AnalysisJobItem.status)
+        .all()
+    )
+
+
+def get_analysis_job_status(job_id):
+    """Progress, per-message status and errors for a job, or None if it doesn't exist."""
+    db = SessionLocal()
+    try:
+        job = db.get(AnalysisJob, job_id)
+        if not job:
+            return None
+        counts = _item_counts(db, job_id)
+        items = (
+            db.query(AnalysisJobItem.message_id, AnalysisJobItem.status, AnalysisJobItem.error)
+            .filter(AnalysisJobItem.job_id == job_id)
+            .order_by(AnalysisJobItem.id)
+            .all()
+        )
+        finished = counts.get("done", 0) + counts.get("error", 0)
+        return {
+            "job_id": job.id,
+            "status": job.status,
+            "total": job.total,
+            "done": counts.get("done", 0),
+            "failed": counts.get("error", 0),
+            "pending": counts.get("pending", 0) + counts.get("running", 0),
+            "progress": finished / job.total if job.total else 1.0,
+            "created_at": job.created_at,
+            "updated_at": job.updated_at,
+            "messages": [{"message_id": m, "status": st, "error": err} for m, st, err in items],
+        }
+    finally:
+        db.close()
@@ -0,0 +1,234 @@
+# app/tasks/analysis_stream.py
+#
+# Consumer side of the analysis stream that ingest_messages(publish=True) feeds.
+# Consumers run as beat-started Celery tasks, or as a long-running asyncio
+# process:
+#
+#   python -m app.backend.tasks.analysis_stream --consumers 2
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+import redis
+import redis.asyncio as aioredis
+from app.backend.celery_worker import celery_app, REDIS_URL, ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP, ANALYSIS_STREAM_TASK_SECONDS
+from app.backend.services.analysis import analyze_messages, fetch_pending_messages
+from app.backend.services.ai_stuff import llm
+from app.backend.services.metrics import ANALYSIS_STREAM_ENTRIES
+from app.config import settings
+
+stream_logger = logging.getLogger(__name__)
+
+# Consumers the beat entry keeps running; each analyzes one batch at a time
+ANALYSIS_STREAM_CONSUMERS = getattr(settings, "ANALYSIS_STREAM_CONSUMERS", 1)
+# Entries read per round; the next round is only read once this one is analyzed
+ANALYSIS_STREAM_BATCH_SIZE = getattr(settings, "ANALYSIS_STREAM_BATCH_SIZE", 16)
+ANALYSIS_STREAM_BLOCK_MS = getattr(settings, "ANALYSIS_STREAM_BLOCK_MS", 5000)
+# Entries read but not acked for this long (crashed consumer, failed analysis) are redelivered
+ANALYSIS_STREAM_CLAIM_IDLE_SECONDS = getattr(settings, "ANALYSIS_STREAM_CLAIM_IDLE_SECONDS", 300)
+# An entry delivered this many times goes to the dead-letter stream instead
+ANALYSIS_STREAM_MAX_DELIVERIES = getattr(settings, "ANALYSIS_STREAM_MAX_DELIVERIES", 5)
+# No new entries are read while the whole group has this many unacked, so a burst
+# of mail queues up in Redis rather than piling onto the shared Groq quota
+ANALYSIS_STREAM_MAX_PENDING = getattr(settings, "ANALYSIS_STREAM_MAX_PENDING", 64)
+ANALYSIS_STREAM_DEAD_LETTER_KEY = getattr(settings, "ANALYSIS_STREAM_DEAD_LETTER_KEY", f"{ANALYSIS_STREAM_KEY}:dead")
+DEAD_LETTER_MAXLEN = 10_000
+
+
+class AnalysisStreamConsumer:
+    """
+    One member of the analysis stream's consumer group. Each round it first
+    reclaims entries other consumers left unacked for too long, otherwise it
+    reads new ones, analyzes the messages that still need it and acks. A
+    failed analysis is left unacked so it is redelivered after the claim
+    timeout; after ANALYSIS_STREAM_MAX_DELIVERIES it is dead-lettered.
+    """
+
+    def __init__(self, name=None, url=REDIS_URL, batch_size=ANALYSIS_STREAM_BATCH_SIZE, block_ms=ANALYSIS_STREAM_BLOCK_MS,
+                 claim_idle_seconds=ANALYSIS_STREAM_CLAIM_IDLE_SECONDS, max_deliveries=ANALYSIS_STREAM_MAX_DELIVERIES,
+                 max_pending=ANALYSIS_STREAM_MAX_PENDING, concurrency=None):
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.client = aioredis.Redis.from_url(url)
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = int(claim_idle_seconds * 1000)
+        self.max_deliveries = max_deliveries
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+        self.counts = {"analyzed": 0, "failed": 0, "acked": 0, "retried": 0, "dead_lettered": 0}
+
+    async def ensure_group(self):
+        # Starting at 0 rather than $ keeps ids published before the first consumer ever ran
+        try:
+            await self.client.xgroup_create(ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _claim_stuck(self):
+        stuck = await self.client.xpending_range(
+            ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP, min="-", max="+", count=self.batch_size, idle=self.claim_idle_ms
+        )
+        dead = [p["message_id"] for p in stuck if p["times_delivered"] >= self.max_deliveries]
+        retry = [p["message_id"] for p in stuck if p["times_delivered"] < self.max_deliveries]
+        if dead:
+            await self._dead_letter(dead)
+        if not retry:
+            return []
+        # XCLAIM re-checks the idle time, so two consumers never both take an entry
+        entries = await self.client.xclaim(ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP, self.name, self.claim_idle_ms, retry)
+        self._count("retried", len(entries))
+        return entries
+
+    async def _dead_letter(self, entry_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            pipe.xrange(ANALYSIS_STREAM_KEY, entry_id, entry_id)
+        found = await pipe.execute()
+
+        pipe = self.client.pipeline(transaction=True)
+        for entry_id, entries in zip(entry_ids, found):
+            message_id = entries[0][1].get(b"message_id", b"") if entries else b""
+            pipe.xadd(ANALYSIS_STREAM_DEAD_LETTER_KEY, {"entry_id": entry_id, "message_id": message_id},
+                      maxlen=DEAD_LETTER_MAXLEN, approximate=True)
+        pipe.xack(ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP, *entry_ids)
+        await pipe.execute()
+        self._count("dead_lettered", len(entry_ids))
+        stream_logger.warning(f"Dead-lettered {len(entry_ids)} analysis stream entries after {self.max_deliveries} deliveries")
+
+    async def _has_capacity(self):
+        """Backpressure: hold off reading while Groq is rate limiting us or the group has enough in flight."""
+        # stats() reads the shared buckets from Redis, so it stays off the loop the other consumers share
+        paused = (await asyncio.to_thread(llm.scheduler.stats))["paused_for_seconds"]
+        if paused:
+            await asyncio.sleep(paused)
+        summary = await self.client.xpending(ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP)
+        return summary["pending"] < self.max_pending
+
+    async def _read_new(self):
+        response = await self.client.xreadgroup(
+            ANALYSIS_STREAM_GROUP, self.name, {ANALYSIS_STREAM_KEY: ">"}, count=self.batch_size, block=self.block_ms
+        )
+        return response[0][1] if response else []
+
+    async def _process(self, entries):
+        # One message can be published more than once (content and label updates)
+        by_message = defaultdict(list)
+        done = []
+        for entry_id, fields in entries:
+            message_id = (fields or {}).get(b"message_id")
+            if message_id is None:
+                done.append(entry_id)
+            else:
+                by_message[message_id.decode()].append(entry_id)
+
+        # Entries whose message is already analyzed with its current content and prompts are just acked
+        messages = []
+        if by_message:
+            messages = await asyncio.to_thread(fetch_pending_messages, limit=len(by_message), message_ids=list(by_message))
+        pending_ids = {msg.message_id for msg in messages}
+        for message_id, entry_ids in by_message.items():
+            if message_id not in pending_ids:
+                done.extend(entry_ids)
+
+        failed = 0
+        if messages:
+            for result in await analyze_messages(messages, concurrency=self.concurrency):
+                if result["error"]:
+                    failed += 1
+                else:
+                    done.extend(by_message[result["message_id"]])
+        if done:
+            await self.client.xack(ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP, *done)
+
+        self.counts["analyzed"] += len(messages) - failed
+        self.counts["failed"] += failed
+        self._count("acked", len(done))
+        return len(messages)
+
+    def _count(self, outcome, n):
+        if n:
+            self.counts[outcome] += n
+            ANALYSIS_STREAM_ENTRIES.labels(outcome).inc(n)
+
+    async def run_once(self):
+        """One round: reclaim or read a batch and analyze it. Returns how many messages were analyzed."""
+        entries = await self._claim_stuck()
+        if not entries:
+            if not await self._has_capacity():
+                await asyncio.sleep(self.block_ms / 1000)
+                return 0
+            entries = await self._read_new()
+        return await self._process(entries) if entries else 0
+
+    async def run(self, seconds=None):
+        """Consume until seconds have passed, or forever. Returns the consumer's counts."""
+        await self.ensure_group()
+        deadline = None if seconds is None else time.monotonic() + seconds
+        while deadline is None or time.monotonic() < deadline:
+            try:
+                await self.run_once()
+            except redis.RedisError as e:
+                stream_logger.warning(f"Analysis stream consumer {self.name}: {e}")
+                await asyncio.sleep(self.block_ms / 1000)
+        return dict(self.counts)
+
+    async def aclose(self):
+        # Drop the consumer from the group unless it still owns unacked entries,
+        # which DELCONSUMER would discard instead of leaving them to be reclaimed
+        try:
+            owned = await self.client.xpending_range(
+                ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP, min="-", max="+", count=1, consumername=self.name
+            )
+            if not owned:
+                await self.client.xgroup_delconsumer(ANALYSIS_STREAM_KEY, ANALYSIS_STREAM_GROUP, self.name)
+        except redis.RedisError as e:
+            stream_logger.warning(f"Could not remove analysis stream consumer {self.name}: {e}")
+        await self.client.aclose()
+
+
+async def run_consumers(count=1, seconds=None):
+    """Run count consumers in this event loop, sharing its LLM client and rate-limit scheduler."""
+    consumers = [AnalysisStreamConsumer() for _ in range(count)]
+    try:
+        return await asyncio.gather(*(consumer.run(seconds) for consumer in consumers))
+    finally:
+        for consumer in consumers:
+            await consumer.aclose()
+        # The async connection pool is tied to this event loop
+        await llm.aclose()
+
+
+@celery_app.task
+def start_analysis_stream_consumers():
+    """Beat entry point: start ANALYSIS_STREAM_CONSUMERS consumers for the next interval."""
+    for _ in range(ANALYSIS_STREAM_CONSUMERS):
+        # Drop the task if no worker got to it before the next round is started
+        consume_analysis_stream.apply_async(expires=ANALYSIS_STREAM_TASK_SECONDS)
+    return ANALYSIS_STREAM_CONSUMERS
+
+
+@celery_app.task
+def consume_analysis_stream(seconds=ANALYSIS_STREAM_TASK_SECONDS):
+    """Consume the analysis stream for seconds, then exit so the worker slot is freed for other tasks."""
+    counts = asyncio.run(run_consumers(1, seconds))[0]
+    stream_logger.info(f"Analysis stream consumer finished: {counts}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze messages from the analysis stream as they are ingested")
+    parser.add_argument("--consumers", type=int, default=ANALYSIS_STREAM_CONSUMERS)
+    parser.add_argument("--seconds", type=float, default=None, help="stop after this long (default: run forever)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(asyncio.run(run_consumers(args.consumers, args.seconds)))
+
+
+if __name__ == "__main__":
+    main()
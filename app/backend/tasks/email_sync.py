@@ -1,70 +1,175 @@
 # app/tasks/email_sync.py
 
-from celery_worker import celery_app
-from app.routes.gmail import user_tokens  # Replace with real DB token storage later
-from app.models.email import Thread, Message
-from app.db.session import SessionLocal
+import redis
+from redis.exceptions import LockError
+from app.backend.celery_worker import celery_app, REDIS_URL, GMAIL_SYNC_INTERVAL_SECONDS
+from app.backend.models.email import Message, AIMessageAnalysis, MailboxSyncState, Todo, AnalysisJob, AnalysisJobItem
+from app.backend.db.session import SessionLocal
 from datetime import datetime
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func
+from app.backend.services.gmail import (
+    ingest_messages,
+    iter_message_ref_pages,
+    batch_get_messages,
+    BATCH_SIZE,
+    list_history_changes,
+    HistoryExpiredError,
+)
+from app.backend.services.search_index import search_index
+from app.backend.services.vector_index import vector_index
+from app.backend.services.gmail_pool import gmail_pool
+from app.backend.services.token_store import token_store, DEFAULT_MAILBOX
+from app.backend.services.response_cache import response_cache
+from app.config import settings
+
+# None means page through the whole mailbox
+SYNC_MAX_MESSAGES = getattr(settings, "GMAIL_SYNC_MAX_MESSAGES", None)
+# A crashed worker's lock expires after this, so the mailbox isn't stuck forever
+SYNC_LOCK_TIMEOUT_SECONDS = getattr(settings, "GMAIL_SYNC_LOCK_TIMEOUT_SECONDS", 15 * 60)
+# Messages fetched and ingested per step; only this many full MIME payloads are held at once
+SYNC_CHUNK_SIZE = getattr(settings, "GMAIL_SYNC_CHUNK_SIZE", BATCH_SIZE)
+# A full sync only queues this many of the newest messages for analysis; the rest of
+# the mailbox's history is left to explicit /ai_analysis runs and jobs
+SYNC_PUBLISH_RECENT = getattr(settings, "GMAIL_SYNC_PUBLISH_RECENT", 100)
+
+redis_client = redis.Redis.from_url(REDIS_URL)
+
+def _fetch_and_ingest(service, message_ids, counts, publish=False):
+    """
+    Fetch and ingest message_ids SYNC_CHUNK_SIZE at a time, so a chunk's raw
+    payloads are dropped before the next one is fetched. Adds to counts and
+    returns the ids that couldn't be fetched.
+    """
+    missing = []
+    for start in range(0, len(message_ids), SYNC_CHUNK_SIZE):
+        details, chunk_missing = batch_get_messages(service, message_ids[start:start + SYNC_CHUNK_SIZE])
+        for key, n in ingest_messages(details, publish=publish).items():
+            counts[key] = counts.get(key, 0) + n
+        missing.extend(chunk_missing)
+        del details
+    return missing
+
+def _full_sync(service):
+    """Returns the new historyId and the ids that couldn't be fetched."""
+    # Read the mailbox historyId before listing so nothing that lands
+    # during the listing is missed by the next delta sync
+    history_id = service.users().getProfile(userId="me").execute().get("historyId")
+    counts, missing, listed = {}, [], 0
+    for page in iter_message_ref_pages(service, max_results=SYNC_MAX_MESSAGES):
+        # Pages come newest first, so the recent window is a prefix of the listing
+        ids = [ref["id"] for ref in page]
+        recent = max(0, SYNC_PUBLISH_RECENT - listed)
+        missing.extend(_fetch_and_ingest(service, ids[:recent], counts, publish=True))
+        missing.extend(_fetch_and_ingest(service, ids[recent:], counts))
+        listed += len(ids)
+    print(f"Full sync: {counts}, {len(missing)} left for the next sync")
+    return history_id, missing
+
+def _drop_job_items(db, message_ids):
+    # Job items reference messages too (an FK Postgres enforces); their jobs shrink with them
+    items = AnalysisJobItem.message_id.in_(message_ids)
+    for job_id, removed in db.query(AnalysisJobItem.job_id, func.count(AnalysisJobItem.id)).filter(items).group_by(AnalysisJobItem.job_id).all():
+        db.query(AnalysisJob).filter_by(id=job_id).update({"total": AnalysisJob.total - removed}, synchronize_session=False)
+    db.query(AnalysisJobItem).filter(items).delete(synchronize_session=False)
+
+def _delta_sync(service, db, start_history_id, retry_ids=()):
+    """
+    Apply what changed since start_history_id, also fetching retry_ids a
+    previous sync couldn't. Returns the new historyId and the ids that
+    still couldn't be fetched.
+    """
+    changes = list_history_changes(service, start_history_id)
+
+    to_fetch = [m for m in dict.fromkeys([*retry_ids, *changes["added"]]) if m not in changes["deleted"]]
+    missing = _fetch_and_ingest(service, to_fetch, {}, publish=True)
+
+    row_ids = []
+    if changes["deleted"]:
+        row_ids = [row_id for (row_id,) in db.query(Message.id).filter(Message.message_id.in_(changes["deleted"]))]
+        db.query(Todo).filter(Todo.message_id.in_(changes["deleted"])).delete(synchronize_session=False)
+        _drop_job_items(db, changes["deleted"])
+        db.query(AIMessageAnalysis).filter(AIMessageAnalysis.message_id.in_(changes["deleted"])).delete(synchronize_session=False)
+        db.query(Message).filter(Message.message_id.in_(changes["deleted"])).delete(synchronize_session=False)
+
+    for message_id, label_ids in changes["labels"].items():
+        db.query(Message).filter_by(message_id=message_id).update({"label_ids": ",".join(label_ids)}, synchronize_session=False)
+    db.commit()
+    # Only once the rows are really gone, so a failed commit leaves the indexes matching the DB
+    if row_ids:
+        search_index.remove(row_ids)
+        vector_index.remove(row_ids)
+    if changes["deleted"] or changes["labels"]:
+        response_cache.bump()
+
+    print(
+        f"Delta sync: {len(changes['added'])} added, {len(changes['deleted'])} deleted, {len(changes['labels'])} relabeled, "
+        f"{len(missing)} left for the next sync."
+    )
+    return changes["history_id"], missing
+
+@celery_app.task
+def sync_all_mailboxes():
+    """Beat entry point: fan out one sync task per authorized mailbox."""
+    mailboxes = [mailbox for mailbox in token_store.mailboxes() if mailbox == DEFAULT_MAILBOX]
+    for mailbox in mailboxes:
+        # Drop the task if it is still queued when the next round is scheduled
+        sync_emails.apply_async((mailbox,), expires=GMAIL_SYNC_INTERVAL_SECONDS)
+    return len(mailboxes)
 
 @celery_app.task
-def sync_emails():
-    creds_data = user_tokens.get("default_user")
-    if not creds_data:
-        print("No tokens available.")
+def sync_emails(mailbox=DEFAULT_MAILBOX, full=False):
+    if mailbox != DEFAULT_MAILBOX:
+        print(f"Mailbox {mailbox} can't be synced, only {DEFAULT_MAILBOX} is supported.")
         return
+    # One sync per mailbox at a time across every worker and node
+    lock = redis_client.lock(f"email_sync:{mailbox}", timeout=SYNC_LOCK_TIMEOUT_SECONDS)
+    if not lock.acquire(blocking=False):
+        print(f"Sync already running for {mailbox}, skipping.")
+        return
+    try:
+        _sync_mailbox(mailbox, full)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # Lock expired mid-sync and may already belong to another worker
+            pass
 
-    creds = Credentials(
-        token=creds_data["access_token"],
-        refresh_token=creds_data["refresh_token"],
-        token_uri=creds_data["token_uri"],
-        client_id=creds_data["client_id"],
-        client_secret=creds_data["client_secret"],
-        scopes=creds_data["scopes"],
-    )
+def _sync_mailbox(mailbox, full):
+    # Leased from the pool so back-to-back syncs reuse the client and its connection
+    with gmail_pool.lease(mailbox) as service:
+        if service is None:
+            print(f"No tokens available for {mailbox}.")
+            return
+        _sync_with_service(mailbox, service, full)
 
-    service = build("gmail", "v1", credentials=creds)
+def _sync_with_service(mailbox, service, full):
     db = SessionLocal()
 
     try:
-        result = service.users().messages().list(userId="me", maxResults=20).execute()
-        messages = result.get("messages", [])
-
-        for msg in messages:
-            msg_detail = service.users().messages().get(userId="me", id=msg["id"]).execute()
-            thread_id = msg["threadId"]
-
-            headers = {h["name"]: h["value"] for h in msg_detail["payload"]["headers"]}
-            subject = headers.get("Subject")
-            sender = headers.get("From")
-            recipient = headers.get("To")
-            sent_at = int(msg_detail.get("internalDate", "0")) / 1000
-
-            thread = db.query(Thread).filter_by(thread_id=thread_id).first()
-            if not thread:
-                thread = Thread(
-                    thread_id=thread_id,
-                    subject=subject,
-                    snippet=msg_detail.get("snippet", ""),
-                    history_id=msg_detail.get("historyId")
-                )
-                db.add(thread)
-                db.commit()
-
-            message = Message(
-                message_id=msg["id"],
-                thread_id=thread_id,
-                sender=sender,
-                recipient=recipient,
-                subject=subject,
-                body=msg_detail.get("snippet", ""),
-                sent_at=datetime.utcfromtimestamp(sent_at)
-            )
-            db.add(message)
+        state = db.get(MailboxSyncState, mailbox)
+        if not state:
+            state = MailboxSyncState(mailbox=mailbox)
+            db.add(state)
             db.commit()
 
+        history_id = None
+        retry_ids = state.retry_message_ids.split(",") if state.retry_message_ids else []
+        if state.history_id and not full:
+            try:
+                history_id, missing = _delta_sync(service, db, state.history_id, retry_ids)
+            except HistoryExpiredError:
+                print(f"historyId {state.history_id} expired for {mailbox}, falling back to full sync.")
+
+        if history_id is None:
+            history_id, missing = _full_sync(service)
+            state.last_full_sync_at = datetime.utcnow()
+
+        state.history_id = history_id
+        state.retry_message_ids = ",".join(missing) or None
+        state.updated_at = datetime.utcnow()
+        db.commit()
+
     except Exception as e:
         print("Sync error:", e)
         db.rollback()
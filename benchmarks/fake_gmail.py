@@ -0,0 +1,229 @@
+# benchmarks/fake_gmail.py
+#
+# Local stand-in for the parts of the Gmail v1 API the app uses: messages.list,
+# messages.get (also inside /batch requests), users.getProfile and
+# users.history.list. The mailbox is synthetic and generated on demand from
+# the message index, so 100k messages cost no memory.
+#
+#   python -m benchmarks.fake_gmail --port 8801 --messages 10000 --latency-ms 40 --error-rate 0.01
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import re
+import uvicorn
+from fastapi import FastAPI, Request, Response
+
+BASE_EPOCH_MS = 1_700_000_000_000
+BASE_HISTORY_ID = 1000
+
+FIRST_NAMES = ["Alice", "Bob", "Carol", "Dan", "Erin", "Frank", "Grace", "Heidi", "Ivan", "Judy", "Mallory", "Niaj", "Olivia", "Peggy", "Rupert", "Sybil", "Trent", "Victor", "Walter", "Yara"]
+DOMAINS = ["example.com", "acme.io", "university.edu", "vendor.co", "newsletter.net"]
+TOPICS = ["Q3 review", "project proposal", "budget approval", "team offsite", "invoice #{n}", "contract renewal", "hiring plan", "release {n}.0", "customer escalation", "weekly report"]
+SUBJECTS = ["Re: {topic}", "{topic} - next steps", "Question about {topic}", "FYI: {topic}", "Reminder: {topic}", "Update on {topic}"]
+ACTIONS = [
+    "Could you send me the updated numbers by Friday?",
+    "Please review the attached draft and share your comments.",
+    "Can we schedule a call next week to discuss this?",
+    "Let me know if you can make it on Tuesday at 3pm.",
+    "Please confirm the budget before the end of the month.",
+]
+AUTOMATED_SENDERS = ["no-reply@vendor.co", "newsletter@newsletter.net", "notifications@acme.io", "billing@vendor.co"]
+AUTOMATED_LABELS = ["CATEGORY_UPDATES", "CATEGORY_PROMOTIONS", None]
+FILLER = (
+    "thanks for the update on this we are still waiting on a few details from the other team and "
+    "will follow up once everything is finalized the numbers look reasonable so far but there are "
+    "some open questions about timing scope and the overall plan for the next quarter"
+).split()
+
+
+class SyntheticMailbox:
+    """Deterministic message i for any index; newer messages have larger indexes."""
+
+    def __init__(self, size, seed=0, automated_share=0.6):
+        self.size = size
+        self.seed = seed
+        # Share of newsletters/receipts/notifications, which carry bulk headers and labels
+        self.automated_share = automated_share
+
+    def message_id(self, index):
+        return f"{index + 1:016x}"
+
+    def index_of(self, message_id):
+        return int(message_id, 16) - 1
+
+    def history_id(self):
+        return BASE_HISTORY_ID + self.size
+
+    def ref(self, index):
+        return {"id": self.message_id(index), "threadId": f"{index // 3 + 1:016x}"}
+
+    def message(self, index, fmt="full"):
+        rng = random.Random(self.seed * 1_000_003 + index)
+        sender = f"{rng.choice(FIRST_NAMES)} <{rng.choice(FIRST_NAMES).lower()}@{rng.choice(DOMAINS)}>"
+        topic = rng.choice(TOPICS).format(n=rng.randint(1, 99))
+        subject = rng.choice(SUBJECTS).format(topic=topic)
+        words = [rng.choice(FILLER) for _ in range(rng.randint(40, 300))]
+        body = "Hi,\n\n" + " ".join(words).capitalize() + "."
+        if rng.random() < 0.4:
+            body += " " + rng.choice(ACTIONS)
+        body += "\n\nBest,\n" + sender.split()[0]
+
+        headers = [
+            {"name": "From", "value": sender},
+            {"name": "To", "value": "me@example.com"},
+            {"name": "Subject", "value": subject},
+        ]
+        labels = ["INBOX"] + (["UNREAD"] if rng.random() < 0.3 else [])
+        # Separate stream, so the rest of message i is the same whatever the share
+        automation = random.Random(f"automated:{self.seed}:{index}")
+        if automation.random() < self.automated_share:
+            sender = automation.choice(AUTOMATED_SENDERS)
+            headers[0]["value"] = sender
+            if automation.random() < 0.8:
+                headers.append({"name": "List-Unsubscribe", "value": f"<mailto:unsubscribe@{sender.split('@')[1]}>"})
+                headers.append({"name": "Precedence", "value": "bulk"})
+            category = automation.choice(AUTOMATED_LABELS)
+            labels += [category] if category else []
+
+        message = {
+            **self.ref(index),
+            "labelIds": labels,
+            "snippet": body[:120],
+            "historyId": str(BASE_HISTORY_ID + index + 1),
+            "internalDate": str(BASE_EPOCH_MS + index * 600_000),
+            "payload": {"mimeType": "multipart/alternative", "headers": headers},
+        }
+        if fmt != "metadata":
+            html = "<html><body><p>" + body.replace("\n\n", "</p><p>") + "</p></body></html>"
+            message["payload"]["parts"] = [
+                _text_part("text/plain", body),
+                _text_part("text/html", html),
+            ]
+        return message
+
+
+def _text_part(mime_type, text):
+    data = base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+    return {
+        "mimeType": mime_type,
+        "headers": [{"name": "Content-Type", "value": f"{mime_type}; charset=UTF-8"}],
+        "body": {"size": len(text), "data": data},
+    }
+
+
+def create_app(mailbox, latency_ms=0.0, error_rate=0.0):
+    app = FastAPI()
+    stats = {"requests": 0, "batch_parts": 0, "injected_errors": 0}
+
+    async def delay():
+        stats["requests"] += 1
+        if latency_ms:
+            await asyncio.sleep(latency_ms * random.uniform(0.5, 1.5) / 1000)
+
+    def get_message(message_id, fmt):
+        try:
+            index = mailbox.index_of(message_id)
+        except ValueError:
+            index = -1
+        if not 0 <= index < mailbox.size:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+        if error_rate and random.random() < error_rate:
+            stats["injected_errors"] += 1
+            return 429, {"error": {"code": 429, "message": "Too many concurrent requests for user."}}
+        return 200, mailbox.message(index, fmt)
+
+    @app.get("/_bench/health")
+    async def health():
+        return {"ok": True, "size": mailbox.size, **stats}
+
+    @app.post("/_bench/deliver")
+    async def deliver(count: int = 10):
+        # New mail for the next delta sync to pick up
+        mailbox.size += count
+        return {"size": mailbox.size, "history_id": mailbox.history_id()}
+
+    @app.get("/gmail/v1/users/{user_id}/profile")
+    async def profile(user_id: str):
+        await delay()
+        return {"emailAddress": "me@example.com", "messagesTotal": mailbox.size, "historyId": str(mailbox.history_id())}
+
+    @app.get("/gmail/v1/users/{user_id}/messages")
+    async def list_messages(user_id: str, maxResults: int = 100, pageToken: str | None = None):
+        await delay()
+        # Newest first, like Gmail; the page token is the index to continue from
+        start = int(pageToken) if pageToken else mailbox.size - 1
+        stop = max(-1, start - min(maxResults, 500))
+        result = {"messages": [mailbox.ref(i) for i in range(start, stop, -1)]}
+        if stop >= 0:
+            result["nextPageToken"] = str(stop)
+        return result
+
+    @app.get("/gmail/v1/users/{user_id}/messages/{message_id}")
+    async def get_message_route(user_id: str, message_id: str, format: str = "full"):
+        await delay()
+        status, payload = get_message(message_id, format)
+        return Response(json.dumps(payload), status_code=status, media_type="application/json")
+
+    @app.get("/gmail/v1/users/{user_id}/history")
+    async def history(user_id: str, startHistoryId: int):
+        await delay()
+        if startHistoryId < BASE_HISTORY_ID:
+            return Response(json.dumps({"error": {"code": 404, "message": "Not found"}}), status_code=404)
+        first = max(0, startHistoryId - BASE_HISTORY_ID)
+        records = [
+            {"id": str(BASE_HISTORY_ID + i + 1), "messagesAdded": [{"message": {**mailbox.ref(i), "labelIds": ["INBOX"]}}]}
+            for i in range(first, mailbox.size)
+        ]
+        return {"history": records, "historyId": str(mailbox.history_id())}
+
+    @app.post("/batch")
+    @app.post("/batch/gmail/v1")
+    async def batch(request: Request):
+        await delay()
+        boundary = re.search(r'boundary="?([^";]+)"?', request.headers["content-type"]).group(1)
+        body = (await request.body()).decode("utf-8")
+        out_boundary = "batch_fake_gmail"
+        parts = []
+        for raw in body.split(f"--{boundary}"):
+            raw = raw.strip()
+            if not raw or raw == "--":
+                continue
+            outer, _, inner = raw.replace("\r\n", "\n").partition("\n\n")
+            content_id = re.search(r"Content-ID:\s*<([^>]+)>", outer, re.IGNORECASE).group(1)
+            request_line = inner.split("\n", 1)[0]
+            path = request_line.split(" ")[1]
+            match = re.search(r"/messages/([^/?]+)", path)
+            fmt = re.search(r"[?&]format=(\w+)", path)
+            status, payload = get_message(match.group(1) if match else "", fmt.group(1) if fmt else "full")
+            stats["batch_parts"] += 1
+            reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests"}[status]
+            parts.append(
+                f"--{out_boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+        content = "".join(parts) + f"--{out_boundary}--\r\n"
+        return Response(content, media_type=f"multipart/mixed; boundary={out_boundary}")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Gmail API stand-in for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8801)
+    parser.add_argument("--messages", type=int, default=1000, help="synthetic mailbox size")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean added latency per HTTP request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of message gets answered with a 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--automated-share", type=float, default=0.6, help="share of newsletters/notifications with bulk headers")
+    args = parser.parse_args()
+    app = create_app(SyntheticMailbox(args.messages, args.seed, args.automated_share), args.latency_ms, args.error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# benchmarks/fake_groq.py
+#
+# Local OpenAI/Groq-compatible /openai/v1/chat/completions endpoint. Answers
+# are shaped like what each prompt in services/ai_stuff.py expects (Yes/No,
+# JSON todo arrays, triage objects, batched triage keyed by email id, thread
+# triage with a summary, free text) and derived from a hash of the prompt, so
+# runs are repeatable. Latency is a fixed time-to-first-token plus a per-token
+# generation time; a share of calls can be failed with 429/500.
+#
+#   python -m benchmarks.fake_groq --port 8802 --latency-ms 300 --ms-per-token 5 --error-rate 0.02
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY_WORDS = (
+    "thanks for reaching out I have looked at this and will get back to you with the details "
+    "shortly in the meantime let me know if anything else is needed on your side"
+).split()
+BATCH_EMAIL_RE = re.compile(r'<email id="([^"]+)">(.*?)</email>', re.DOTALL)
+TODO_TITLES = ["Send updated numbers", "Review the draft", "Schedule a call", "Confirm the budget", "Reply with availability"]
+
+
+def _prompt_text(messages):
+    return "\n".join(m.get("content") or "" for m in messages)
+
+
+def _count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def _todos(rng):
+    return [
+        {"title": title, "completed": False, "due": rng.choice([None, "Friday", "next week"])}
+        for title in rng.sample(TODO_TITLES, rng.randint(0, 2))
+    ]
+
+
+def _rng_for(text):
+    return random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+
+
+def _triage(rng):
+    return {
+        "needs_reply": rng.random() < 0.4,
+        "reply_confidence": round(rng.uniform(0.5, 1.0), 2),
+        "todos": _todos(rng),
+    }
+
+
+def fake_answer(body):
+    """Content for a chat.completions request, shaped after the prompt it carries."""
+    messages = body.get("messages", [])
+    text = _prompt_text(messages)
+    rng = _rng_for(text)
+    system = messages[0].get("content", "") if messages else ""
+
+    if (body.get("response_format") or {}).get("type") == "json_object":
+        emails = BATCH_EMAIL_RE.findall(text)
+        if emails:
+            # Batched triage: one entry per email, each as if it had been asked alone
+            return json.dumps({email_id: _triage(_rng_for(section)) for email_id, section in emails})
+        answer = _triage(rng)
+        if '"summary"' in text:
+            # Thread triage also returns the updated conversation summary
+            answer["summary"] = " ".join(rng.choice(REPLY_WORDS) for _ in range(rng.randint(30, 80))).capitalize() + "."
+        return json.dumps(answer)
+    if 'Answer only "Yes" or "No"' in text:
+        return "Yes" if rng.random() < 0.4 else "No"
+    if "extract tasks" in system:
+        return json.dumps(_todos(rng))
+    length = min(body.get("max_tokens") or 120, 120)
+    return " ".join(rng.choice(REPLY_WORDS) for _ in range(rng.randint(length // 2, length))).capitalize() + "."
+
+
+def create_app(latency_ms=0.0, ms_per_token=0.0, error_rate=0.0):
+    app = FastAPI()
+    stats = {"requests": 0, "injected_errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    @app.get("/_bench/health")
+    async def health():
+        return {"ok": True, **stats}
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        if error_rate and random.random() < error_rate:
+            stats["injected_errors"] += 1
+            if random.random() < 0.5:
+                return JSONResponse({"error": {"message": "Rate limit reached", "type": "tokens"}}, status_code=429, headers={"retry-after": "0.2"})
+            return JSONResponse({"error": {"message": "Internal server error"}}, status_code=500)
+
+        content = fake_answer(body)
+        prompt_tokens = _count_tokens(_prompt_text(body.get("messages", [])))
+        completion_tokens = _count_tokens(content)
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        model = body.get("model", "fake")
+        created = int(time.time())
+
+        await asyncio.sleep(latency_ms * random.uniform(0.7, 1.3) / 1000)
+
+        if body.get("stream"):
+            async def events():
+                words = content.split(" ")
+                for i, word in enumerate(words):
+                    if ms_per_token:
+                        await asyncio.sleep(ms_per_token / 1000)
+                    delta = {"content": word if i == 0 else " " + word}
+                    chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                done = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+                yield f"data: {json.dumps(done)}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        await asyncio.sleep(ms_per_token * completion_tokens / 1000)
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Groq/OpenAI-compatible stand-in for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8802)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean time to first token")
+    parser.add_argument("--ms-per-token", type=float, default=0.0, help="generation time per completion token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls failed with 429/500")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency_ms, args.ms_per_token, args.error_rate), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
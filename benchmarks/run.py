@@ -0,0 +1,488 @@
+# benchmarks/run.py
+#
+# Offline benchmark suite. Starts the local Gmail and Groq stand-ins, points
+# the app at them and at a scratch database, then times ingestion, sync and
+# the main read/analysis endpoints at several concurrency levels. Results
+# (throughput, p50/p99 latency, peak RSS) are written as JSON and can be
+# compared against an earlier run.
+#
+#   python -m benchmarks.run --messages 10000 --concurrency 1,8,32 \
+#       --output benchmarks/results/latest.json --baseline benchmarks/results/baseline.json
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import datetime, timedelta
+from pathlib import Path
+import httpx
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ["ingest", "store_email_data", "sync", "ai_analysis", "todos", "email_qa"]
+QUESTIONS = [
+    "What did {name} say about the {topic}?",
+    "Are there any deadlines related to the {topic}?",
+    "Summarize the latest emails about the {topic}.",
+    "Who asked me to schedule a call about the {topic}?",
+]
+NAMES = ["Alice", "Bob", "Carol", "Dan", "Erin", "Frank"]
+TOPICS = ["Q3 review", "project proposal", "budget approval", "team offsite", "contract renewal", "hiring plan"]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(module, port, *args):
+    process = subprocess.Popen(
+        [sys.executable, "-m", module, "--port", str(port), *map(str, args)],
+        cwd=REPO_ROOT,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/_bench/health", timeout=1).raise_for_status()
+            return process
+        except httpx.HTTPError:
+            if process.poll() is not None:
+                raise RuntimeError(f"{module} exited with code {process.returncode}")
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{module} did not come up on port {port}")
+
+
+def configure_app(overrides):
+    """
+    Swap app.config.settings for a view that returns the benchmark overrides
+    and falls back to the real settings (if there are any) for everything
+    else. Must run before anything under app.backend is imported, since the
+    modules read their settings at import time.
+    """
+    try:
+        from app.config import settings as real_settings
+    except ImportError:
+        real_settings = None
+
+    class BenchSettings:
+        def __getattr__(self, name):
+            if name in overrides:
+                return overrides[name]
+            if real_settings is None:
+                raise AttributeError(name)
+            return getattr(real_settings, name)
+
+    module = types.ModuleType("app.config")
+    module.settings = BenchSettings()
+    sys.modules["app.config"] = module
+
+
+class PeakRSS:
+    """Samples this process's resident set size in the background and keeps the peak."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            # No procfs (macOS): lifetime peak is the best we have
+            import resource
+            scale = 1 if sys.platform == "darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+    @property
+    def peak_mb(self):
+        return round(self.peak / (1024 * 1024), 1)
+
+
+def summarize(scenario, concurrency, latencies, errors, elapsed, rss, unit="requests", count=None):
+    latencies_ms = np.asarray(latencies) * 1000
+    count = len(latencies) if count is None else count
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "unit": unit,
+        "count": count,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(count / elapsed, 2) if elapsed else None,
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 2) if len(latencies_ms) else None,
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 2) if len(latencies_ms) else None,
+        "mean_ms": round(float(latencies_ms.mean()), 2) if len(latencies_ms) else None,
+        "peak_rss_mb": rss.peak_mb,
+    }
+    print(
+        f"{scenario:<18} c={concurrency:<4} {result['throughput']:>10} {unit}/s  "
+        f"p50={result['p50_ms']}ms p99={result['p99_ms']}ms errors={errors} rss={result['peak_rss_mb']}MB"
+    )
+    return result
+
+
+async def run_load(send, total, concurrency):
+    """Issue total calls of send(i) from concurrency workers; returns (latencies, errors, elapsed)."""
+    latencies, errors = [], 0
+    counter = itertools.count()
+
+    async def worker():
+        nonlocal errors
+        while (i := next(counter)) < total:
+            start = time.perf_counter()
+            try:
+                ok = await send(i)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+class Bench:
+    def __init__(self, args, gmail_url):
+        # Imported here, after configure_app()
+        from google.oauth2.credentials import Credentials
+        from app.backend.db.session import engine
+        from app.backend.models.email import Base
+        from app.backend.services.token_store import token_store, DEFAULT_MAILBOX
+
+        self.args = args
+        self.gmail_url = gmail_url
+        Base.metadata.create_all(bind=engine)
+        self.mailbox = DEFAULT_MAILBOX
+        token_store.save(self.mailbox, Credentials(
+            token="bench", refresh_token=None, token_uri="http://127.0.0.1/token",
+            client_id="bench", client_secret="bench", scopes=["https://www.googleapis.com/auth/gmail.readonly"],
+            expiry=datetime.utcnow() + timedelta(days=1),
+        ))
+        self.results = []
+        self.ingested = False
+        self.analyzed = False
+
+    def service(self):
+        from app.backend.services.gmail import build_gmail_service
+        from app.backend.services.token_store import token_store, DEFAULT_MAILBOX
+        return build_gmail_service(token_store.get_credentials(self.mailbox))
+
+    def bench_ingest(self, record=True):
+        from app.backend.services.gmail import list_message_refs, batch_get_messages, ingest_messages
+
+        service = self.service()
+        latencies, errors, total = [], 0, 0
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            refs = list_message_refs(service)
+            ids = [ref["id"] for ref in refs]
+            for offset in range(0, len(ids), 1000):
+                chunk_start = time.perf_counter()
+                details, _ = batch_get_messages(service, ids[offset:offset + 1000])
+                counts = ingest_messages(details)
+                latencies.append(time.perf_counter() - chunk_start)
+                errors += len(ids[offset:offset + 1000]) - len(details)
+                total += counts["inserted"] + counts["updated"] + counts["skipped"]
+            elapsed = time.perf_counter() - start
+        self.ingested = True
+        if record:
+            # Latencies are per 1000-message chunk (batch fetch + upsert)
+            self.results.append(summarize("ingest", 1, latencies, errors, elapsed, rss, unit="messages", count=total))
+
+    def bench_store_email_data(self):
+        from app.backend.services.gmail import list_message_refs, batch_get_messages, store_email_data
+
+        service = self.service()
+        refs = list_message_refs(service, max_results=self.args.store_sample)
+        details, _ = batch_get_messages(service, [ref["id"] for ref in refs])
+        latencies, errors = [], 0
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            for detail in details:
+                call_start = time.perf_counter()
+                try:
+                    store_email_data(detail["threadId"], detail)
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - call_start)
+            elapsed = time.perf_counter() - start
+        self.results.append(summarize("store_email_data", 1, latencies, errors, elapsed, rss, unit="messages"))
+
+    def bench_sync(self):
+        from app.backend.tasks.email_sync import _sync_mailbox
+
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            _sync_mailbox(self.mailbox, True)
+            elapsed = time.perf_counter() - start
+        self.results.append(summarize("sync_full", 1, [elapsed], 0, elapsed, rss, unit="syncs"))
+
+        latencies = []
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            for _ in range(self.args.sync_rounds):
+                httpx.post(f"{self.gmail_url}/_bench/deliver", params={"count": self.args.delta_messages}).raise_for_status()
+                round_start = time.perf_counter()
+                _sync_mailbox(self.mailbox, False)
+                latencies.append(time.perf_counter() - round_start)
+            elapsed = time.perf_counter() - start
+        self.results.append(summarize("sync_delta", 1, latencies, 0, elapsed, rss, unit="syncs"))
+        self.ingested = True
+
+    async def bench_http(self, scenario, levels, total, make_request):
+        from app.backend.main import app
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for concurrency in levels:
+                async def send(i):
+                    response = await make_request(client, i)
+                    return response.status_code < 400
+
+                with PeakRSS() as rss:
+                    latencies, errors, elapsed = await run_load(send, max(total, concurrency), concurrency)
+                self.results.append(summarize(scenario, concurrency, latencies, errors, elapsed, rss))
+
+    async def bench_ai_analysis(self, record=True):
+        async def request(client, i):
+            return await client.get("/gmail/ai_analysis", params={"force": "true"})
+
+        if record:
+            from app.backend.services.reply_prefilter import reply_prefilter
+            await self.bench_http("ai_analysis", self.args.concurrency, self.args.analysis_requests, request)
+            stats = reply_prefilter.stats()
+            print(f"Reply pre-filter: skip rate {stats['skip_rate']:.0%}, {stats['decisions']}")
+        else:
+            from app.backend.main import app
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None) as client:
+                await request(client, 0)
+        self.analyzed = True
+
+    async def bench_todos(self):
+        async def request(client, i):
+            params = {"limit": 50}
+            if i % 3 == 1:
+                params["completed"] = "false"
+            return await client.get("/gmail/todos", params=params)
+
+        await self.bench_http("todos", self.args.concurrency, self.args.requests, request)
+
+    async def bench_email_qa(self):
+        async def request(client, i):
+            template = QUESTIONS[i % len(QUESTIONS)]
+            question = template.format(name=NAMES[i % len(NAMES)], topic=TOPICS[(i // len(QUESTIONS)) % len(TOPICS)])
+            return await client.post("/gmail/email-qa", json={"question": f"{question} ({i})"})
+
+        await self.bench_http("email_qa", self.args.concurrency, self.args.qa_requests, request)
+
+    async def run(self, scenarios):
+        for scenario in scenarios:
+            if scenario in ("store_email_data", "ai_analysis", "todos", "email_qa") and not self.ingested:
+                self.bench_ingest(record=False)
+            if scenario == "todos" and not self.analyzed:
+                await self.bench_ai_analysis(record=False)
+
+            if scenario == "ingest":
+                self.bench_ingest()
+            elif scenario == "store_email_data":
+                self.bench_store_email_data()
+            elif scenario == "sync":
+                self.bench_sync()
+            elif scenario == "ai_analysis":
+                await self.bench_ai_analysis()
+            elif scenario == "todos":
+                await self.bench_todos()
+            elif scenario == "email_qa":
+                await self.bench_email_qa()
+        return self.results
+
+
+# Higher is better for throughput, lower for everything else
+METRICS = {"throughput": 1, "p50_ms": -1, "p99_ms": -1, "peak_rss_mb": -1}
+
+
+def compare(results, baseline, threshold):
+    """Print per-metric changes against a baseline run; returns the list of regressions."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\nCompared with baseline from {baseline['meta'].get('timestamp')} ({baseline['meta'].get('git_commit')}):")
+    for result in results:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if before is None:
+            continue
+        changes = []
+        for metric, direction in METRICS.items():
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = direction * change < -threshold
+            changes.append(f"{metric} {change:+.1%}{' !' if regressed else ''}")
+            if regressed:
+                regressions.append({"scenario": result["scenario"], "concurrency": result["concurrency"], "metric": metric, "change": round(change, 4)})
+        print(f"  {result['scenario']:<18} c={result['concurrency']:<4} " + ", ".join(changes))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks against local Gmail and Groq stand-ins")
+    parser.add_argument("--messages", type=int, default=1000, help="synthetic mailbox size (1k-100k)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="concurrent clients for the HTTP scenarios")
+    parser.add_argument("--requests", type=int, default=200, help="requests per concurrency level for /gmail/todos")
+    parser.add_argument("--qa-requests", type=int, default=50, help="requests per concurrency level for /gmail/email-qa")
+    parser.add_argument("--analysis-requests", type=int, default=8, help="requests per concurrency level for /gmail/ai_analysis")
+    parser.add_argument("--store-sample", type=int, default=500, help="messages written one by one via store_email_data")
+    parser.add_argument("--sync-rounds", type=int, default=5, help="delta syncs to time")
+    parser.add_argument("--delta-messages", type=int, default=50, help="new messages delivered before each delta sync")
+    parser.add_argument("--gmail-latency-ms", type=float, default=20.0)
+    parser.add_argument("--gmail-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=200.0)
+    parser.add_argument("--llm-ms-per-token", type=float, default=2.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--groq-rpm", type=int, default=1_000_000, help="scheduler limit; the default effectively disables throttling")
+    parser.add_argument("--groq-tpm", type=int, default=1_000_000_000)
+    parser.add_argument("--analysis-mode", default="triage", choices=["triage", "batch", "thread", "split"], help="AI_ANALYSIS_MODE for the ai_analysis scenario")
+    parser.add_argument("--automated-share", type=float, default=0.6, help="share of synthetic mail that is newsletters/notifications")
+    parser.add_argument("--no-reply-prefilter", action="store_true", help="send every message to the LLM for the needs-reply decision")
+    parser.add_argument("--llm-cache", action="store_true", help="keep the completion cache on (off by default so every call hits the LLM)")
+    parser.add_argument("--redis-url", default=None, help="enable the response cache against this Redis")
+    parser.add_argument("--db-url", default=None, help="database to benchmark against (default: scratch SQLite file)")
+    parser.add_argument("--workdir", default=None, help="where scratch DB and index files go (default: a temp dir)")
+    parser.add_argument("--output", default="benchmarks/results/latest.json")
+    parser.add_argument("--baseline", default=None, help="earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's INFO/DEBUG logging")
+    args = parser.parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="email-bench-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    gmail_port, groq_port = _free_port(), _free_port()
+
+    from cryptography.fernet import Fernet
+    configure_app({
+        "DB_URL": args.db_url or f"sqlite:///{workdir / 'bench.db'}",
+        "LLM_CACHE_PATH": str(workdir / "llm_cache.sqlite3"),
+        "SEARCH_INDEX_PATH": str(workdir / "email_search.sqlite3"),
+        "VECTOR_INDEX_DIR": str(workdir / "vector_index"),
+        "REPLY_PREFILTER_PATH": str(workdir / "reply_prefilter.npz"),
+        "REPLY_PREFILTER_ENABLED": not args.no_reply_prefilter,
+        "AI_ANALYSIS_MODE": args.analysis_mode,
+        "GMAIL_API_ENDPOINT": f"http://127.0.0.1:{gmail_port}/",
+        "GROQ_BASE_URL": f"http://127.0.0.1:{groq_port}",
+        "GROQ_API_KEY": "bench",
+        "GROQ_RPM": args.groq_rpm,
+        "GROQ_TPM": args.groq_tpm,
+        # One benchmark process: local buckets unless a Redis is given to share them through
+        "GROQ_RATE_LIMIT_SHARED": bool(args.redis_url),
+        "TOKEN_ENCRYPTION_KEY": Fernet.generate_key().decode("ascii"),
+        "GOOGLE_CLIENT_ID": "bench",
+        "GOOGLE_CLIENT_SECRET": "bench",
+        "GOOGLE_REDIRECT_URI": "http://127.0.0.1/gmail/callback",
+        "RESPONSE_CACHE_ENABLED": bool(args.redis_url),
+        # Keep ingest timings free of stream writes and bench mail away from real analysis workers
+        "ANALYSIS_STREAM_ENABLED": False,
+        "REDIS_URL": args.redis_url or "redis://localhost:6379/0",
+    })
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    servers = []
+    try:
+        servers.append(start_server(
+            "benchmarks.fake_gmail", gmail_port,
+            "--messages", args.messages, "--latency-ms", args.gmail_latency_ms, "--error-rate", args.gmail_error_rate,
+            "--automated-share", args.automated_share,
+        ))
+        servers.append(start_server(
+            "benchmarks.fake_groq", groq_port,
+            "--latency-ms", args.llm_latency_ms, "--ms-per-token", args.llm_ms_per_token, "--error-rate", args.llm_error_rate,
+        ))
+
+        bench = Bench(args, f"http://127.0.0.1:{gmail_port}")
+        if not args.llm_cache:
+            from app.backend.services.ai_stuff import llm
+            llm.cache = None
+        results = asyncio.run(bench.run(args.scenarios))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "workdir")},
+        },
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.threshold)
+        if report["regressions"] and args.fail_on_regression:
+            exit_code = 1
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nWrote {output}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())